@@ -0,0 +1,234 @@
+import asyncio
+import math
+import time
+from collections import deque
+from typing import AsyncIterator, Dict, List, Optional
+
+
+class AdmissionRejected(Exception):
+    """排队已满（或排队超时），retry_after 为建议的重试等待秒数"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Ticket:
+    def __init__(self, client: str, lane: str):
+        self.client = client
+        self.lane = lane
+        self.granted = False
+        self.released = False
+        self.enqueued_at = time.monotonic()
+        self.granted_at: Optional[float] = None
+
+
+class Scheduler:
+    """
+    上游调用的准入控制：全局并发上限 + 单客户端并发上限 + 有界 FIFO 排队 + 优先级通道
+
+    - lanes 按优先级从高到低排列；有空位时先放行高优先级通道的排队者，同一通道内先到先得
+    - reserved 为某通道预留的并发数，该通道未用满的预留名额低优先级通道不能占用
+      （例如长耗时的动画生成不会占满全部并发，文字对话总有空位）
+    - 单个客户端同时最多 per_client 个运行中、per_client 个排队中的请求，超出部分不会挤占他人
+    - 排队已满时立即拒绝（AdmissionRejected），由调用方返回 429 + Retry-After
+    计数只在当前进程内有效，多 worker 时每个进程各自限流
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_concurrent: int,
+        per_client: int,
+        max_queue: int,
+        lanes: List[str],
+        reserved: Optional[Dict[str, int]] = None,
+        queue_timeout: float = 120.0,
+    ):
+        self.name = name
+        self.max_concurrent = max(1, max_concurrent)
+        self.per_client = max(1, per_client)
+        self.max_queue = max(0, max_queue)
+        self.lanes = list(lanes)
+        self.queue_timeout = queue_timeout
+        # 预留总数不超过 max_concurrent - 1，保证最低优先级通道也能运行
+        reserved = reserved or {}
+        self.reserved = {lane: max(0, min(reserved.get(lane, 0), self.max_concurrent - 1)) for lane in self.lanes}
+        self._queues: Dict[str, deque] = {lane: deque() for lane in self.lanes}
+        self._active = 0
+        self._lane_active: Dict[str, int] = {lane: 0 for lane in self.lanes}
+        self._client_active: Dict[str, int] = {}
+        self._client_queued: Dict[str, int] = {}
+        self._changed = asyncio.Event()
+        # 单次占用时长的指数滑动平均，用于估算 Retry-After
+        self._hold_avg: Dict[str, float] = {}
+        self.admitted = 0
+        self.queued_total = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    @property
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _lane_limit(self, lane: str) -> int:
+        """该通道当前可用的并发上限：总数减去更高优先级通道尚未用掉的预留"""
+        held = 0
+        for other in self.lanes:
+            if other == lane:
+                break
+            held += max(0, self.reserved.get(other, 0) - self._lane_active[other])
+        return self.max_concurrent - held
+
+    def _can_run(self, client: str, lane: str) -> bool:
+        return (
+            self._active < self._lane_limit(lane)
+            and self._client_active.get(client, 0) < self.per_client
+        )
+
+    def retry_after(self, lane: str) -> int:
+        hold = self._hold_avg.get(lane, 10.0)
+        waves = (self.queued + 1) / self.max_concurrent
+        return max(1, math.ceil(hold * waves))
+
+    def check(self, client: str, lane: str):
+        """不占位地预检：若本次请求需要排队且队列已满则抛出 AdmissionRejected"""
+        if self._can_run(client, lane) and not self._queues[lane]:
+            return
+        if self.queued >= self.max_queue or self._client_queued.get(client, 0) >= self.per_client:
+            self.rejected += 1
+            raise AdmissionRejected("服务繁忙，请稍后重试", self.retry_after(lane))
+
+    def enter(self, client: str, lane: str) -> Ticket:
+        """登记一个请求：有空位时立即放行，否则进入排队；队列已满时抛出 AdmissionRejected"""
+        self.check(client, lane)
+        ticket = Ticket(client, lane)
+        self._queues[lane].append(ticket)
+        self._client_queued[client] = self._client_queued.get(client, 0) + 1
+        self._dispatch()
+        if not ticket.granted:
+            self.queued_total += 1
+        return ticket
+
+    def _dispatch(self):
+        granted = False
+        for lane in self.lanes:
+            queue = self._queues[lane]
+            for ticket in list(queue):
+                if self._active >= self._lane_limit(lane):
+                    break
+                if self._client_active.get(ticket.client, 0) >= self.per_client:
+                    continue
+                queue.remove(ticket)
+                self._client_queued[ticket.client] -= 1
+                self._grant(ticket)
+                granted = True
+        if granted:
+            self._notify()
+
+    def _grant(self, ticket: Ticket):
+        ticket.granted = True
+        ticket.granted_at = time.monotonic()
+        self._active += 1
+        self._lane_active[ticket.lane] += 1
+        self._client_active[ticket.client] = self._client_active.get(ticket.client, 0) + 1
+        self.admitted += 1
+
+    def position(self, ticket: Ticket) -> int:
+        """排队位置（从 1 开始）：更高优先级通道的全部排队者 + 同通道中排在前面的"""
+        if ticket.granted:
+            return 0
+        ahead = 0
+        for lane in self.lanes:
+            if lane == ticket.lane:
+                return ahead + self._queues[lane].index(ticket) + 1
+            ahead += len(self._queues[lane])
+        return ahead + 1
+
+    async def wait(self, ticket: Ticket) -> AsyncIterator[int]:
+        """等待放行，排队位置变化时产出新位置；超过 queue_timeout 抛出 AdmissionRejected"""
+        deadline = time.monotonic() + self.queue_timeout
+        last = None
+        while not ticket.granted:
+            position = self.position(ticket)
+            if position != last:
+                last = position
+                yield position
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.timed_out += 1
+                self.release(ticket)
+                raise AdmissionRejected("排队超时，请稍后重试", self.retry_after(ticket.lane))
+            try:
+                await asyncio.wait_for(self._changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    async def acquire(self, ticket: Ticket):
+        async for _ in self.wait(ticket):
+            pass
+
+    def release(self, ticket: Ticket):
+        """结束占用或放弃排队（可重复调用）"""
+        if ticket.released:
+            return
+        ticket.released = True
+        client = ticket.client
+        if ticket.granted:
+            self._active -= 1
+            self._lane_active[ticket.lane] -= 1
+            self._client_active[client] -= 1
+            if not self._client_active[client]:
+                del self._client_active[client]
+            hold = time.monotonic() - ticket.granted_at
+            previous = self._hold_avg.get(ticket.lane)
+            self._hold_avg[ticket.lane] = hold if previous is None else previous * 0.8 + hold * 0.2
+        else:
+            self._queues[ticket.lane].remove(ticket)
+            self._client_queued[client] -= 1
+        if not self._client_queued.get(client, 1):
+            del self._client_queued[client]
+        self._dispatch()
+        self._notify()
+
+    def slot(self, client: str, lane: str) -> "Slot":
+        return Slot(self, client, lane)
+
+    def stats(self) -> dict:
+        return {
+            "active": self._active,
+            "active_by_lane": dict(self._lane_active),
+            "queued": {lane: len(queue) for lane, queue in self._queues.items()},
+            "max_concurrent": self.max_concurrent,
+            "admitted": self.admitted,
+            "queued_total": self.queued_total,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+        }
+
+
+class Slot:
+    """非流式调用使用：async with scheduler.slot(client, lane): ...（排队已满时进入即抛出 AdmissionRejected）"""
+
+    def __init__(self, scheduler: Scheduler, client: str, lane: str):
+        self._scheduler = scheduler
+        self._client = client
+        self._lane = lane
+        self._ticket: Optional[Ticket] = None
+
+    async def __aenter__(self):
+        self._ticket = self._scheduler.enter(self._client, self._lane)
+        try:
+            await self._scheduler.acquire(self._ticket)
+        except BaseException:
+            self._scheduler.release(self._ticket)
+            raise
+        return self._ticket
+
+    async def __aexit__(self, *exc):
+        self._scheduler.release(self._ticket)
+        return False
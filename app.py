@@ -1,10 +1,12 @@
 import asyncio
+import base64
 import json
 import re
 import os
+import time
 import uuid
 from datetime import datetime
-from typing import AsyncGenerator, List, Optional
+from typing import AsyncGenerator, List, Optional, Tuple
 
 import pytz
 import httpx
@@ -20,6 +22,38 @@ try:
     import google.generativeai as genai
 except ModuleNotFoundError:
     from google import genai
+try:
+    import h2  # noqa: F401  httpx 的 HTTP/2 支持依赖 h2
+    HTTP2_AVAILABLE = True
+except ModuleNotFoundError:
+    HTTP2_AVAILABLE = False
+
+from assets import ASSET_PREFIX, PageShells, asset_urls, build_assets
+from artifacts import codec_name, looks_like_html, minify_html, set_codec, unpack
+from admission import AdmissionRejected, Scheduler
+from cache import ResponseCache, history_digest, make_cache_key, normalize_text
+from history import build_history
+from html_stream import HtmlStreamExtractor
+from jobs import JobRunner, is_finished
+from prompts import MODEL_PROMPT, prompt_for_mode
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+from metrics import FAST_BUCKETS, RATE_BUCKETS, SIZE_BUCKETS, Counter, Gauge, Registry
+from providers import GeminiProvider, OpenAIProvider, Provider, ProviderPool
+from resume import ResumableStreams, parse_last_event_id, split_frames
+from shared_state import create_shared_state
+from singleflight import DistributedSingleFlight, SingleFlight
+from sse import (
+    DONE_FRAME,
+    accepts_encoding,
+    coalesce_tokens,
+    compress_body,
+    compress_frames,
+    encode_event,
+    negotiate_encoding,
+    set_json_encoder,
+    token_frame,
+)
+from storage import create_store
 # -----------------------------------------------------------------------
 # 0. 配置
 # -----------------------------------------------------------------------
@@ -30,37 +64,156 @@ with open("credentials.json", "r") as f:
 API_KEY = credentials["API_KEY"]
 BASE_URL = credentials.get("BASE_URL", "")
 MODEL = credentials.get("MODEL", "gemini-3-pro-preview")
+# 备用模型提供方：[{"API_KEY", "BASE_URL", "MODEL", "NAME", "TYPE"}]，主提供方失败或过慢时依次使用
+PROVIDERS = credentials.get("PROVIDERS", [])
+# 首个 token 之前的重试、对冲与熔断（LLM_HEDGE_AFTER / LLM_SLOW_THRESHOLD 为 0 表示不启用）
+LLM_RETRIES = int(credentials.get("LLM_RETRIES", 2))
+LLM_BACKOFF_BASE = float(credentials.get("LLM_BACKOFF_BASE", 0.5))
+LLM_HEDGE_AFTER = float(credentials.get("LLM_HEDGE_AFTER", 0))
+LLM_SLOW_THRESHOLD = float(credentials.get("LLM_SLOW_THRESHOLD", 0))
+LLM_BREAKER_FAILURES = int(credentials.get("LLM_BREAKER_FAILURES", 3))
+LLM_BREAKER_COOLDOWN = float(credentials.get("LLM_BREAKER_COOLDOWN", 30))
+# 前缀缓存：OpenAI 兼容接口随请求发送 prompt_cache_key（上游需支持该参数）；
+# Gemini 为固定的系统提示词创建 cached content 并保留的秒数（0 表示只依赖隐式缓存）。PROVIDERS 中的条目可单独覆盖
+PROMPT_CACHE_KEY = bool(credentials.get("PROMPT_CACHE_KEY", False))
+GEMINI_CONTEXT_CACHE_TTL = float(credentials.get("GEMINI_CONTEXT_CACHE_TTL", 0))
 # Qwen TTS API 配置
 QWEN_TTS_API_KEY = credentials.get("QWEN_TTS_API_KEY", "")
 QWEN_TTS_BASE_URL = credentials.get("Base_TTS_URL", "https://dashscope.aliyuncs.com/compatible-mode/v1")
 # 使用 Qwen TTS
 USE_QWEN_TTS = bool(QWEN_TTS_API_KEY)
-
-if API_KEY.startswith("sk-"):
-    # 为 OpenRouter 添加应用标识
-    extra_headers = {}
-    if "openrouter.ai" in BASE_URL.lower():
-        extra_headers = {
-            "HTTP-Referer": "https://github.com/fogsightai/fogsight",
-            "X-Title": "Fogsight - AI Animation Generator"
-        }
-    
-    client = AsyncOpenAI(
-        api_key=API_KEY, 
-        base_url=BASE_URL,
-        default_headers=extra_headers
-    )
-    USE_GEMINI = False
-else:
-    os.environ["GEMINI_API_KEY"] = API_KEY
-    gemini_client = genai.Client()
-    USE_GEMINI = True
+# 生成结果缓存配置（RESPONSE_CACHE_DIR 为空则只使用内存缓存）
+RESPONSE_CACHE_TTL = float(credentials.get("RESPONSE_CACHE_TTL", 24 * 3600))
+RESPONSE_CACHE_MAX_ENTRIES = int(credentials.get("RESPONSE_CACHE_MAX_ENTRIES", 512))
+RESPONSE_CACHE_DIR = credentials.get("RESPONSE_CACHE_DIR", "")
+# TTS 音频缓存配置（TTS_CACHE_DIR 为空则只使用内存缓存）
+TTS_CACHE_TTL = float(credentials.get("TTS_CACHE_TTL", 7 * 24 * 3600))
+TTS_CACHE_MAX_ENTRIES = int(credentials.get("TTS_CACHE_MAX_ENTRIES", 2048))
+TTS_CACHE_MAX_BYTES = int(credentials.get("TTS_CACHE_MAX_BYTES", 128 * 1024 * 1024))
+TTS_CACHE_DIR = credentials.get("TTS_CACHE_DIR", "")
+# 批量预取字幕音频时的最大并发数
+TTS_PREFETCH_CONCURRENCY = int(credentials.get("TTS_PREFETCH_CONCURRENCY", 4))
+# 送入模型的历史消息：按 token 预算裁剪，带 chat_id 时最多读取最近的多少条消息
+HISTORY_TOKEN_BUDGET = int(credentials.get("HISTORY_TOKEN_BUDGET", 8000))
+HISTORY_MAX_MESSAGES = int(credentials.get("HISTORY_MAX_MESSAGES", 40))
+# 准入控制：上游 LLM / TTS 调用的全局并发、单客户端并发与排队长度（按进程计）
+LLM_MAX_CONCURRENCY = int(credentials.get("LLM_MAX_CONCURRENCY", 8))
+LLM_MAX_PER_CLIENT = int(credentials.get("LLM_MAX_PER_CLIENT", 2))
+LLM_QUEUE_SIZE = int(credentials.get("LLM_QUEUE_SIZE", 32))
+LLM_TEXT_RESERVED = int(credentials.get("LLM_TEXT_RESERVED", 2))
+TTS_MAX_CONCURRENCY = int(credentials.get("TTS_MAX_CONCURRENCY", 8))
+TTS_MAX_PER_CLIENT = int(credentials.get("TTS_MAX_PER_CLIENT", 4))
+TTS_QUEUE_SIZE = int(credentials.get("TTS_QUEUE_SIZE", 64))
+ADMISSION_QUEUE_TIMEOUT = float(credentials.get("ADMISSION_QUEUE_TIMEOUT", 120))
+# 每次生成 / TTS 调用结束时输出一行 JSON 计时日志
+TIMING_LOG = bool(credentials.get("TIMING_LOG", True))
+# SSE 客户端断开检测间隔（秒）：上游长时间没有输出时也能及时取消
+DISCONNECT_POLL_INTERVAL = float(credentials.get("DISCONNECT_POLL_INTERVAL", 0.5))
+# 事件循环延迟探测间隔（秒），0 表示关闭
+EVENT_LOOP_LAG_INTERVAL = float(credentials.get("EVENT_LOOP_LAG_INTERVAL", 0.5))
+# SSE 输出：token 微批窗口（秒，0 表示逐 token 输出）与单帧最多合并的字符数
+SSE_BATCH_INTERVAL = float(credentials.get("SSE_BATCH_INTERVAL", 0.02))
+SSE_BATCH_MAX_CHARS = int(credentials.get("SSE_BATCH_MAX_CHARS", 2048))
+# SSE JSON 编码器："auto"（已安装 orjson 时使用 orjson）、"orjson" 或 "json"
+SSE_JSON_ENCODER = credentials.get("SSE_JSON_ENCODER", "auto")
+# SSE 响应按 Accept-Encoding 压缩（gzip；安装 brotli 后优先 br），每个事件单独刷新
+SSE_COMPRESSION = bool(credentials.get("SSE_COMPRESSION", False))
+SSE_COMPRESSION_LEVEL = int(credentials.get("SSE_COMPRESSION_LEVEL", 5))
+# 生成的 HTML 保存前压缩（去掉注释与多余空白；已安装 minify-html 时同时压缩内联 CSS / JS），原文另存可按需取回
+HTML_MINIFY = bool(credentials.get("HTML_MINIFY", True))
+# 产物存储压缩："auto"（已安装 zstandard 时使用 zstd，否则 gzip）、"zstd" 或 "gzip"
+ARTIFACT_COMPRESSION = credentials.get("ARTIFACT_COMPRESSION", "auto")
+# 对话详情 / 单条消息 / 产物响应按 Accept-Encoding 压缩；小于 RESPONSE_COMPRESSION_MIN_SIZE 字节的响应不压缩
+RESPONSE_COMPRESSION = bool(credentials.get("RESPONSE_COMPRESSION", True))
+RESPONSE_COMPRESSION_MIN_SIZE = int(credentials.get("RESPONSE_COMPRESSION_MIN_SIZE", 1024))
+# 前端 script.js / style.css 启动时压缩（只删除注释与空白）；关闭后仍加内容哈希并预压缩，便于排查前端问题
+STATIC_MINIFY = bool(credentials.get("STATIC_MINIFY", True))
+# 可续传 SSE（请求体 "resumable": true）：结束后保留事件的秒数（0 表示关闭）、断线后继续生成的宽限秒数、
+# 全部缓冲区的总字节上限与每次生成最多保留的事件数
+SSE_RESUME_TTL = float(credentials.get("SSE_RESUME_TTL", 300))
+SSE_RESUME_GRACE = float(credentials.get("SSE_RESUME_GRACE", 60))
+SSE_RESUME_MAX_BYTES = int(credentials.get("SSE_RESUME_MAX_BYTES", 64 * 1024 * 1024))
+SSE_RESUME_MAX_EVENTS = int(credentials.get("SSE_RESUME_MAX_EVENTS", 10000))
+# 后台任务：本进程执行任务的 worker 数（0 表示只提交，由 python jobs.py 单独执行）、空闲 worker 与进度订阅的轮询间隔（秒）、
+# 心跳超过多少秒视为 worker 失联、任务结束后保留记录的秒数
+JOB_WORKERS = int(credentials.get("JOB_WORKERS", 2))
+JOB_POLL_INTERVAL = float(credentials.get("JOB_POLL_INTERVAL", 1.0))
+JOB_STALE_AFTER = float(credentials.get("JOB_STALE_AFTER", 60))
+JOB_TTL = float(credentials.get("JOB_TTL", 86400))
+# 对话/项目存储配置："sqlite"（默认，持久化）或 "memory"（进程内，重启丢失）
+STORAGE_BACKEND = credentials.get("STORAGE_BACKEND", "sqlite")
+STORAGE_PATH = credentials.get("STORAGE_PATH", os.path.join("data", "chattutor.db"))
+# 多进程共享状态（缓存与进行中请求合并）："" 不共享、"sqlite"（单机多 worker）或 "redis"
+SHARED_STATE_BACKEND = credentials.get("SHARED_STATE_BACKEND", "")
+SHARED_STATE_PATH = credentials.get("SHARED_STATE_PATH", os.path.join("data", "shared_state.db"))
+SHARED_STATE_URL = credentials.get("SHARED_STATE_URL", "redis://127.0.0.1:6379/0")
+# worker 数量由 start_fogsight.py --workers 通过环境变量传入
+WORKERS = int(os.environ.get("CHATTUTOR_WORKERS", "1"))
+if WORKERS > 1:
+    if STORAGE_BACKEND == "memory":
+        raise RuntimeError("多 worker 模式下不能使用 memory 存储，请将 STORAGE_BACKEND 设置为 sqlite")
+    SHARED_STATE_BACKEND = SHARED_STATE_BACKEND or "sqlite"
+
+def create_provider(entry: dict, name: str, primary: bool = False) -> Provider:
+    """
+    按配置创建模型提供方：TYPE 为 "openai" / "gemini"，未指定时 sk- 开头的 key 视为 OpenAI 兼容接口
+    """
+    api_key = entry["API_KEY"]
+    base_url = entry.get("BASE_URL", "")
+    model = entry.get("MODEL", MODEL)
+    kind = entry.get("TYPE") or ("openai" if api_key.startswith("sk-") else "gemini")
+    if kind == "openai":
+        # 为 OpenRouter 添加应用标识
+        extra_headers = {}
+        if "openrouter.ai" in base_url.lower():
+            extra_headers = {
+                "HTTP-Referer": "https://github.com/fogsightai/fogsight",
+                "X-Title": "Fogsight - AI Animation Generator"
+            }
+        # 重试由 llm_pool 统一负责（可切换提供方），关闭 SDK 自带的重试
+        client = AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url or None,
+            default_headers=extra_headers,
+            max_retries=0,
+        )
+        return OpenAIProvider(name, client, model, prompt_cache_key=bool(entry.get("PROMPT_CACHE_KEY", PROMPT_CACHE_KEY)))
+    if kind == "gemini":
+        context_cache_ttl = float(entry.get("GEMINI_CONTEXT_CACHE_TTL", GEMINI_CONTEXT_CACHE_TTL))
+        if primary:
+            # 主提供方的 BASE_URL 只用于 OpenAI 兼容接口，Gemini 使用默认地址
+            os.environ["GEMINI_API_KEY"] = api_key
+            return GeminiProvider(name, genai.Client(), model, context_cache_ttl)
+        http_options = {"base_url": base_url} if base_url else None
+        return GeminiProvider(name, genai.Client(api_key=api_key, http_options=http_options), model, context_cache_ttl)
+    raise RuntimeError(f"未知的模型提供方类型：{kind}（可选 openai / gemini）")
+
+set_json_encoder(SSE_JSON_ENCODER)
+set_codec(ARTIFACT_COMPRESSION)
 
 if API_KEY.startswith("sk-REPLACE_ME"):
     raise RuntimeError("请在环境变量里配置 API_KEY")
 
+llm_pool = ProviderPool(
+    [create_provider({"API_KEY": API_KEY, "BASE_URL": BASE_URL, "MODEL": MODEL}, "primary", primary=True)]
+    + [create_provider(entry, entry.get("NAME") or f"provider-{i + 1}") for i, entry in enumerate(PROVIDERS)],
+    retries=LLM_RETRIES,
+    backoff_base=LLM_BACKOFF_BASE,
+    hedge_after=LLM_HEDGE_AFTER,
+    slow_threshold=LLM_SLOW_THRESHOLD,
+    breaker_failures=LLM_BREAKER_FAILURES,
+    breaker_cooldown=LLM_BREAKER_COOLDOWN,
+)
+
 templates = Jinja2Templates(directory="templates")
 
+# 静态资源带内容哈希并预先压缩，以 /assets/ 路径长期缓存；页面骨架按视图只渲染一次
+static_assets = build_assets("static", minify=STATIC_MINIFY)
+static_assets_by_url = {asset.url: asset for asset in static_assets.values()}
+page_shells = PageShells(
+    lambda view: templates.get_template("index.html").render(view=view, assets=asset_urls(static_assets))
+)
+
 # -----------------------------------------------------------------------
 # 1. FastAPI 初始化
 # -----------------------------------------------------------------------
@@ -70,14 +223,20 @@ app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_methods=["*"],
-    allow_headers=["Content-Type", "Authorization"],
+    allow_headers=["Content-Type", "Authorization", "X-Cache-Bypass", "Last-Event-ID"],
+    expose_headers=["X-Cache", "ETag", "X-TTS-Audio-Id", "X-Next-Cursor", "X-Generation-Id"],
 )
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 class ChatRequest(BaseModel):
     topic: str
     history: Optional[List[dict]] = None
+    chat_id: Optional[str] = None  # 提供时由服务端从存储的对话构建历史，忽略 history
     mode: Optional[str] = "animation"  # "animation" 或 "text"
+    # 动画模式下以 html_start / html_chunk / html_body / html_done 事件代替逐 token 输出
+    html_events: bool = False
+    # 事件带 id，客户端断线后携带 Last-Event-ID 请求 /api/generations/{id}/events 续传
+    resumable: bool = False
 
 class Project(BaseModel):
     id: str
@@ -86,7 +245,11 @@ class Project(BaseModel):
 
 class ChatMessage(BaseModel):
     role: str
-    content: str
+    content: Optional[str]
+    index: Optional[int] = None  # 消息在对话中的序号
+    size: Optional[int] = None   # 摘要模式下省略正文时的字符数
+    url: Optional[str] = None    # 省略正文时按需获取完整内容的地址
+    artifact: Optional[str] = None  # 大段正文的内容哈希，可通过 /api/artifacts/{artifact} 获取
 
 class ChatSummary(BaseModel):
     id: str
@@ -96,6 +259,11 @@ class ChatSummary(BaseModel):
 
 class ChatDetail(ChatSummary):
     messages: List[ChatMessage]
+    message_count: Optional[int] = None
+    message_offset: Optional[int] = None
+
+class AppendMessageResponse(ChatSummary):
+    message: ChatMessage
 
 class NewChatRequest(BaseModel):
     title: Optional[str] = None
@@ -114,17 +282,79 @@ class NewProjectRequest(BaseModel):
 class RenameProjectRequest(BaseModel):
     name: str
 
+class JobStatus(BaseModel):
+    id: str
+    kind: str                          # "generate" 或 "model"
+    status: str                        # queued / running / succeeded / failed / cancelled
+    progress: int = 0                  # 已接收的输出长度（字符）
+    error: Optional[str] = None
+    chat_id: Optional[str] = None
+    message_index: Optional[int] = None  # 提供 chat_id 时结果保存为该对话的第几条消息
+    artifact: Optional[str] = None     # 结果的内容哈希
+    result_url: Optional[str] = None
+    created_at: str
+    finished_at: Optional[str] = None
+
 class TTSRequest(BaseModel):
     text: str
     language: Optional[str] = "auto"  # "zh", "en", or "auto"
     speed: Optional[float] = 1.0
 
+class TTSPrefetchRequest(BaseModel):
+    texts: List[str]
+    language: Optional[str] = "auto"
+    speed: Optional[float] = 1.0
+
 class ModelGenerateRequest(BaseModel):
     prompt: str
+    chat_id: Optional[str] = None  # 流式接口：提供时生成完成后由服务端把 HTML 写入该对话
 
 def now_iso() -> str:
     return datetime.now(shanghai_tz).isoformat()
 
+def parse_int_param(request: Request, name: str, default: int) -> int:
+    value = request.query_params.get(name)
+    if value is None or value == "":
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid {name}")
+
+# -----------------------------------------------------------------------
+# 列表游标分页
+#   ?limit=20&after=<游标>；不带 limit 时返回全部（兼容旧前端）
+#   还有下一页时响应头 X-Next-Cursor 给出下一页的 after
+# -----------------------------------------------------------------------
+MAX_PAGE_SIZE = 200
+
+def encode_cursor(item: dict) -> str:
+    raw = json.dumps([item["updated_at"], item["id"]], ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        updated_at, item_id = json.loads(raw)
+        if not isinstance(updated_at, str) or not isinstance(item_id, str):
+            raise ValueError
+        return updated_at, item_id
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+async def fetch_page(request: Request, response: Response, list_page) -> list:
+    """list_page(limit, after) 为存储层的列表方法；多取一条判断是否还有下一页"""
+    after = request.query_params.get("after")
+    after = decode_cursor(after) if after else None
+    if request.query_params.get("limit") in (None, ""):
+        return await list_page(None, after)
+    limit = min(max(parse_int_param(request, "limit", MAX_PAGE_SIZE), 1), MAX_PAGE_SIZE)
+    items = await list_page(limit + 1, after)
+    if len(items) > limit:
+        items = items[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(items[-1])
+    return items
+
 def detect_language(text: str) -> str:
     """
     检测文本语言
@@ -143,148 +373,524 @@ def detect_language(text: str) -> str:
     
     return 'en'
 
-# 使用字典优化查找性能 O(1) 替代 O(n)
-PROJECTS_DICT: dict[str, Project] = {}
-CHAT_STORE: dict[str, dict] = {}
+# 对话与项目存储（见 storage.py），路由只通过 store 访问数据
+store = create_store(STORAGE_BACKEND, STORAGE_PATH)
+# 多 worker 共享状态，未配置时为 None（仅进程内缓存与合并）
+shared_state = create_shared_state(SHARED_STATE_BACKEND, SHARED_STATE_PATH, SHARED_STATE_URL)
+
+def new_single_flight() -> SingleFlight:
+    if shared_state is None:
+        return SingleFlight()
+    return DistributedSingleFlight(shared_state)
+
+# 生成结果缓存：相同 (mode, model, 规范化主题, 历史摘要) 直接回放
+generation_cache = ResponseCache(
+    "generate",
+    max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+    ttl=RESPONSE_CACHE_TTL,
+    disk_dir=os.path.join(RESPONSE_CACHE_DIR, "generate") if RESPONSE_CACHE_DIR else None,
+    shared=shared_state,
+)
+model_cache = ResponseCache(
+    "model",
+    max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+    ttl=RESPONSE_CACHE_TTL,
+    disk_dir=os.path.join(RESPONSE_CACHE_DIR, "model") if RESPONSE_CACHE_DIR else None,
+    shared=shared_state,
+)
 
-# 并发保护锁
-_projects_lock = asyncio.Lock()
-_chats_lock = asyncio.Lock()
+# 相同的进行中生成请求只驱动一个上游调用，其余请求订阅同一份输出
+generation_flights = new_single_flight()
+model_flights = new_single_flight()
+model_stream_flights = new_single_flight()
+
+# TTS 音频缓存：键为 (text, voice, language_type, speed)
+tts_cache = ResponseCache(
+    "tts",
+    max_entries=TTS_CACHE_MAX_ENTRIES,
+    ttl=TTS_CACHE_TTL,
+    disk_dir=TTS_CACHE_DIR or None,
+    binary=True,
+    max_bytes=TTS_CACHE_MAX_BYTES,
+    shared=shared_state,
+)
+tts_flights = new_single_flight()
+
+# 准入控制：文字对话优先于动画生成，并预留 LLM_TEXT_RESERVED 个并发；字幕朗读优先于批量预取
+llm_scheduler = Scheduler(
+    "llm",
+    max_concurrent=LLM_MAX_CONCURRENCY,
+    per_client=LLM_MAX_PER_CLIENT,
+    max_queue=LLM_QUEUE_SIZE,
+    lanes=["text", "animation"],
+    reserved={"text": LLM_TEXT_RESERVED},
+    queue_timeout=ADMISSION_QUEUE_TIMEOUT,
+)
+tts_scheduler = Scheduler(
+    "tts",
+    max_concurrent=TTS_MAX_CONCURRENCY,
+    per_client=TTS_MAX_PER_CLIENT,
+    max_queue=TTS_QUEUE_SIZE,
+    lanes=["tts", "prefetch"],
+    queue_timeout=ADMISSION_QUEUE_TIMEOUT,
+)
+
+# 流式生成的取消计数：客户端断开次数（未读完即关闭的上游流见 llm_pool.aborted）
+stream_stats = {"client_disconnects": 0}
+
+job_runner = JobRunner(
+    store,
+    concurrency=JOB_WORKERS,
+    poll_interval=JOB_POLL_INTERVAL,
+    stale_after=JOB_STALE_AFTER,
+    ttl=JOB_TTL,
+    tz=shanghai_tz,
+)
+
+resumable_streams = ResumableStreams(
+    ttl=SSE_RESUME_TTL,
+    max_bytes=SSE_RESUME_MAX_BYTES,
+    max_events=SSE_RESUME_MAX_EVENTS,
+    grace=SSE_RESUME_GRACE,
+    # 多 worker 时事件同时写入共享状态，续传请求落到任意 worker 都可以回放
+    state=shared_state,
+)
+
+# -----------------------------------------------------------------------
+# 指标与计时（GET /metrics，Prometheus 文本格式）
+# -----------------------------------------------------------------------
+metrics = Registry("chattutor_")
+GENERATION_LABELS = ("endpoint", "mode", "model", "provider")
+generation_ttfb = metrics.histogram(
+    "generation_ttfb_seconds", "从开始调用上游到首个 token 的时间（含重试与排队后的调用）", GENERATION_LABELS
+)
+generation_duration = metrics.histogram(
+    "generation_duration_seconds", "单次生成的总耗时", GENERATION_LABELS + ("status",)
+)
+generation_tokens_per_second = metrics.histogram(
+    "generation_tokens_per_second", "首个 token 之后的输出速度（上游 chunk 数/秒）", GENERATION_LABELS, RATE_BUCKETS
+)
+generation_output_chars = metrics.histogram(
+    "generation_output_chars", "单次生成输出的字符数", GENERATION_LABELS, SIZE_BUCKETS
+)
+stage_seconds = metrics.histogram(
+    "stage_seconds", "请求内各阶段耗时：history_build、prompt_build、html_extract", ("stage",), FAST_BUCKETS
+)
+tts_upstream_seconds = metrics.histogram("tts_upstream_seconds", "TTS 上游调用耗时", ("status",))
+tts_audio_bytes = metrics.histogram("tts_audio_bytes", "TTS 合成的音频大小", (), SIZE_BUCKETS)
+event_loop_lag = metrics.histogram(
+    "event_loop_lag_seconds", "事件循环延迟：定时唤醒比预期晚的时间", (), FAST_BUCKETS
+)
+
+def log_timing(event: str, **fields):
+    if TIMING_LOG:
+        print(json.dumps({"event": event, **fields}, ensure_ascii=False))
+
+class GenerationTiming:
+    """
+    单次上游生成的分阶段计时：token 到达时调用 token()，结束时 finish() 写入指标并输出一行计时日志
+    trace 由 llm_pool 填入实际使用的 provider / model
+    """
+
+    def __init__(self, endpoint: str, mode: str, streaming: bool = True):
+        self.endpoint = endpoint
+        self.mode = mode
+        self.streaming = streaming
+        self.trace: dict = {}
+        self.stages: dict = {}
+        self.started = time.perf_counter()
+        self.first_token_at: Optional[float] = None
+        self.chunks = 0
+        self.chars = 0
+        self.finished = False
+
+    def token(self, token: str):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        self.chunks += 1
+        self.chars += len(token)
+
+    def add_stage(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def finish(self, status: str):
+        if self.finished:
+            return
+        self.finished = True
+        now = time.perf_counter()
+        labels = {
+            "endpoint": self.endpoint,
+            "mode": self.mode,
+            "model": self.trace.get("model", MODEL),
+            "provider": self.trace.get("provider", "none"),
+        }
+        duration = now - self.started
+        generation_duration.observe(duration, status=status, **labels)
+        for stage, seconds in self.stages.items():
+            stage_seconds.observe(seconds, stage=stage)
+        ttfb = None
+        tokens_per_second = None
+        if self.first_token_at is not None:
+            if self.streaming:
+                ttfb = self.first_token_at - self.started
+                generation_ttfb.observe(ttfb, **labels)
+                if self.chunks > 1 and now > self.first_token_at:
+                    tokens_per_second = (self.chunks - 1) / (now - self.first_token_at)
+                    generation_tokens_per_second.observe(tokens_per_second, **labels)
+            if status == "ok":
+                generation_output_chars.observe(self.chars, **labels)
+        log_timing(
+            "generation",
+            status=status,
+            **labels,
+            attempts=self.trace.get("attempts"),
+            hedged=self.trace.get("hedged", False),
+            ttfb=round(ttfb, 4) if ttfb is not None else None,
+            duration=round(duration, 4),
+            chunks=self.chunks,
+            chars=self.chars,
+            tokens_per_second=round(tokens_per_second, 2) if tokens_per_second is not None else None,
+            stages={stage: round(seconds, 5) for stage, seconds in self.stages.items()},
+        )
+
+def collect_state_metrics():
+    """抓取时读取缓存、提供方、准入控制与进行中请求的统计"""
+    cache_lookups = Counter("chattutor_cache_lookups_total", "缓存查询次数", ("cache", "result"))
+    cache_hit_ratio = Gauge("chattutor_cache_hit_ratio", "缓存命中率（命中 / (命中 + 未命中)）", ("cache",))
+    cache_entries = Gauge("chattutor_cache_entries", "内存缓存条目数", ("cache",))
+    cache_bytes = Gauge("chattutor_cache_bytes", "内存缓存占用字节数", ("cache",))
+    for cache in (generation_cache, model_cache, tts_cache):
+        stats = cache.stats()
+        for result, key in (("hit", "hits"), ("miss", "misses"), ("bypass", "bypasses")):
+            cache_lookups.inc(stats[key], cache=stats["name"], result=result)
+        cache_hit_ratio.set(stats["hit_ratio"], cache=stats["name"])
+        cache_entries.set(stats["entries"], cache=stats["name"])
+        cache_bytes.set(stats["bytes"], cache=stats["name"])
+
+    provider_calls = Counter("chattutor_provider_calls_total", "上游提供方调用结果", ("provider", "kind", "model", "outcome"))
+    provider_open = Gauge("chattutor_provider_circuit_open", "提供方是否处于熔断中", ("provider",))
+    provider_ttft = Gauge("chattutor_provider_ttft_avg_seconds", "提供方首 token 延迟的滑动平均", ("provider",))
+    provider_prompt_tokens = Counter(
+        "chattutor_provider_prompt_tokens_total", "上游报告的输入 token 数（cached 为命中前缀缓存的部分）", ("provider", "type")
+    )
+    for provider in llm_pool.providers:
+        stats = provider.stats()
+        labels = {"provider": provider.name, "kind": provider.kind, "model": provider.model}
+        for outcome in ("requests", "successes", "failures", "slow", "aborted"):
+            provider_calls.inc(stats[outcome], outcome=outcome, **labels)
+        provider_open.set(1 if stats["state"] == "open" else 0, provider=provider.name)
+        if stats["ttft_avg"] is not None:
+            provider_ttft.set(stats["ttft_avg"], provider=provider.name)
+        provider_prompt_tokens.inc(stats["prompt_tokens"], provider=provider.name, type="total")
+        provider_prompt_tokens.inc(stats["cached_tokens"], provider=provider.name, type="cached")
+    pool_events = Counter("chattutor_provider_pool_events_total", "提供方池的重试与对冲次数", ("event",))
+    pool_stats = llm_pool.stats()
+    for event in ("retried", "hedged", "hedge_wins"):
+        pool_events.inc(pool_stats[event], event=event)
+
+    admission_active = Gauge("chattutor_admission_active", "占用中的上游并发名额", ("scheduler", "lane"))
+    admission_queued = Gauge("chattutor_admission_queued", "排队中的请求数", ("scheduler", "lane"))
+    admission_events = Counter("chattutor_admission_events_total", "准入控制结果", ("scheduler", "event"))
+    for scheduler in (llm_scheduler, tts_scheduler):
+        stats = scheduler.stats()
+        for lane in scheduler.lanes:
+            admission_active.set(stats["active_by_lane"][lane], scheduler=scheduler.name, lane=lane)
+            admission_queued.set(stats["queued"][lane], scheduler=scheduler.name, lane=lane)
+        for event in ("admitted", "queued_total", "rejected", "timed_out"):
+            admission_events.inc(stats[event], scheduler=scheduler.name, event=event)
+
+    in_flight = Gauge("chattutor_in_flight_streams", "进行中的（合并后）上游流", ("flight",))
+    coalesced = Counter("chattutor_coalesced_requests_total", "合并到进行中请求的次数", ("flight",))
+    for name, flights in (
+        ("generate", generation_flights),
+        ("model", model_flights),
+        ("model_stream", model_stream_flights),
+        ("tts", tts_flights),
+    ):
+        stats = flights.stats()
+        in_flight.set(stats["in_flight_streams"] + stats["in_flight_calls"], flight=name)
+        coalesced.inc(stats["coalesced"], flight=name)
+
+    stream_events = Counter("chattutor_stream_events_total", "SSE 客户端断开与上游提前关闭次数", ("event",))
+    stream_events.inc(stream_stats["client_disconnects"], event="client_disconnect")
+    stream_events.inc(llm_pool.aborted, event="upstream_aborted")
+    resume_stats = resumable_streams.stats()
+    for event in ("resumed", "evicted", "abandoned"):
+        stream_events.inc(resume_stats[event], event=event)
+    resumable = Gauge("chattutor_resumable_generations", "保留中的可续传生成", ("state",))
+    resumable.set(resume_stats["live"], state="live")
+    resumable.set(resume_stats["generations"] - resume_stats["live"], state="finished")
+    resumable_bytes = Gauge("chattutor_resumable_bytes", "可续传生成的缓冲区占用字节数")
+    resumable_bytes.set(resume_stats["bytes"])
+    job_stats = job_runner.stats()
+    jobs_total = Counter("chattutor_jobs_total", "本进程执行结束的后台任务", ("outcome",))
+    for outcome in ("completed", "failed", "cancelled"):
+        jobs_total.inc(job_stats[outcome], outcome=outcome)
+    jobs_running = Gauge("chattutor_jobs_running", "本进程执行中的后台任务")
+    jobs_running.set(job_stats["running"])
+    return [
+        cache_lookups, cache_hit_ratio, cache_entries, cache_bytes,
+        provider_calls, provider_open, provider_ttft, provider_prompt_tokens, pool_events,
+        admission_active, admission_queued, admission_events,
+        in_flight, coalesced, stream_events, resumable, resumable_bytes,
+        jobs_total, jobs_running,
+    ]
+
+metrics.add_collector(collect_state_metrics)
+
+event_loop_lag_task: Optional[asyncio.Task] = None
+
+async def monitor_event_loop_lag():
+    """定时休眠并记录实际唤醒的滞后，同步阻塞或 CPU 密集的处理会体现为延迟升高"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        event_loop_lag.observe(max(0.0, time.perf_counter() - started - EVENT_LOOP_LAG_INTERVAL))
+
+@app.on_event("startup")
+async def start_event_loop_lag_monitor():
+    global event_loop_lag_task
+    if EVENT_LOOP_LAG_INTERVAL > 0:
+        event_loop_lag_task = asyncio.create_task(monitor_event_loop_lag())
+
+@app.on_event("shutdown")
+async def stop_event_loop_lag_monitor():
+    if event_loop_lag_task is not None:
+        event_loop_lag_task.cancel()
+
+# TTS 共享连接池：应用生命周期内复用 DNS/TCP/TLS（可用时走 HTTP/2）
+tts_http_client: Optional[httpx.AsyncClient] = None
+
+def get_tts_http_client() -> httpx.AsyncClient:
+    global tts_http_client
+    if tts_http_client is None or tts_http_client.is_closed:
+        tts_http_client = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            timeout=30.0,
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=16, keepalive_expiry=120.0),
+        )
+    return tts_http_client
 
 @app.on_event("startup")
-async def reset_project_store():
-    async with _projects_lock:
-        PROJECTS_DICT.clear()
-    async with _chats_lock:
-        CHAT_STORE.clear()
+async def open_tts_http_client():
+    get_tts_http_client()
+
+@app.on_event("shutdown")
+async def close_tts_http_client():
+    if tts_http_client is not None:
+        await tts_http_client.aclose()
+
+def client_key(request: Request) -> str:
+    """准入控制按客户端 IP 计数（反向代理后需启用 uvicorn --proxy-headers）"""
+    return request.client.host if request.client else "unknown"
+
+def admission_http_error(error: AdmissionRejected) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail=str(error),
+        headers={"Retry-After": str(error.retry_after)},
+    )
+
+def check_admission(scheduler: Scheduler, flights: SingleFlight, key: str, client: str, lane: str, share: bool = True):
+    """
+    排队已满时快速返回 429；会合并进已有请求的不占用名额，直接放行
+    """
+    if share and flights.in_flight(key):
+        return
+    try:
+        scheduler.check(client, lane)
+    except AdmissionRejected as e:
+        raise admission_http_error(e)
+
+def admission_error_frame(error: AdmissionRejected) -> str:
+    return encode_event({
+        "error": str(error),
+        "type": "AdmissionRejected",
+        "message": str(error),
+        "retry_after": error.retry_after,
+    })
+
+def is_queue_frame(frame: str) -> bool:
+    return frame.startswith(('data: {"event":"queued"', 'data: {"event":"admitted"'))
+
+async def admitted_stream(
+    scheduler: Scheduler,
+    client: str,
+    lane: str,
+    source_factory,
+) -> AsyncGenerator[str, None]:
+    """
+    取得上游并发名额后再开始生成；排队期间推送 {"event": "queued", "position", "lane"}，
+    放行时推送 {"event": "admitted"}
+    """
+    try:
+        ticket = scheduler.enter(client, lane)
+    except AdmissionRejected as e:
+        yield admission_error_frame(e)
+        return
+    try:
+        queued = False
+        try:
+            async for position in scheduler.wait(ticket):
+                queued = True
+                yield encode_event({"event": "queued", "position": position, "lane": lane})
+        except AdmissionRejected as e:
+            yield admission_error_frame(e)
+            return
+        if queued:
+            yield encode_event({"event": "admitted"})
+        async for frame in source_factory():
+            yield frame
+    finally:
+        scheduler.release(ticket)
+
+def cache_bypassed(request: Request) -> bool:
+    """
+    请求头 X-Cache-Bypass: 1 或 Cache-Control: no-cache 时跳过缓存读取（结果仍会写回缓存）
+    """
+    if request.headers.get("x-cache-bypass", "").strip().lower() in ("1", "true", "yes"):
+        return True
+    return "no-cache" in request.headers.get("cache-control", "").lower()
+
+@app.on_event("startup")
+async def open_store():
+    await store.init()
+    if shared_state is not None:
+        await shared_state.init()
+    job_runner.start()
+
+@app.on_event("shutdown")
+async def close_store():
+    await job_runner.stop()
+    await store.close()
+    if shared_state is not None:
+        await shared_state.close()
 
 # -----------------------------------------------------------------------
 # 2. 核心：流式生成器 (现在会使用 history)
 # -----------------------------------------------------------------------
-async def llm_event_stream(
+def llm_event_stream(
     topic: str,
     history: Optional[List[dict]] = None,
-    model: str = None, # Will use MODEL from config if not specified
+    model: str = None, # 未指定时使用各提供方配置的模型
     mode: str = "animation",  # "animation" 或 "text"
+    html_events: bool = False,
 ) -> AsyncGenerator[str, None]:
+    # 构建提示词后直接返回 SSE 帧生成器，不再逐帧转发
+    timing = GenerationTiming("generate", mode)
+    prompt_started = time.perf_counter()
     history = history or []
+    # 流式提取 HTML：边生成边输出结构化事件，客户端可提前渲染页面骨架
+    extractor = HtmlStreamExtractor() if html_events and mode != "text" else None
     
-    # Use configured model if not specified
-    if model is None:
-        model = MODEL
-    
-    # 根据模式选择不同的系统提示词
-    if mode == "text":
-        # 文字对话模式
-        system_prompt = """你是一个友好的AI助手，擅长用清晰、易懂的方式回答问题。
-请用中文回答用户的问题，回答要准确、详细、有条理。
-如果问题涉及复杂概念，请用通俗易懂的语言解释，可以适当举例说明。
-回答要自然流畅，就像在和朋友聊天一样。"""
-    else:
-        # 动画生成模式（默认）
-        # 字幕语言要求：强制使用中文
-        subtitle_requirement = """**字幕语言要求（严格）：字幕必须100%使用中文，绝对不允许出现任何英文单词、英文句子或混合语言。所有字幕内容必须完全用中文表达，包括专业术语也要用中文。无论用户输入什么语言，生成的字幕必须全部是中文，这是强制要求。**"""
-        subtitle_lang_note = "（必须全部中文，禁止英文）"
-        
-        # The system prompt is now more focused
-        system_prompt = f"""请你生成一个非常精美的动态动画,讲讲 {topic}
-要动态的,要像一个完整的,正在播放的视频。包含一个完整的过程，能把知识点讲清楚。
-页面极为精美，好看，有设计感，同时能够很好的传达知识。知识和图像要准确
-附带一些旁白式的文字解说,从头到尾讲清楚一个小的知识点
-不需要任何互动按钮,直接开始播放
-使用和谐好看，广泛采用的浅色配色方案，使用很多的，丰富的视觉元素。
-{subtitle_requirement}
-**布局要求：使用全屏或接近全屏的布局，主容器应该占据至少80%的视口宽度和70%以上的视口高度，减少不必要的边距和空白，让内容充满整个显示区域，提供沉浸式的视觉体验。主内容区域应该是一个大的、居中的白色或浅色卡片，占据屏幕的大部分空间。**
-**字幕要求：字幕必须放置在动画内容的下方，使用固定定位或绝对定位在容器底部，确保字幕清晰可见且不会遮挡任何动画元素。字幕区域应该有足够的背景色或半透明背景，确保文字可读性。字幕与动画内容之间要有明确的视觉分隔。字幕内容{subtitle_lang_note}**
-**字幕元素标识要求：所有字幕文本必须包含在具有 class="subtitle-text" 或 id="subtitle" 的元素中，每个字幕段落应该是一个独立的元素，便于程序识别和朗读。如果有多段字幕，每个字幕元素都应该有 class="subtitle-text"。**
-**请保证任何一个元素都在一个2k分辨率的容器中被摆在了正确的位置，避免穿模，字幕遮挡，图形位置错误等等问题影响正确的视觉传达**
-html+css+js+svg，放进一个html里"""
-    
-    # 如果是文字模式，不需要代码块格式
-    if mode == "text":
-        # 文字模式：直接返回文字回复，不需要代码块
-        pass
+    # 系统提示词在启动时构建，主题只出现在用户消息中（固定前缀可被上游缓存）
+    prompt = prompt_for_mode(mode)
+    user_prompt = prompt.user_prompt(topic=topic)
+    timing.add_stage("prompt_build", time.perf_counter() - prompt_started)
+    tokens = llm_token_stream(
+        prompt.system,
+        user_prompt,
+        history,
+        model=model,
+        temperature=0.8,
+        trace=timing.trace,
+        cache_key=prompt.cache_key,
+    )
+    error_message = "生成内容时发生错误，请稍后重试" if mode == "text" else "生成动画时发生错误，请稍后重试"
+    return sse_token_events(tokens, extractor, error_message, timing)
 
-    if USE_GEMINI:
-        try:
-            full_prompt = system_prompt + "\n\n" + topic
-            if history:
-                history_text = "\n".join([f"{msg['role']}: {msg['content']}" for msg in history])
-                full_prompt = history_text + "\n\n" + full_prompt
-            
-            response = await asyncio.get_event_loop().run_in_executor(
-                None, 
-                lambda: gemini_client.models.generate_content(
-                    model=model, 
-                    contents=full_prompt
-                )
-            )
-            
-            text = response.text
-            # 根据模式调整chunk_size和延迟
-            if mode == "text":
-                chunk_size = 200  # 文字模式：更大的块，更快
-                sleep_time = 0.01  # 更短的延迟
-            else:
-                chunk_size = 50   # 动画模式：保持原有设置
-                sleep_time = 0.05
-            
-            for i in range(0, len(text), chunk_size):
-                chunk = text[i:i+chunk_size]
-                payload = json.dumps({"token": chunk}, ensure_ascii=False)
-                yield f"data: {payload}\n\n"
-                await asyncio.sleep(sleep_time)
-                
-        except Exception as e:
-            error_msg = {
-                "error": str(e),
-                "type": type(e).__name__,
-                "message": "生成内容时发生错误，请稍后重试" if mode == "text" else "生成动画时发生错误，请稍后重试"
-            }
-            yield f"data: {json.dumps(error_msg, ensure_ascii=False)}\n\n"
-            return
-    else:
-        if mode == "text":
-            # 文字模式：使用对话格式，不要求代码块
-            messages = [
-                {"role": "system", "content": system_prompt},
-                *history,
-                {"role": "user", "content": topic},
-            ]
-        else:
-            # 动画模式：原有逻辑
-            messages = [
-                {"role": "system", "content": system_prompt},
-                *history,
-                {"role": "user", "content": topic},
-            ]
+def llm_token_stream(
+    system_prompt: str,
+    user_prompt: str,
+    history: Optional[List[dict]] = None,
+    model: str = None,
+    temperature: float = 0.8,
+    gemini_contents: Optional[str] = None,
+    trace: Optional[dict] = None,
+    cache_key: Optional[str] = None,
+) -> AsyncGenerator[str, None]:
+    """
+    调用上游模型的流式接口，逐个产出文本 token
+    经 llm_pool 调用：首个 token 之前的失败自动重试 / 切换提供方，之后出错直接抛出异常
+    Gemini 使用拼接后的单段文本（gemini_contents 可覆盖），OpenAI 兼容接口使用对话消息；
+    model 为空时各提供方使用自己配置的模型；cache_key 标识 system_prompt，用于上游的前缀缓存
+    """
+    return llm_pool.stream(system_prompt, user_prompt, history, model, temperature, gemini_contents, trace, cache_key)
 
+async def sse_token_events(
+    tokens: AsyncGenerator[str, None],
+    extractor: Optional[HtmlStreamExtractor] = None,
+    error_message: str = "生成内容时发生错误，请稍后重试",
+    timing: Optional[GenerationTiming] = None,
+) -> AsyncGenerator[str, None]:
+    """
+    把 token 流转换为 SSE 帧：{"token"} 或 HTML 提取事件，出错时输出错误帧，正常结束时输出 [DONE]
+    SSE_BATCH_INTERVAL 内相继到达的 token 合并为一帧（首个 token 立即输出）
+    timing 不为空时记录首 token、输出速度与 HTML 提取耗时，结束（含取消）时写入指标
+    """
+    on_token = timing.token if timing is not None else None
+    if SSE_BATCH_INTERVAL > 0:
+        # 微批时由 coalesce_tokens 按上游原始 chunk 计时
+        tokens = coalesce_tokens(tokens, SSE_BATCH_INTERVAL, SSE_BATCH_MAX_CHARS, on_token)
+        on_token = None
+    preamble: List[str] = []
+    status = "cancelled"
+    try:
         try:
-            response = await client.chat.completions.create(
-                model=model,
-                messages=messages,
-                stream=True,
-                temperature=0.8, 
-            )
+            async for token in tokens:
+                if on_token is not None:
+                    on_token(token)
+                if extractor is None:
+                    yield token_frame(token)
+                    continue
+                if not extractor.started:
+                    preamble.append(token)
+                extract_started = time.perf_counter()
+                events = extractor.feed(token)
+                if timing is not None:
+                    timing.add_stage("html_extract", time.perf_counter() - extract_started)
+                for name, data in events:
+                    yield encode_event({"event": name, **data})
         except OpenAIError as e:
-            error_msg = {
+            status = "error"
+            yield encode_event({
                 "error": str(e),
                 "type": "OpenAIError",
                 "message": "LLM服务调用失败，请检查API配置"
-            }
-            yield f"data: {json.dumps(error_msg, ensure_ascii=False)}\n\n"
+            })
+            return
+        except Exception as e:
+            status = "error"
+            yield encode_event({
+                "error": str(e),
+                "type": type(e).__name__,
+                "message": error_message
+            })
             return
 
-        async for chunk in response:
-            token = chunk.choices[0].delta.content or ""
-            if token:
-                payload = json.dumps({"token": token}, ensure_ascii=False)
-                yield f"data: {payload}\n\n"
-                # 文字模式不需要延迟，直接流式输出；动画模式保持小延迟
-                if mode != "text":
-                    await asyncio.sleep(0.001)
-
-    yield 'data: {"event":"[DONE]"}\n\n'
+        if extractor is not None:
+            for name, data in extractor.finish():
+                yield encode_event({"event": name, **data})
+            if not extractor.started and preamble:
+                # 没有生成 HTML（例如模型直接回复了文字），按原样输出
+                yield token_frame("".join(preamble))
+        status = "ok"
+        yield DONE_FRAME
+    finally:
+        if timing is not None:
+            timing.finish(status)
+
+async def replay_cached_stream(body: str, chunk_size: int = 64 * 1024) -> AsyncGenerator[str, None]:
+    """
+    以网络速度回放缓存的 SSE 响应体（已包含结尾的 [DONE] 事件）
+    每段约 chunk_size 个字符，只在事件边界处切分（下游按整帧处理：保存、续传编号）
+    """
+    start = 0
+    while start < len(body):
+        end = body.find("\n\n", start + chunk_size - 2)
+        end = len(body) if end < 0 else end + 2
+        yield body[start:end]
+        start = end
 
 def extract_html_from_text(text: str) -> str:
     if not text:
@@ -295,149 +901,658 @@ def extract_html_from_text(text: str) -> str:
     return text.strip()
 
 async def generate_model_html(prompt: str, model: str = None) -> str:
-    if model is None:
-        model = MODEL
-    system_prompt = """你是一个教育建模助手。请根据用户输入的知识点或模型名称，生成一个可交互式的数学/教育模型页面。
-要求：
-1) 只输出一个完整的 HTML（包含 CSS + JS），不要输出 markdown 或代码块。
-2) 页面布局：左侧说明卡片（模型名称、定义、公式/参数说明），右侧为可交互的模型展示区域。
-3) 交互：至少包含 2 个可调参数（滑块/输入框），参数变化实时影响图形/模型。
-4) 语言：全部中文。
-5) 只使用原生 HTML/CSS/JS，不使用外部库或远程资源。
-6) 画面清爽，背景浅色，文字清晰，元素不拥挤。
-7) 模型需与主题匹配（例如圆锥曲线、三角函数、立体几何等）。"""
-
-    if USE_GEMINI:
-        response = await asyncio.get_event_loop().run_in_executor(
-            None,
-            lambda: gemini_client.models.generate_content(
-                model=model,
-                contents=f"{system_prompt}\n\n用户需求：{prompt}"
-            )
+    timing = GenerationTiming("model", "model", streaming=False)
+    status = "error"
+    try:
+        text = await llm_pool.complete(
+            MODEL_PROMPT.system,
+            MODEL_PROMPT.user_prompt(topic=prompt),
+            model=model,
+            temperature=0.6,
+            trace=timing.trace,
+            cache_key=MODEL_PROMPT.cache_key,
         )
-        return extract_html_from_text(response.text)
+        timing.token(text)
+        extract_started = time.perf_counter()
+        html = extract_html_from_text(text)
+        timing.add_stage("html_extract", time.perf_counter() - extract_started)
+        status = "ok"
+        return html
+    except asyncio.CancelledError:
+        status = "cancelled"
+        raise
+    finally:
+        timing.finish(status)
 
-    response = await client.chat.completions.create(
+def model_event_stream(prompt: str, model: str = None) -> AsyncGenerator[str, None]:
+    """
+    /api/model/generate 的流式版本：输出 html_start / html_chunk / html_body / html_done 事件
+    """
+    timing = GenerationTiming("model_stream", "model")
+    tokens = llm_token_stream(
+        MODEL_PROMPT.system,
+        MODEL_PROMPT.user_prompt(topic=prompt),
         model=model,
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": prompt},
-        ],
         temperature=0.6,
+        trace=timing.trace,
+        cache_key=MODEL_PROMPT.cache_key,
     )
-    return extract_html_from_text(response.choices[0].message.content or "")
+    return sse_token_events(tokens, HtmlStreamExtractor(), "生成模型时发生错误，请稍后重试", timing)
+
+def collect_stream_parts(frames: List[str]) -> Tuple[List[str], List[str]]:
+    """从完整的 SSE 帧中取出 (html_chunk 片段, token 片段)"""
+    html_parts: List[str] = []
+    text_parts: List[str] = []
+    for frame in frames:
+        if not frame.startswith("data: {"):
+            continue
+        data = json.loads(frame[6:])
+        if data.get("event") == "html_chunk":
+            html_parts.append(data["html"])
+        elif "token" in data:
+            text_parts.append(data["token"])
+    return html_parts, text_parts
+
+def collect_stream_html(frames: List[str]) -> str:
+    """从完整的 SSE 帧中还原提取出的 HTML（未检测到 HTML 时退回整段文本）"""
+    html_parts, text_parts = collect_stream_parts(frames)
+    if html_parts:
+        return "".join(html_parts).strip()
+    return extract_html_from_text("".join(text_parts))
+
+def collect_stream_message(frames: List[str], mode: str) -> str:
+    """还原要保存的助手消息：文字模式为完整回复，动画模式为提取出的 HTML（与前端原先保存的内容一致）"""
+    if mode != "text":
+        return collect_stream_html(frames)
+    return "".join(collect_stream_parts(frames)[1]).strip()
+
+def assistant_message(content: str, html: bool) -> dict:
+    """要保存的助手消息；HTML 压缩后保存，压缩前的原文放在 "original" 中另存"""
+    message = {"role": "assistant", "content": content}
+    if html and HTML_MINIFY:
+        minified = minify_html(content)
+        if minified != content:
+            message["content"] = minified
+            message["original"] = content
+    return message
+
+async def save_generated_message(chat_id: str, frames: List[str], mode: str) -> Optional[dict]:
+    """把生成结果作为助手消息追加到对话，返回 {"message_index", "artifact"}；内容为空或对话已删除时返回 None"""
+    return await save_assistant_message(chat_id, assistant_message(collect_stream_message(frames, mode), mode != "text"))
+
+async def save_assistant_message(chat_id: str, message: dict) -> Optional[dict]:
+    if not message["content"]:
+        return None
+    try:
+        summary = await store.append_message(chat_id, message, now_iso())
+    except Exception as e:
+        print(f"--- 保存生成结果失败 ({chat_id}): {e} ---")
+        return None
+    if not summary:
+        return None
+    return {"message_index": summary["message_index"], "artifact": summary["artifact"]}
 
-# -----------------------------------------------------------------------
-# 3. 路由 (CHANGED: Now a POST request)
-# -----------------------------------------------------------------------
-@app.post("/generate")
-async def generate(
-    chat_request: ChatRequest, # CHANGED: Use the Pydantic model
-    request: Request,
-):
+def persist_stream(frames: AsyncGenerator[str, None], chat_id: str, mode: str) -> AsyncGenerator[str, None]:
     """
-    Main endpoint: POST /generate
-    Accepts a JSON body with "topic" and optional "history".
-    Returns an SSE stream.
+    流正常结束（以 [DONE] 结尾）时由服务端保存助手消息，并在 [DONE] 之前输出
+    {"event": "saved", "message_index", "artifact"}，前端收到后不再回传整段内容
+    出错或客户端中途断开时不保存；按请求保存，合并到同一上游流的不同对话各自写入
     """
-    accumulated_response = ""  # for caching flow results
+    async def event_generator():
+        received: List[str] = []
+        # 只按完整的事件转发：上游的分段可能把 [DONE] 切在两段之间，不完整的结尾留到下一段
+        pending = ""
+        async for chunk in frames:
+            text = pending + chunk if pending else chunk
+            cut = text.rfind("\n\n")
+            cut = cut + 2 if cut >= 0 else 0
+            text, pending = text[:cut], text[cut:]
+            if not text:
+                continue
+            if not text.endswith(DONE_FRAME):
+                received.append(text)
+                yield text
+                continue
+            body = text[:-len(DONE_FRAME)]
+            if body:
+                received.append(body)
+                yield body
+            # 上游已完整结束：保存不随取消中断（避免写事务执行到一半）
+            saved = await asyncio.shield(save_generated_message(chat_id, "".join(received).split("\n\n"), mode))
+            if saved is not None:
+                yield encode_event({"event": "saved", **saved})
+            yield DONE_FRAME
+        if pending:
+            yield pending
+
+    return event_generator()
+
+def html_event_frames(html: str) -> List[str]:
+    """把缓存的完整 HTML 包装为与实时生成相同的事件序列"""
+    events = [
+        {"event": "html_start", "source": "cache"},
+        {"event": "html_chunk", "html": html},
+        {"event": "html_done", "length": len(html), "complete": True},
+    ]
+    frames = [encode_event(event) for event in events]
+    frames.append(DONE_FRAME)
+    return frames
+
+def relay_stream(shared_stream, request: Request) -> AsyncGenerator[str, None]:
+    """
+    把共享的生成流转发给单个客户端：客户端断开后停止转发，并释放订阅
+    断开检测与转发并发进行，上游迟迟没有新 token 时也能立即退订
+    """
+    async def watch_disconnect():
+        while not await request.is_disconnected():
+            await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+        await shared_stream.aclose()
 
     async def event_generator():
-        nonlocal accumulated_response
+        watcher = asyncio.create_task(watch_disconnect())
+        finished = False
         try:
-            async for chunk in llm_event_stream(
-                chat_request.topic, 
-                chat_request.history,
-                mode=chat_request.mode or "animation"
-            ):
-                accumulated_response += chunk
-                if await request.is_disconnected():
-                    break
+            async for chunk in shared_stream:
                 yield chunk
+            finished = not watcher.done()
         except Exception as e:
-            error_msg = {
+            yield encode_event({
                 "error": str(e),
                 "type": type(e).__name__,
                 "message": "处理请求时发生错误"
-            }
-            yield f"data: {json.dumps(error_msg, ensure_ascii=False)}\n\n"
+            })
+            finished = True
+        finally:
+            watcher.cancel()
+            if not finished:
+                stream_stats["client_disconnects"] += 1
+            # 显式关闭订阅，只有全部订阅者都断开时才会取消共享的上游流
+            await shared_stream.aclose()
+
+    return event_generator()
+
+def sse_response(frames: AsyncGenerator[str, None], request: Request, headers: dict) -> StreamingResponse:
+    """
+    SSE 响应：开启 SSE_COMPRESSION 且客户端接受时按 br / gzip 压缩，每段输出单独刷新
+    """
+    encoding = negotiate_encoding(request.headers.get("accept-encoding", "")) if SSE_COMPRESSION else None
+    if encoding is not None:
+        frames = compress_frames(frames, encoding, SSE_COMPRESSION_LEVEL)
+        headers = {**headers, "Content-Encoding": encoding, "Vary": "Accept-Encoding"}
+    return StreamingResponse(frames, headers=headers)
+
+async def generation_history(chat_request: ChatRequest) -> List[dict]:
+    """按 chat_id（或旧的 history 字段）构建送入模型的历史，对话不存在时返回 404"""
+    if chat_request.chat_id:
+        chat = await store.get_chat(chat_request.chat_id, offset=-HISTORY_MAX_MESSAGES)
+        if not chat:
+            raise HTTPException(status_code=404, detail="Chat not found")
+        source_history = chat["messages"]
+    else:
+        source_history = chat_request.history
+    # 旧的 HTML 动画替换为描述，超出预算的早期对话合并为摘要
+    history_started = time.perf_counter()
+    history = build_history(source_history, chat_request.topic, HISTORY_TOKEN_BUDGET)
+    stage_seconds.observe(time.perf_counter() - history_started, stage="history_build")
+    return history
+
+def generation_cache_key(chat_request: ChatRequest, history: List[dict]) -> str:
+    return make_cache_key(
+        "generate",
+        chat_request.mode or "animation",
+        chat_request.html_events,
+        MODEL,
+        normalize_text(chat_request.topic),
+        history_digest(history),
+    )
+
+def generation_stream(chat_request: ChatRequest, history: List[dict], cache_key: str, client: str, share: bool = True):
+    """
+    取得（或合并到）cache_key 对应的上游生成流的订阅；完整结束的流写入缓存
+    """
+    mode = chat_request.mode or "animation"
+    lane = "text" if mode == "text" else "animation"
+
+    async def store_response(accumulated_response: List[str]):
+        # 仅缓存完整结束的流（出错或被取消的不缓存），排队事件不进入缓存
+        if accumulated_response and accumulated_response[-1] == DONE_FRAME:
+            await generation_cache.set(
+                cache_key,
+                "".join(frame for frame in accumulated_response if not is_queue_frame(frame)),
+            )
 
+    return generation_flights.stream(
+        cache_key,
+        lambda: admitted_stream(
+            llm_scheduler,
+            client,
+            lane,
+            lambda: llm_event_stream(chat_request.topic, history, mode=mode, html_events=chat_request.html_events),
+        ),
+        on_complete=store_response,
+        share=share,
+    )
 
-    async def wrapped_stream():
-        async for chunk in event_generator():
-            yield chunk
+def generation_response(
+    frames: AsyncGenerator[str, None],
+    request: Request,
+    headers: dict,
+    mode: str,
+    chat_id: Optional[str] = None,
+    resumable: bool = False,
+    live: bool = True,
+) -> StreamingResponse:
+    """
+    生成类 SSE 响应的公共出口
+    - live：frames 为共享上游流的订阅，经 relay_stream 转发（客户端断开即退订）；否则为缓存回放
+    - chat_id：流结束时由服务端保存助手消息（persist_stream）
+    - resumable：交给 resumable_streams 在后台驱动，事件带 id，客户端断开后生成继续，可凭 Last-Event-ID 续传
+    """
+    resumable = resumable and SSE_RESUME_TTL > 0
+    source = frames
+    if live and not resumable:
+        frames = relay_stream(frames, request)
+    if chat_id:
+        frames = persist_stream(frames, chat_id, mode)
+    if resumable:
+        generation = resumable_streams.start(frames, on_close=source.aclose if source is not frames else None)
+        headers = {**headers, "X-Generation-Id": generation.id}
+        frames = relay_stream(resumable_streams.follow(generation), request)
+    return sse_response(frames, request, headers)
 
+# -----------------------------------------------------------------------
+# 3. 路由 (CHANGED: Now a POST request)
+# -----------------------------------------------------------------------
+@app.post("/generate")
+async def generate(
+    chat_request: ChatRequest, # CHANGED: Use the Pydantic model
+    request: Request,
+):
+    """
+    Main endpoint: POST /generate
+    Accepts a JSON body with "topic" and optional "chat_id" (or legacy "history").
+    Returns an SSE stream.
+    """
+    mode = chat_request.mode or "animation"
+    history = await generation_history(chat_request)
     headers = {
         "Cache-Control": "no-store",
         "Content-Type": "text/event-stream; charset=utf-8",
         "X-Accel-Buffering": "no",
     }
-    return StreamingResponse(wrapped_stream(), headers=headers)
+    cache_key = generation_cache_key(chat_request, history)
+    if cache_bypassed(request):
+        generation_cache.record_bypass()
+        headers["X-Cache"] = "BYPASS"
+    else:
+        cached = await generation_cache.get(cache_key)
+        if cached is not None:
+            headers["X-Cache"] = "HIT"
+            return generation_response(
+                replay_cached_stream(cached),
+                request,
+                headers,
+                mode,
+                chat_id=chat_request.chat_id,
+                resumable=chat_request.resumable,
+                live=False,
+            )
+        headers["X-Cache"] = "MISS"
+
+    share = headers["X-Cache"] != "BYPASS"
+    client = client_key(request)
+    lane = "text" if mode == "text" else "animation"
+    check_admission(llm_scheduler, generation_flights, cache_key, client, lane, share)
+    # 相同请求合并到同一个上游流；带 bypass 的请求单独生成，便于对比测量
+    shared_stream = generation_stream(chat_request, history, cache_key, client, share)
+    return generation_response(
+        shared_stream, request, headers, mode, chat_id=chat_request.chat_id, resumable=chat_request.resumable
+    )
 
-@app.post("/api/model/generate")
-async def generate_model(payload: ModelGenerateRequest):
+@app.get("/api/generations/{generation_id}/events")
+async def resume_generation(generation_id: str, request: Request):
+    """
+    续传 resumable 生成流：回放 Last-Event-ID（或 ?last_event_id=）之后的事件，生成未结束时继续跟随实时输出
+    """
+    last_event_id = request.headers.get("last-event-id") or request.query_params.get("last_event_id")
+    last_generation_id, seq = parse_last_event_id(last_event_id)
+    if last_generation_id and last_generation_id != generation_id:
+        raise HTTPException(status_code=404, detail="Generation not found or expired")
+    generation = resumable_streams.get(generation_id)
+    if generation is not None:
+        if generation.events_after(seq) is None:
+            raise HTTPException(status_code=410, detail="Resume window expired")
+        follower = resumable_streams.follow(generation, seq)
+    else:
+        # 生成在其他 worker 上：从共享状态回放
+        follower = await resumable_streams.follow_remote(generation_id, seq)
+        if follower is None:
+            raise HTTPException(status_code=404, detail="Generation not found or expired")
+    headers = {
+        "Cache-Control": "no-store",
+        "Content-Type": "text/event-stream; charset=utf-8",
+        "X-Accel-Buffering": "no",
+        "X-Generation-Id": generation_id,
+    }
+    return sse_response(relay_stream(follower, request), request, headers)
+
+@app.delete("/api/generations/{generation_id}")
+async def cancel_generation(generation_id: str):
+    """
+    主动放弃 resumable 生成（新的生成取代旧的、删除对话等）：立即取消上游，结果不保存到对话
+    断线续传的宽限期只用于网络中断，客户端有意中止时应调用此接口
+    """
+    generation = resumable_streams.get(generation_id)
+    if generation is not None:
+        return {"status": "ok", "cancelled": resumable_streams.cancel(generation)}
+    # 生成在其他 worker 上：写入取消标记，由其所在的 worker 取消
+    cancelled = await resumable_streams.cancel_remote(generation_id)
+    if cancelled is None:
+        raise HTTPException(status_code=404, detail="Generation not found or expired")
+    return {"status": "ok", "cancelled": cancelled}
+
+def model_prompt(payload: ModelGenerateRequest) -> str:
     prompt = payload.prompt.strip()
     if not prompt:
         raise HTTPException(status_code=400, detail="Prompt is required")
     if len(prompt) > 1000:
         raise HTTPException(status_code=400, detail="Prompt too long (max 1000 characters)")
+    return prompt
 
-    try:
+async def generate_and_cache_model(prompt: str, cache_key: str, client: str) -> str:
+    async with llm_scheduler.slot(client, "animation"):
         html = await generate_model_html(prompt)
+    if html:
+        await model_cache.set(cache_key, html)
+    return html
+
+@app.post("/api/model/generate")
+async def generate_model(payload: ModelGenerateRequest, request: Request, response: Response):
+    prompt = model_prompt(payload)
+
+    cache_key = make_cache_key("model", MODEL, normalize_text(prompt))
+    bypass = cache_bypassed(request)
+    if bypass:
+        model_cache.record_bypass()
+        response.headers["X-Cache"] = "BYPASS"
+    else:
+        cached = await model_cache.get(cache_key)
+        if cached is not None:
+            response.headers["X-Cache"] = "HIT"
+            return {"html": cached}
+        response.headers["X-Cache"] = "MISS"
+
+    client = client_key(request)
+    check_admission(llm_scheduler, model_flights, cache_key, client, "animation", not bypass)
+
+    try:
+        if bypass:
+            html = await generate_and_cache_model(prompt, cache_key, client)
+        else:
+            html = await model_flights.do(cache_key, lambda: generate_and_cache_model(prompt, cache_key, client))
+    except AdmissionRejected as e:
+        raise admission_http_error(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Model generation failed: {str(e)}")
     if not html:
         raise HTTPException(status_code=500, detail="Empty model response")
     return {"html": html}
 
+@app.post("/api/model/generate/stream")
+async def generate_model_stream(payload: ModelGenerateRequest, request: Request):
+    """
+    /api/model/generate 的 SSE 版本：首个 token 到达即开始输出，客户端断开时取消上游调用
+    结果与非流式接口共用缓存
+    """
+    prompt = model_prompt(payload)
+    if payload.chat_id and not await store.chat_exists(payload.chat_id):
+        raise HTTPException(status_code=404, detail="Chat not found")
+
+    headers = {
+        "Cache-Control": "no-store",
+        "Content-Type": "text/event-stream; charset=utf-8",
+        "X-Accel-Buffering": "no",
+    }
+    cache_key = make_cache_key("model", MODEL, normalize_text(prompt))
+    if cache_bypassed(request):
+        model_cache.record_bypass()
+        headers["X-Cache"] = "BYPASS"
+    else:
+        cached = await model_cache.get(cache_key)
+        if cached is not None:
+            headers["X-Cache"] = "HIT"
+            frames = replay_cached_stream("".join(html_event_frames(cached)))
+            return generation_response(frames, request, headers, "model", chat_id=payload.chat_id, live=False)
+        headers["X-Cache"] = "MISS"
+
+    async def store_html(frames: List[str]):
+        if frames and frames[-1] == DONE_FRAME:
+            html = collect_stream_html(frames)
+            if html:
+                await model_cache.set(cache_key, html)
+
+    # 与非流式接口的请求合并分开（两者的合并结果形态不同）
+    flight_key = make_cache_key("model-stream", MODEL, normalize_text(prompt))
+    share = headers["X-Cache"] != "BYPASS"
+    client = client_key(request)
+    check_admission(llm_scheduler, model_stream_flights, flight_key, client, "animation", share)
+    shared_stream = model_stream_flights.stream(
+        flight_key,
+        lambda: admitted_stream(llm_scheduler, client, "animation", lambda: model_event_stream(prompt)),
+        on_complete=store_html,
+        share=share,
+    )
+    return generation_response(shared_stream, request, headers, "model", chat_id=payload.chat_id)
+
+# -----------------------------------------------------------------------
+# 后台任务：提交后立即返回任务 ID，由 job_runner 的 worker 执行，结果写入产物存储
+# -----------------------------------------------------------------------
+def stream_error_message(frames: List[str]) -> str:
+    """未以 [DONE] 结束的生成流：取最后一个错误事件的说明"""
+    for frame in reversed(frames):
+        if frame.startswith("data: ") and '"error"' in frame:
+            try:
+                data = json.loads(frame[6:])
+            except ValueError:
+                continue
+            return data.get("message") or data.get("error") or "生成失败"
+    return "生成未完成"
+
+async def run_generate_job(job: dict, progress) -> dict:
+    payload = job["payload"]
+    chat_request = ChatRequest(**payload["request"])
+    mode = chat_request.mode or "animation"
+    history = await generation_history(chat_request)
+    cache_key = generation_cache_key(chat_request, history)
+    body = await generation_cache.get(cache_key)
+    if body is None:
+        chunks, received = [], 0
+        # 与同一请求的前台生成合并为同一个上游流
+        shared_stream = generation_stream(chat_request, history, cache_key, payload["client"])
+        try:
+            async for chunk in shared_stream:
+                chunks.append(chunk)
+                received += len(chunk)
+                progress(received)
+        finally:
+            await shared_stream.aclose()
+        body = "".join(chunks)
+    frames = [frame + "\n\n" for frame in split_frames(body)]
+    if not frames or frames[-1] != DONE_FRAME:
+        raise RuntimeError(stream_error_message(frames))
+    content = collect_stream_message(frames, mode)
+    return await job_result(job, assistant_message(content, mode != "text"))
+
+async def run_model_job(job: dict, progress) -> dict:
+    prompt = job["payload"]["prompt"]
+    cache_key = make_cache_key("model", MODEL, normalize_text(prompt))
+    html = await model_cache.get(cache_key)
+    if html is None:
+        client = job["payload"]["client"]
+        html = await model_flights.do(cache_key, lambda: generate_and_cache_model(prompt, cache_key, client))
+    if not html:
+        raise RuntimeError("Empty model response")
+    progress(len(html))
+    return await job_result(job, assistant_message(html, True))
+
+async def job_result(job: dict, message: dict) -> dict:
+    """提供了 chat_id 的任务把结果保存为对话中的助手消息；结果产物与消息内容相同（压缩后的 HTML）"""
+    if not message["content"]:
+        raise RuntimeError("生成结果为空")
+    saved = await save_assistant_message(job["chat_id"], message) if job.get("chat_id") else None
+    return {
+        "content": message["content"],
+        "original": message.get("original"),
+        "message_index": saved["message_index"] if saved else None,
+    }
+
+job_runner.register("generate", run_generate_job)
+job_runner.register("model", run_model_job)
+
+def job_status(job: dict) -> JobStatus:
+    artifact = job.get("artifact")
+    return JobStatus(
+        id=job["id"],
+        kind=job["kind"],
+        status=job["status"],
+        progress=job.get("progress") or 0,
+        error=job.get("error"),
+        chat_id=job.get("chat_id"),
+        message_index=job.get("message_index"),
+        artifact=artifact,
+        result_url=f"/api/artifacts/{artifact}" if artifact else None,
+        created_at=job["created_at"],
+        finished_at=job.get("finished_at"),
+    )
+
+@app.post("/api/jobs/generate", response_model=JobStatus, status_code=202)
+async def submit_generate_job(chat_request: ChatRequest, request: Request):
+    """
+    以后台任务执行 /generate：立即返回任务 ID，之后通过 GET /api/jobs/{id} 轮询或 /events 订阅
+    提供 chat_id 时结果由服务端保存为该对话的助手消息
+    """
+    if chat_request.chat_id and not await store.chat_exists(chat_request.chat_id):
+        raise HTTPException(status_code=404, detail="Chat not found")
+    payload = {
+        "request": chat_request.model_dump(exclude={"resumable"}),
+        "client": client_key(request),
+    }
+    job = await job_runner.submit("generate", payload, chat_id=chat_request.chat_id)
+    return job_status(job)
+
+@app.post("/api/jobs/model", response_model=JobStatus, status_code=202)
+async def submit_model_job(payload: ModelGenerateRequest, request: Request):
+    """以后台任务执行 /api/model/generate，结果（HTML）写入产物存储"""
+    prompt = model_prompt(payload)
+    if payload.chat_id and not await store.chat_exists(payload.chat_id):
+        raise HTTPException(status_code=404, detail="Chat not found")
+    job = await job_runner.submit(
+        "model",
+        {"prompt": prompt, "client": client_key(request)},
+        chat_id=payload.chat_id,
+    )
+    return job_status(job)
+
+@app.get("/api/jobs/{job_id}", response_model=JobStatus)
+async def get_job(job_id: str):
+    job = await store.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_status(job)
+
+@app.get("/api/jobs/{job_id}/events")
+async def job_events(job_id: str, request: Request):
+    """
+    订阅任务状态：状态或进度变化时推送 {"event": "job", ...JobStatus}，任务结束后推送 [DONE]
+    状态来自存储（任务可能由其他进程的 worker 执行），每 JOB_POLL_INTERVAL 秒检查一次
+    """
+    job = await store.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def event_generator():
+        current, last = job, None
+        while current is not None and not await request.is_disconnected():
+            status = job_status(current)
+            snapshot = (status.status, status.progress)
+            if snapshot != last:
+                last = snapshot
+                yield encode_event({"event": "job", **status.model_dump()})
+            if is_finished(current):
+                break
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+            current = await store.get_job(job_id)
+        yield DONE_FRAME
+
+    headers = {
+        "Cache-Control": "no-store",
+        "Content-Type": "text/event-stream; charset=utf-8",
+        "X-Accel-Buffering": "no",
+    }
+    return sse_response(event_generator(), request, headers)
+
+@app.delete("/api/jobs/{job_id}", response_model=JobStatus)
+async def cancel_job(job_id: str):
+    """取消排队中或执行中的任务（执行中的任务在 worker 下一次心跳时停止）；已结束的任务原样返回"""
+    job = await store.cancel_job(job_id, now_iso())
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_status(job)
+
+@app.get("/metrics")
+async def get_metrics():
+    return Response(metrics.render(), media_type=METRICS_CONTENT_TYPE)
+
+@app.get("/api/cache/stats")
+async def cache_stats():
+    return {
+        "generate": generation_cache.stats(),
+        "model": model_cache.stats(),
+        "tts": tts_cache.stats(),
+        "generate_in_flight": generation_flights.stats(),
+        "model_in_flight": model_flights.stats(),
+        "model_stream_in_flight": model_stream_flights.stats(),
+        "tts_in_flight": tts_flights.stats(),
+        "streams": {**stream_stats, "upstream_aborted": llm_pool.aborted},
+        "resumable": resumable_streams.stats(),
+        "jobs": job_runner.stats(),
+        "page_shells": page_shells.stats(),
+        "static_assets": {name: asset.stats() for name, asset in static_assets.items()},
+        "artifacts": {**await store.artifact_stats(), "codec": codec_name(), "html_minify": HTML_MINIFY},
+        "llm_providers": llm_pool.stats(),
+        "admission": {"llm": llm_scheduler.stats(), "tts": tts_scheduler.stats()},
+    }
+
 @app.get("/api/projects", response_model=List[Project])
-async def list_projects():
-    async with _projects_lock:
-        # 按更新时间倒序返回
-        projects = list(PROJECTS_DICT.values())
-        projects.sort(key=lambda p: p.updated_at, reverse=True)
-        return projects
+async def list_projects(request: Request, response: Response):
+    # 按更新时间倒序返回
+    projects = await fetch_page(request, response, store.list_projects)
+    return [Project(**project) for project in projects]
 
 @app.post("/api/projects", response_model=Project)
 async def create_project(payload: NewProjectRequest):
     name = payload.name.strip()
     if not name:
         raise HTTPException(status_code=400, detail="Project name is required")
-    project = Project(id=uuid.uuid4().hex, name=name, updated_at=now_iso())
-    async with _projects_lock:
-        PROJECTS_DICT[project.id] = project
-    return project
+    project = {"id": uuid.uuid4().hex, "name": name, "updated_at": now_iso()}
+    await store.create_project(project)
+    return Project(**project)
 
 @app.patch("/api/projects/{project_id}", response_model=Project)
 async def rename_project(project_id: str, payload: RenameProjectRequest):
     name = payload.name.strip()
     if not name:
         raise HTTPException(status_code=400, detail="Project name is required")
-    async with _projects_lock:
-        project = PROJECTS_DICT.get(project_id)
-        if not project:
-            raise HTTPException(status_code=404, detail="Project not found")
-        project.name = name
-        project.updated_at = now_iso()
-        PROJECTS_DICT[project_id] = project
-        return project
+    project = await store.rename_project(project_id, name, now_iso())
+    if not project:
+        raise HTTPException(status_code=404, detail="Project not found")
+    return Project(**project)
 
 @app.delete("/api/projects/{project_id}")
 async def delete_project(project_id: str):
-    async with _projects_lock:
-        if project_id not in PROJECTS_DICT:
-            raise HTTPException(status_code=404, detail="Project not found")
-        PROJECTS_DICT.pop(project_id, None)
-    
-    # 删除关联的chats
-    async with _chats_lock:
-        chat_ids_to_remove = [
-            chat_id for chat_id, chat in CHAT_STORE.items()
-            if (chat.get("project_id") or "") == project_id
-        ]
-        for chat_id in chat_ids_to_remove:
-            CHAT_STORE.pop(chat_id, None)
-    
+    # 同时删除关联的chats
+    if not await store.delete_project(project_id):
+        raise HTTPException(status_code=404, detail="Project not found")
     return {"status": "ok"}
 
 @app.post("/api/projects/{project_id}/rename", response_model=Project)
@@ -450,51 +1565,28 @@ async def delete_project_post(project_id: str):
 
 @app.get("/api/projects/{project_id}/share")
 async def share_project(project_id: str, request: Request):
-    async with _projects_lock:
-        if project_id not in PROJECTS_DICT:
-            raise HTTPException(status_code=404, detail="Project not found")
+    if not await store.get_project(project_id):
+        raise HTTPException(status_code=404, detail="Project not found")
     return {"url": str(request.base_url).rstrip("/") + f"/chat?project_id={project_id}"}
 
 @app.get("/api/chats", response_model=List[ChatSummary])
-async def list_chats(request: Request):
+async def list_chats(request: Request, response: Response):
     query = (request.query_params.get("q") or "").strip().lower()
-    async with _chats_lock:
-        chats = list(CHAT_STORE.values())
     if query:
-        def match_chat(chat):
-            title = (chat["title"] or "").lower()
-            if query in title:
-                return True
-            return any(query in (msg["content"] or "").lower() for msg in chat["messages"])
-        chats = [chat for chat in chats if match_chat(chat)]
-    chats.sort(key=lambda c: c["updated_at"], reverse=True)
-    return [
-        ChatSummary(
-            id=chat["id"],
-            title=chat["title"],
-            updated_at=chat["updated_at"],
-            project_id=chat.get("project_id"),
-        )
-        for chat in chats
-    ]
+        # 检索结果按相关度排序并分页：limit 默认 50、最大 200
+        limit = min(max(parse_int_param(request, "limit", 50), 1), 200)
+        offset = max(parse_int_param(request, "offset", 0), 0)
+        chats = await store.search_chats(query, limit=limit, offset=offset)
+    else:
+        chats = await fetch_page(request, response, store.list_chats)
+    return [ChatSummary(**chat) for chat in chats]
 
 @app.get("/api/projects/{project_id}/chats", response_model=List[ChatSummary])
-async def list_project_chats(project_id: str):
-    async with _chats_lock:
-        chats = [
-            chat for chat in CHAT_STORE.values()
-            if (chat.get("project_id") or "") == project_id
-        ]
-    chats.sort(key=lambda c: c["updated_at"], reverse=True)
-    return [
-        ChatSummary(
-            id=chat["id"],
-            title=chat["title"],
-            updated_at=chat["updated_at"],
-            project_id=chat.get("project_id"),
-        )
-        for chat in chats
-    ]
+async def list_project_chats(project_id: str, request: Request, response: Response):
+    chats = await fetch_page(
+        request, response, lambda limit, after: store.list_project_chats(project_id, limit, after)
+    )
+    return [ChatSummary(**chat) for chat in chats]
 
 @app.post("/api/chats", response_model=ChatSummary)
 async def create_chat(payload: NewChatRequest):
@@ -509,8 +1601,7 @@ async def create_chat(payload: NewChatRequest):
         "project_id": project_id or None,
         "messages": [],
     }
-    async with _chats_lock:
-        CHAT_STORE[chat_id] = chat
+    await store.create_chat(chat)
     return ChatSummary(
         id=chat_id,
         title=chat["title"],
@@ -518,84 +1609,301 @@ async def create_chat(payload: NewChatRequest):
         project_id=chat["project_id"],
     )
 
+# 摘要模式下超过该长度的助手消息（生成的 HTML 动画）只返回句柄
+SUMMARY_MAX_CONTENT = 2000
+
+def message_url(chat_id: str, index: int) -> str:
+    return f"/api/chats/{chat_id}/messages/{index}"
+
+def encoded_response(request: Request, body: bytes, media_type: str, headers: Optional[dict] = None) -> Response:
+    """按 Accept-Encoding 整段压缩响应体（gzip；安装 brotli 后优先 br）"""
+    headers = dict(headers or {})
+    headers["Vary"] = "Accept-Encoding"
+    if RESPONSE_COMPRESSION and len(body) >= RESPONSE_COMPRESSION_MIN_SIZE:
+        encoding = negotiate_encoding(request.headers.get("accept-encoding", ""))
+        if encoding:
+            body = compress_body(body, encoding, SSE_COMPRESSION_LEVEL)
+            headers["Content-Encoding"] = encoding
+    return Response(body, media_type=media_type, headers=headers)
+
+def json_model_response(request: Request, model: BaseModel, headers: Optional[dict] = None) -> Response:
+    return encoded_response(request, model.model_dump_json().encode("utf-8"), "application/json", headers)
+
 @app.get("/api/chats/{chat_id}", response_model=ChatDetail)
-async def get_chat(chat_id: str):
-    async with _chats_lock:
-        chat = CHAT_STORE.get(chat_id)
-        if not chat:
-            raise HTTPException(status_code=404, detail="Chat not found")
-        # 创建副本避免在锁内进行复杂操作
-        chat_copy = dict(chat)
-    return ChatDetail(
-        id=chat_copy["id"],
-        title=chat_copy["title"],
-        updated_at=chat_copy["updated_at"],
-        project_id=chat_copy.get("project_id"),
-        messages=[ChatMessage(**msg) for msg in chat_copy["messages"]],
+async def get_chat(chat_id: str, request: Request):
+    """
+    ?offset=&limit= 只返回部分消息（offset 为负数时从末尾倒数，如 offset=-20 取最近 20 条）
+    ?summary=1 时大段助手消息正文替换为 url，按需单独获取
+    """
+    offset = parse_int_param(request, "offset", 0)
+    limit = parse_int_param(request, "limit", -1)
+    summary = request.query_params.get("summary", "").lower() in ("1", "true", "yes")
+    chat = await store.get_chat(
+        chat_id,
+        offset=offset,
+        limit=None if limit < 0 else limit,
+        max_content=SUMMARY_MAX_CONTENT if summary else None,
+    )
+    if not chat:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    messages = []
+    for index, msg in enumerate(chat["messages"], start=chat["message_offset"]):
+        message = ChatMessage(**msg, index=index)
+        if msg["content"] is None:
+            message.url = message_url(chat_id, index)
+        messages.append(message)
+    return json_model_response(request, ChatDetail(
+        id=chat["id"],
+        title=chat["title"],
+        updated_at=chat["updated_at"],
+        project_id=chat.get("project_id"),
+        messages=messages,
+        message_count=chat["message_count"],
+        message_offset=chat["message_offset"],
+    ))
+
+@app.get("/api/chats/{chat_id}/messages/{index}", response_model=ChatMessage)
+async def get_chat_message(chat_id: str, index: int, request: Request):
+    message = await store.get_message(chat_id, index)
+    if not message:
+        raise HTTPException(status_code=404, detail="Message not found")
+    # 消息只追加不修改，可以长期缓存
+    return json_model_response(
+        request,
+        ChatMessage(**message, index=index),
+        {"Cache-Control": "private, max-age=86400, immutable"},
     )
 
-@app.post("/api/chats/{chat_id}/messages", response_model=ChatDetail)
+@app.post("/api/chats/{chat_id}/messages", response_model=AppendMessageResponse)
 async def append_message(chat_id: str, payload: ChatMessageRequest):
-    async with _chats_lock:
-        chat = CHAT_STORE.get(chat_id)
-        if not chat:
-            raise HTTPException(status_code=404, detail="Chat not found")
-        content = payload.content.strip()
-        chat["messages"].append({"role": payload.role, "content": content})
-        if not chat["title"] and payload.role == "user":
-            chat["title"] = content[:28] if content else "New Chat"
-        chat["updated_at"] = now_iso()
-        # 创建副本用于返回
-        chat_copy = dict(chat)
-    return ChatDetail(
-        id=chat_copy["id"],
-        title=chat_copy["title"],
-        updated_at=chat_copy["updated_at"],
-        project_id=chat_copy.get("project_id"),
-        messages=[ChatMessage(**msg) for msg in chat_copy["messages"]],
+    content = payload.content.strip()
+    default_title = (content[:28] if content else "New Chat") if payload.role == "user" else None
+    if payload.role == "assistant":
+        # 前端回传的生成 HTML 与服务端保存的结果同样压缩
+        message = assistant_message(content, looks_like_html(content))
+    else:
+        message = {"role": payload.role, "content": content}
+    # 只追加一条消息，不重写整个对话
+    summary = await store.append_message(
+        chat_id,
+        message,
+        now_iso(),
+        default_title=default_title,
+    )
+    if not summary:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    # 只返回新消息与对话元数据，不再回传整个对话
+    index = summary.pop("message_index")
+    artifact = summary.pop("artifact", None)
+    return AppendMessageResponse(
+        **summary,
+        message=ChatMessage(role=payload.role, content=message["content"], index=index, artifact=artifact),
     )
 
+@app.get("/api/artifacts/{artifact_id}")
+async def get_artifact(artifact_id: str, request: Request):
+    """
+    按内容哈希获取生成的产物（HTML 动画等），内容寻址，可永久缓存
+    ?original=1 返回压缩 HTML 之前的原文
+    产物压缩存储，客户端接受存储所用的编码时原样发送，否则解压后按 Accept-Encoding 重新压缩
+    """
+    original = request.query_params.get("original", "").lower() in ("1", "true", "yes")
+    packed = await store.get_artifact_data(artifact_id, original)
+    if packed is None:
+        raise HTTPException(status_code=404, detail="Artifact not found")
+    data, encoding = packed
+    headers = {
+        "Cache-Control": "private, max-age=31536000, immutable",
+        "ETag": f'"{artifact_id}-original"' if original else f'"{artifact_id}"',
+        "X-Content-Type-Options": "nosniff",
+    }
+    media_type = "text/plain; charset=utf-8"
+    if encoding and RESPONSE_COMPRESSION and accepts_encoding(request.headers.get("accept-encoding", ""), encoding):
+        headers["Vary"] = "Accept-Encoding"
+        headers["Content-Encoding"] = encoding
+        return Response(data, media_type=media_type, headers=headers)
+    return encoded_response(request, unpack(data, encoding).encode("utf-8"), media_type, headers)
+
 @app.patch("/api/chats/{chat_id}", response_model=ChatSummary)
 async def rename_chat(chat_id: str, payload: RenameChatRequest):
-    async with _chats_lock:
-        chat = CHAT_STORE.get(chat_id)
-        if not chat:
-            raise HTTPException(status_code=404, detail="Chat not found")
-        title = payload.title.strip() if payload.title else ""
-        # 如果提供了标题，则更新（即使为空字符串也要更新）
-        if payload.title is not None:
-            chat["title"] = title if title else None
-        chat["updated_at"] = now_iso()
-        chat_copy = dict(chat)
-    return ChatSummary(
-        id=chat_copy["id"],
-        title=chat_copy["title"],
-        updated_at=chat_copy["updated_at"],
-        project_id=chat_copy.get("project_id"),
-    )
+    title = payload.title.strip() if payload.title else ""
+    # 如果提供了标题，则更新（即使为空字符串也要更新）
+    chat = await store.rename_chat(chat_id, title if title else None, now_iso())
+    if not chat:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    return ChatSummary(**chat)
 
 @app.delete("/api/chats/{chat_id}")
 async def delete_chat(chat_id: str):
-    async with _chats_lock:
-        if chat_id not in CHAT_STORE:
-            raise HTTPException(status_code=404, detail="Chat not found")
-        CHAT_STORE.pop(chat_id, None)
+    if not await store.delete_chat(chat_id):
+        raise HTTPException(status_code=404, detail="Chat not found")
     return {"status": "ok"}
 
 @app.get("/api/chats/{chat_id}/share")
 async def share_chat(chat_id: str, request: Request):
-    async with _chats_lock:
-        if chat_id not in CHAT_STORE:
-            raise HTTPException(status_code=404, detail="Chat not found")
+    if not await store.chat_exists(chat_id):
+        raise HTTPException(status_code=404, detail="Chat not found")
     return {"url": str(request.base_url).rstrip("/") + f"/chat?chat_id={chat_id}"}
 
+def resolve_tts_voice(language: Optional[str]) -> tuple:
+    """
+    根据字幕语言选择 Qwen TTS 语音，返回 (voice, language_type)
+    注意：由于系统提示词中 subtitle_lang_note 要求字幕必须全部中文，
+    所以即使传入 "auto"，也默认使用中文，确保与字幕语言要求一致
+    """
+    if language == "auto":
+        # 字幕强制使用中文（与 subtitle_lang_note 保持一致）
+        detected_lang = "zh"
+    else:
+        detected_lang = language
+
+    # 根据语言选择 Qwen TTS 语音
+    # Qwen TTS 支持的语音：Cherry, Breeze, 等
+    # 中文推荐：Cherry, Breeze
+    # 英文推荐：Cherry
+    if detected_lang == "zh":
+        return "Cherry", "Chinese"  # 中文语音
+    return "Cherry", "English"  # 英文语音
+
+def tts_audio_etag(audio_id: str) -> str:
+    return f'"{audio_id[:32]}"'
+
+def tts_audio_response(audio_data: bytes, audio_id: str, request: Optional[Request] = None) -> Response:
+    """
+    返回音频响应，带 ETag；客户端 If-None-Match 命中时返回 304
+    """
+    etag = tts_audio_etag(audio_id)
+    headers = {
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "ETag": etag,
+        "X-TTS-Audio-Id": audio_id,
+    }
+    if request is not None and etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    return Response(content=audio_data, media_type="audio/mpeg", headers=headers)
+
+async def fetch_tts_audio(text: str, voice: str, language_type: str, speed: float) -> bytes:
+    """
+    调用 Qwen TTS API，返回解码后的音频数据
+    """
+    # Qwen TTS API 端点
+    # 从 Base_TTS_URL 中提取基础 URL（移除 compatible-mode/v1）
+    base_url = QWEN_TTS_BASE_URL.replace("/compatible-mode/v1", "").rstrip("/")
+    if not base_url:
+        # 如果 Base_TTS_URL 就是 compatible-mode/v1，使用默认的 dashscope 域名
+        base_url = "https://dashscope.aliyuncs.com"
+
+    tts_url = f"{base_url}/api/v1/services/audio/tts/generation"
+
+    # 标准 Qwen TTS API 格式
+    request_body = {
+        "model": "qwen3-tts-flash",  # Qwen TTS 模型名称
+        "input": {
+            "text": text,
+            "voice": voice,
+            "language_type": language_type,
+        },
+        "parameters": {
+            "speed": speed,
+        }
+    }
+
+    # 调用 Qwen TTS API（复用长连接池）
+    response = await get_tts_http_client().post(
+        tts_url,
+        headers={
+            "Authorization": f"Bearer {QWEN_TTS_API_KEY}",
+            "Content-Type": "application/json",
+        },
+        json=request_body,
+    )
+
+    if response.status_code != 200:
+        error_detail = response.text
+        try:
+            error_json = response.json()
+            error_detail = error_json.get("message", error_json.get("error", {}).get("message", error_detail))
+        except:
+            pass
+        raise HTTPException(
+            status_code=response.status_code,
+            detail=f"Qwen TTS API error: {error_detail}"
+        )
+
+    # 如果返回的是直接音频流（某些情况下）
+    content_type = response.headers.get("content-type", "")
+    if "audio" in content_type:
+        return response.content
+
+    # Qwen TTS 返回 JSON 格式，包含 base64 编码的音频数据
+    result = response.json()
+
+    # 检查响应格式
+    if "output" in result and "audio" in result["output"]:
+        # 标准格式：output.audio 包含 base64 编码的音频
+        return base64.b64decode(result["output"]["audio"])
+    if "data" in result and "audio" in result["data"]:
+        # 可能的其他格式
+        return base64.b64decode(result["data"]["audio"])
+    raise HTTPException(status_code=500, detail=f"Invalid Qwen TTS response format: {result}")
+
+async def synthesize_tts(
+    text: str,
+    language: Optional[str],
+    speed: float,
+    client: str = "unknown",
+    lane: str = "tts",
+) -> tuple:
+    """
+    合成（或从缓存读取）一段字幕音频，返回 (audio_data, audio_id)
+    audio_id 即缓存键，可用于 GET /api/tts/audio/{audio_id}
+    未命中缓存时经 tts_scheduler 准入，排队已满时返回 429
+    """
+    voice, language_type = resolve_tts_voice(language)
+    audio_id = make_cache_key("tts", text, voice, language_type, speed)
+    audio_data = await tts_cache.get(audio_id)
+    if audio_data is not None:
+        return audio_data, audio_id
+
+    check_admission(tts_scheduler, tts_flights, audio_id, client, lane)
+
+    async def fetch_and_store():
+        async with tts_scheduler.slot(client, lane):
+            started = time.perf_counter()
+            status = "error"
+            try:
+                data = await fetch_tts_audio(text, voice, language_type, speed)
+                status = "ok"
+            finally:
+                elapsed = time.perf_counter() - started
+                tts_upstream_seconds.observe(elapsed, status=status)
+                log_timing("tts", status=status, lane=lane, chars=len(text), duration=round(elapsed, 4))
+        tts_audio_bytes.observe(len(data))
+        await tts_cache.set(audio_id, data)
+        return data
+
+    try:
+        audio_data = await tts_flights.do(audio_id, fetch_and_store)
+    except httpx.TimeoutException:
+        raise HTTPException(status_code=504, detail="Qwen TTS API request timeout")
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=503, detail=f"Qwen TTS API request failed: {str(e)}")
+    except HTTPException:
+        raise
+    except AdmissionRejected as e:
+        raise admission_http_error(e)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Qwen TTS error: {str(e)}")
+    return audio_data, audio_id
+
 @app.post("/api/tts/generate")
-async def generate_tts(payload: TTSRequest):
+async def generate_tts(payload: TTSRequest, request: Request):
     """
     生成 TTS 音频
     使用 Qwen TTS API
     注意：由于系统提示词要求字幕必须全部中文（subtitle_lang_note），
     所以 TTS 默认使用中文语音，确保与字幕语言一致
+    相同 (text, voice, language_type, speed) 的音频会被缓存，并支持 ETag/304
     """
     if not USE_QWEN_TTS or not QWEN_TTS_API_KEY:
         raise HTTPException(status_code=500, detail="Qwen TTS API key not configured. Please set QWEN_TTS_API_KEY and Base_TTS_URL in credentials.json")
@@ -611,161 +1919,124 @@ async def generate_tts(payload: TTSRequest):
     
     # 限制速度范围
     speed = max(0.25, min(4.0, payload.speed))
-    
-    # 检测字幕语言并选择语音
-    # 注意：由于系统提示词中 subtitle_lang_note 要求字幕必须全部中文，
-    # 所以即使传入 "auto"，也默认使用中文，确保与字幕语言要求一致
-    if payload.language == "auto":
-        # 字幕强制使用中文（与 subtitle_lang_note 保持一致）
-        detected_lang = "zh"
-    else:
-        detected_lang = payload.language
-    
-    try:
-        # Qwen TTS API 端点
-        # 从 Base_TTS_URL 中提取基础 URL（移除 compatible-mode/v1）
-        base_url = QWEN_TTS_BASE_URL.replace("/compatible-mode/v1", "").rstrip("/")
-        if not base_url:
-            # 如果 Base_TTS_URL 就是 compatible-mode/v1，使用默认的 dashscope 域名
-            base_url = "https://dashscope.aliyuncs.com"
-        
-        tts_url = f"{base_url}/api/v1/services/audio/tts/generation"
-        
-        # 根据语言选择 Qwen TTS 语音
-        # Qwen TTS 支持的语音：Cherry, Breeze, 等
-        # 中文推荐：Cherry, Breeze
-        # 英文推荐：Cherry
-        if detected_lang == "zh":
-            voice = "Cherry"  # 中文语音
-            language_type = "Chinese"
-        else:
-            voice = "Cherry"  # 英文语音
-            language_type = "English"
-        
-        # 标准 Qwen TTS API 格式
-        request_body = {
-            "model": "qwen3-tts-flash",  # Qwen TTS 模型名称
-            "input": {
-                "text": text,
-                "voice": voice,
-                "language_type": language_type,
-            },
-            "parameters": {
-                "speed": speed,
-            }
+
+    audio_data, audio_id = await synthesize_tts(text, payload.language, speed, client_key(request))
+    return tts_audio_response(audio_data, audio_id, request)
+
+@app.post("/api/tts/prefetch")
+async def prefetch_tts(payload: TTSPrefetchRequest, request: Request):
+    """
+    批量预取一个动画的全部字幕音频
+    以有界并发合成，每完成一段就推送一条 SSE 清单事件：
+    {"index", "text", "audio_id", "url"}，前端可直接用 url 播放（命中浏览器缓存）
+    """
+    if not USE_QWEN_TTS or not QWEN_TTS_API_KEY:
+        raise HTTPException(status_code=500, detail="Qwen TTS API key not configured. Please set QWEN_TTS_API_KEY and Base_TTS_URL in credentials.json")
+
+    # 去重并保留原始顺序
+    texts = []
+    for text in payload.texts:
+        text = (text or "").strip()
+        if text and text not in texts:
+            texts.append(text)
+    if not texts:
+        raise HTTPException(status_code=400, detail="Texts are required")
+    if len(texts) > 200:
+        raise HTTPException(status_code=400, detail="Too many texts (max 200)")
+    if any(len(text) > 1000 for text in texts):
+        raise HTTPException(status_code=400, detail="Text too long (max 1000 characters)")
+
+    speed = max(0.25, min(4.0, payload.speed))
+    client = client_key(request)
+    semaphore = asyncio.Semaphore(max(1, TTS_PREFETCH_CONCURRENCY))
+
+    async def synthesize_one(index: int, text: str) -> dict:
+        async with semaphore:
+            try:
+                _, audio_id = await synthesize_tts(text, payload.language, speed, client, "prefetch")
+            except HTTPException as e:
+                return {"index": index, "text": text, "error": e.detail}
+        return {
+            "index": index,
+            "text": text,
+            "audio_id": audio_id,
+            "url": f"/api/tts/audio/{audio_id}",
         }
-        
-        # 调用 Qwen TTS API
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(
-                tts_url,
-                headers={
-                    "Authorization": f"Bearer {QWEN_TTS_API_KEY}",
-                    "Content-Type": "application/json",
-                },
-                json=request_body,
-            )
-            
-            if response.status_code != 200:
-                error_detail = response.text
-                try:
-                    error_json = response.json()
-                    error_detail = error_json.get("message", error_json.get("error", {}).get("message", error_detail))
-                except:
-                    pass
-                raise HTTPException(
-                    status_code=response.status_code,
-                    detail=f"Qwen TTS API error: {error_detail}"
-                )
-            
-            # Qwen TTS 返回 JSON 格式，包含 base64 编码的音频数据
-            result = response.json()
-            
-            # 检查响应格式
-            if "output" in result and "audio" in result["output"]:
-                # 标准格式：output.audio 包含 base64 编码的音频
-                import base64
-                audio_data = base64.b64decode(result["output"]["audio"])
-                return Response(
-                    content=audio_data,
-                    media_type="audio/mpeg",
-                    headers={
-                        "Cache-Control": "public, max-age=31536000",
-                    }
-                )
-            elif "data" in result and "audio" in result["data"]:
-                # 可能的其他格式
-                import base64
-                audio_data = base64.b64decode(result["data"]["audio"])
-                return Response(
-                    content=audio_data,
-                    media_type="audio/mpeg",
-                    headers={
-                        "Cache-Control": "public, max-age=31536000",
-                    }
-                )
+
+    async def event_generator():
+        tasks = [asyncio.create_task(synthesize_one(i, text)) for i, text in enumerate(texts)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                item = await next_done
+                if await request.is_disconnected():
+                    break
+                yield encode_event(item)
             else:
-                # 如果返回的是直接音频流（某些情况下）
-                content_type = response.headers.get("content-type", "")
-                if "audio" in content_type:
-                    return Response(
-                        content=response.content,
-                        media_type=content_type,
-                        headers={
-                            "Cache-Control": "public, max-age=31536000",
-                        }
-                    )
-                else:
-                    raise HTTPException(status_code=500, detail=f"Invalid Qwen TTS response format: {result}")
-    
-    except httpx.TimeoutException:
-        raise HTTPException(status_code=504, detail="Qwen TTS API request timeout")
-    except httpx.RequestError as e:
-        raise HTTPException(status_code=503, detail=f"Qwen TTS API request failed: {str(e)}")
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Qwen TTS error: {str(e)}")
+                yield DONE_FRAME
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    headers = {
+        "Cache-Control": "no-store",
+        "Content-Type": "text/event-stream; charset=utf-8",
+        "X-Accel-Buffering": "no",
+    }
+    return sse_response(event_generator(), request, headers)
+
+@app.get("/api/tts/audio/{audio_id}")
+async def get_tts_audio(audio_id: str, request: Request):
+    """
+    按 audio_id 读取已缓存的音频（可被浏览器长期缓存）
+    """
+    etag = tts_audio_etag(audio_id)
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers={"ETag": etag})
+    audio_data = await tts_cache.get(audio_id)
+    if audio_data is None:
+        raise HTTPException(status_code=404, detail="Audio not found")
+    return tts_audio_response(audio_data, audio_id)
+
+@app.get(ASSET_PREFIX + "{filename}")
+async def get_static_asset(filename: str, request: Request):
+    """带内容哈希的静态资源：内容变化即换新 URL，可永久缓存；按 Accept-Encoding 发送预压缩版本"""
+    asset = static_assets_by_url.get(ASSET_PREFIX + filename)
+    if asset is None:
+        raise HTTPException(status_code=404, detail="Asset not found")
+    return prebuilt_response(request, asset, "public, max-age=31536000, immutable")
+
+def prebuilt_response(request: Request, asset, cache_control: str) -> Response:
+    headers = {"Cache-Control": cache_control, "ETag": asset.etag, "Vary": "Accept-Encoding"}
+    if asset.etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    encoding = asset.select(request.headers.get("accept-encoding", ""))
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(asset.variants[encoding], media_type=asset.content_type, headers=headers)
+
+def page_response(request: Request, view: str) -> Response:
+    # 页面骨架引用的资源 URL 随部署变化，浏览器每次按 ETag 重新验证（未变化时返回 304）
+    return prebuilt_response(request, page_shells.get(view), "no-cache")
 
 @app.get("/", response_class=HTMLResponse)
 async def read_index(request: Request):
-    return templates.TemplateResponse(
-        "index.html", {
-            "request": request,
-            "time": datetime.now(shanghai_tz).strftime("%Y%m%d%H%M%S"),
-            "view": "initial"})
+    return page_response(request, "initial")
 
 @app.get("/chat", response_class=HTMLResponse)
 async def read_chat(request: Request):
-    return templates.TemplateResponse(
-        "index.html", {
-            "request": request,
-            "time": datetime.now(shanghai_tz).strftime("%Y%m%d%H%M%S"),
-            "view": "chat"})
+    return page_response(request, "chat")
 
 @app.get("/project", response_class=HTMLResponse)
 async def read_project(request: Request):
-    return templates.TemplateResponse(
-        "index.html", {
-            "request": request,
-            "time": datetime.now(shanghai_tz).strftime("%Y%m%d%H%M%S"),
-            "view": "project"})
+    return page_response(request, "project")
 
 @app.get("/model", response_class=HTMLResponse)
 async def read_model(request: Request):
-    return templates.TemplateResponse(
-        "index.html", {
-            "request": request,
-            "time": datetime.now(shanghai_tz).strftime("%Y%m%d%H%M%S"),
-            "view": "model"})
+    return page_response(request, "model")
 
 @app.get("/video", response_class=HTMLResponse)
 async def read_video(request: Request):
-    return templates.TemplateResponse(
-        "index.html", {
-            "request": request,
-            "time": datetime.now(shanghai_tz).strftime("%Y%m%d%H%M%S"),
-            "view": "video"})
+    return page_response(request, "video")
 
 # -----------------------------------------------------------------------
 # 4. 本地启动命令
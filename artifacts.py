@@ -0,0 +1,282 @@
+import re
+import zlib
+from typing import List, Optional, Tuple
+
+try:
+    import minify_html as _minify_html
+except ModuleNotFoundError:
+    _minify_html = None
+
+try:
+    import zstandard
+except ModuleNotFoundError:
+    zstandard = None
+
+# -----------------------------------------------------------------------
+# 产物处理：HTML 压缩（minify）与存储压缩
+#
+# minify_html：生成的 HTML 在提取之后、保存之前去掉注释与多余空白
+#   - 已安装 minify-html（pip install minify-html）时使用它，同时压缩内联的 CSS / JS
+#   - 否则使用内置的保守实现：HTML 注释删除、文本中的连续空白合并为一个；<style> 去注释与多余空白；
+#     <script> 只删除注释与行首缩进、空行（保留换行，不依赖自动分号插入规则）；
+#     <pre>、<textarea>、非 JavaScript 的 <script>（着色器、JSON 等）原样保留
+#   minify 不改变渲染结果，输出与输入相同时调用方不必另存原文
+#
+# pack / unpack：产物正文压缩存储。已安装 zstandard 时使用 zstd，否则使用 gzip；
+# 存储的字节可直接作为 Content-Encoding 相同的响应体发送
+# -----------------------------------------------------------------------
+
+_SEGMENT = re.compile(
+    r"<!--.*?-->"
+    r"|<(script|style|pre|textarea)\b((?:[^>\"']|\"[^\"]*\"|'[^']*')*)>(.*?)</\1\s*>"
+    r"|<[A-Za-z/!?](?:[^>\"']|\"[^\"]*\"|'[^']*')*>",
+    re.IGNORECASE | re.DOTALL,
+)
+# HTML 的可合并空白只有 ASCII 空白（&nbsp; 等不可合并）
+_WHITESPACE = re.compile(r"[ \t\n\r\f]+")
+_SCRIPT_TYPE = re.compile(r"""\btype\s*=\s*["']?([^"'\s>]+)""", re.IGNORECASE)
+_JS_TYPES = {"", "module", "text/javascript", "application/javascript", "text/ecmascript", "application/ecmascript"}
+
+_CSS_TOKEN = re.compile(r"\"(?:\\.|[^\"\\])*\"|'(?:\\.|[^'\\])*'|/\*.*?\*/", re.DOTALL)
+_CSS_PUNCTUATION = re.compile(r"\s*([{};,>])\s*|(:)\s+")
+
+# 其后出现的 / 是正则表达式字面量而不是除号
+_REGEX_PRECEDERS = set("(,=:[!&|?{};+-*%<>~^")
+_REGEX_KEYWORDS = {
+    "return", "typeof", "case", "do", "else", "in", "of", "new", "delete", "void", "throw",
+    "instanceof", "yield", "await",
+}
+
+
+def minify_css(css: str) -> str:
+    parts: List[str] = []
+    position = 0
+    for match in _CSS_TOKEN.finditer(css):
+        parts.append(_squeeze_css(css[position:match.start()]))
+        if not match.group().startswith("/*"):
+            parts.append(match.group())
+        position = match.end()
+    parts.append(_squeeze_css(css[position:]))
+    return "".join(parts).replace(";}", "}").strip()
+
+
+def _squeeze_css(text: str) -> str:
+    # 只处理不影响语义的分隔符；冒号之前、括号与运算符周围的空白保留（如 a :hover、and (...)、calc(1px + 2px)）
+    return _CSS_PUNCTUATION.sub(lambda m: m.group(1) or m.group(2), _WHITESPACE.sub(" ", text))
+
+
+def minify_js(js: str) -> str:
+    """删除注释、行首缩进与空行；字符串、模板字符串与正则表达式原样保留"""
+    out: List[str] = []
+    line: List[str] = []
+    i, n = 0, len(js)
+    last = ""  # 上一个非空白字符（判断 / 是否开始正则表达式）
+    word = ""  # 上一个标识符或关键字
+    in_word = False
+
+    def end_line():
+        text = "".join(line).strip()
+        if text:
+            out.append(text)
+        line.clear()
+
+    while i < n:
+        ch = js[i]
+        if ch == "\n":
+            end_line()
+            i += 1
+            continue
+        if ch == "/" and i + 1 < n and js[i + 1] == "/":
+            end = js.find("\n", i)
+            i = n if end < 0 else end
+            continue
+        if ch == "/" and i + 1 < n and js[i + 1] == "*":
+            end = js.find("*/", i + 2)
+            if end < 0:
+                return js
+            # 多行注释相当于换行，保留一个分隔以免前后两段代码粘连
+            if "\n" in js[i:end]:
+                end_line()
+            else:
+                line.append(" ")
+            i = end + 2
+            continue
+        if ch in "'\"`":
+            end = _skip_string(js, i)
+            if end < 0:
+                return js
+            line.append(js[i:end])
+            i = end
+            last, word, in_word = ch, "", False
+            continue
+        if ch == "/" and (last in _REGEX_PRECEDERS or last == "" or word in _REGEX_KEYWORDS):
+            end = _skip_regex(js, i)
+            if end > 0:
+                line.append(js[i:end])
+                i = end
+                last, word, in_word = "/", "", False
+                continue
+        line.append(ch)
+        if ch.isalnum() or ch in "_$":
+            word = word + ch if in_word else ch
+            in_word = True
+        else:
+            in_word = False
+            if not ch.isspace():
+                word = ""
+        if not ch.isspace():
+            last = ch
+        i += 1
+    end_line()
+    return "\n".join(out)
+
+
+def _skip_string(js: str, start: int) -> int:
+    """返回字符串（或模板字符串）结束后的位置，未闭合时返回 -1"""
+    quote = js[start]
+    i, n = start + 1, len(js)
+    depth = 0
+    while i < n:
+        ch = js[i]
+        if ch == "\\":
+            i += 2
+            continue
+        if quote == "`":
+            if ch == "$" and i + 1 < n and js[i + 1] == "{":
+                # ${...} 中的代码可能再包含字符串，整体原样保留，只需找到匹配的右括号
+                depth += 1
+                i += 2
+                continue
+            if depth and ch == "}":
+                depth -= 1
+            elif depth and ch in "'\"`":
+                end = _skip_string(js, i)
+                if end < 0:
+                    return -1
+                i = end
+                continue
+            elif depth and ch == "{":
+                depth += 1
+            elif not depth and ch == "`":
+                return i + 1
+        elif ch == quote:
+            return i + 1
+        elif ch == "\n":
+            return -1
+        i += 1
+    return -1
+
+
+def _skip_regex(js: str, start: int) -> int:
+    """返回正则表达式字面量（含标志）结束后的位置，不像正则表达式时返回 -1"""
+    i, n = start + 1, len(js)
+    in_class = False
+    while i < n:
+        ch = js[i]
+        if ch == "\n":
+            return -1
+        if ch == "\\":
+            i += 2
+            continue
+        if ch == "[":
+            in_class = True
+        elif ch == "]":
+            in_class = False
+        elif ch == "/" and not in_class:
+            i += 1
+            while i < n and (js[i].isalnum() or js[i] == "_"):
+                i += 1
+            return i
+        i += 1
+    return -1
+
+
+def _builtin_minify(html: str) -> str:
+    parts: List[str] = []
+    position = 0
+    for match in _SEGMENT.finditer(html):
+        parts.append(_WHITESPACE.sub(" ", html[position:match.start()]))
+        position = match.end()
+        segment = match.group()
+        if segment.startswith("<!--"):
+            # 条件注释保留
+            if segment.startswith("<!--[if"):
+                parts.append(segment)
+            continue
+        tag = (match.group(1) or "").lower()
+        if tag == "style":
+            parts.append(f"<style{match.group(2)}>{minify_css(match.group(3))}</style>")
+        elif tag == "script":
+            script_type = _SCRIPT_TYPE.search(match.group(2) or "")
+            if (script_type.group(1).lower() if script_type else "") in _JS_TYPES:
+                parts.append(f"<script{match.group(2)}>{minify_js(match.group(3))}</script>")
+            else:
+                parts.append(segment)
+        else:
+            parts.append(segment)
+    parts.append(_WHITESPACE.sub(" ", html[position:]))
+    return "".join(parts).strip()
+
+
+def minify_html(html: str) -> str:
+    """压缩 HTML；处理出错时返回原文"""
+    if not html:
+        return html
+    try:
+        if _minify_html is not None:
+            return _minify_html.minify(html, minify_css=True, minify_js=True, keep_closing_tags=True)
+        return _builtin_minify(html)
+    except Exception as e:
+        print(f"--- HTML 压缩失败，保留原文: {e} ---")
+        return html
+
+
+def looks_like_html(text: str) -> bool:
+    head = text.lstrip()[:64].lower()
+    return head.startswith("<!doctype html") or head.startswith("<html")
+
+
+# -----------------------------------------------------------------------
+# 存储压缩
+# -----------------------------------------------------------------------
+
+_codec = "zstd" if zstandard is not None else "gzip"
+
+
+def set_codec(name: str):
+    """选择新写入产物的压缩方式："auto"（zstandard 可用时优先）、"zstd"、"gzip"；已存储的产物按各自的编码读取"""
+    global _codec
+    if name in ("", "auto"):
+        _codec = "zstd" if zstandard is not None else "gzip"
+        return
+    if name not in ("zstd", "gzip"):
+        raise RuntimeError(f"未知的产物压缩方式：{name}（可选 auto / zstd / gzip）")
+    if name == "zstd" and zstandard is None:
+        raise RuntimeError("zstd 压缩需要 pip install zstandard")
+    _codec = name
+
+
+def codec_name() -> str:
+    return _codec
+
+
+def pack(text: str, codec: Optional[str] = None, level: int = 6) -> Tuple[bytes, str]:
+    """把正文压缩为 (字节, 编码)，编码即对应的 Content-Encoding"""
+    codec = codec or _codec
+    data = text.encode("utf-8")
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstd 压缩需要 pip install zstandard")
+        return zstandard.ZstdCompressor(level=level).compress(data), "zstd"
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush(), "gzip"
+
+
+def unpack(data: bytes, encoding: Optional[str]) -> str:
+    if encoding == "zstd":
+        if zstandard is None:
+            raise RuntimeError("读取 zstd 压缩的产物需要 pip install zstandard")
+        return zstandard.ZstdDecompressor().decompress(data).decode("utf-8")
+    if encoding == "gzip":
+        return zlib.decompress(data, 31).decode("utf-8")
+    return data.decode("utf-8")
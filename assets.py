@@ -0,0 +1,168 @@
+import hashlib
+import json
+import mimetypes
+import os
+import sys
+import zlib
+from typing import Callable, Dict, Iterable, List
+
+from artifacts import minify_css, minify_js
+from sse import accepts_encoding
+
+try:
+    import brotli
+except ModuleNotFoundError:
+    brotli = None
+
+# -----------------------------------------------------------------------
+# 静态资源构建
+#
+# build_assets 读取 static/ 下的前端资源，生成带内容哈希的版本：
+#   - script.js / style.css 先压缩（artifacts.minify_js / minify_css，只删除注释与空白），
+#     再预先压缩为 gzip（与安装 brotli 时的 br）；图片只加哈希
+#   - URL 为 /assets/<名称>.<哈希><扩展名>，内容变化即换新 URL，可以设置 immutable 长期缓存
+# 页面骨架（index.html 按视图渲染的结果）同样预先压缩并缓存，见 PageShells
+#
+# 进程启动时在内存中构建（几百 KB，耗时在一秒以内）；也可以写出到目录交给反向代理 / CDN：
+#   python assets.py build [输出目录，默认 static/dist]
+# -----------------------------------------------------------------------
+
+ASSET_PREFIX = "/assets/"
+ASSET_FILES = ("script.js", "style.css", "favicon.png", "logo.png")
+MINIFIERS: Dict[str, Callable[[str], str]] = {".js": minify_js, ".css": minify_css}
+# 已压缩格式（图片）再压缩没有收益
+COMPRESSIBLE = {".js", ".css", ".html", ".svg", ".json"}
+
+
+class Asset:
+    """一个构建好的资源：原始字节与预先压缩的各编码版本"""
+
+    __slots__ = ("name", "url", "content_type", "etag", "variants")
+
+    def __init__(self, name: str, url: str, content_type: str, data: bytes, compress: bool = True):
+        self.name = name
+        self.url = url
+        self.content_type = content_type
+        self.etag = f'"{hashlib.sha256(data).hexdigest()[:16]}"'
+        self.variants: Dict[str, bytes] = {"identity": data}
+        if compress:
+            for encoding, packed in compress_variants(data).items():
+                # 压缩后反而更大时不保留
+                if len(packed) < len(data):
+                    self.variants[encoding] = packed
+
+    def select(self, accept_encoding: str) -> str:
+        """按 Accept-Encoding 选择编码：br 优先，其次 gzip，否则不压缩"""
+        for encoding in ("br", "gzip"):
+            if encoding in self.variants and accepts_encoding(accept_encoding, encoding):
+                return encoding
+        return "identity"
+
+    def stats(self) -> dict:
+        return {"url": self.url, **{encoding: len(data) for encoding, data in self.variants.items()}}
+
+
+def compress_variants(data: bytes) -> Dict[str, bytes]:
+    # 只构建一次，使用最高压缩级别
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+    variants = {"gzip": compressor.compress(data) + compressor.flush()}
+    if brotli is not None:
+        variants["br"] = brotli.compress(data, quality=11)
+    return variants
+
+
+def content_type_for(name: str) -> str:
+    content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    if content_type.startswith("text/") or content_type.endswith("javascript"):
+        content_type += "; charset=utf-8"
+    return content_type
+
+
+def build_asset(static_dir: str, name: str, minify: bool = True) -> Asset:
+    with open(os.path.join(static_dir, name), "rb") as f:
+        data = f.read()
+    stem, ext = os.path.splitext(name)
+    minifier = MINIFIERS.get(ext) if minify else None
+    if minifier is not None:
+        text = data.decode("utf-8")
+        try:
+            data = minifier(text).encode("utf-8")
+        except Exception as e:
+            print(f"--- 压缩 {name} 失败，使用原文: {e} ---")
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    return Asset(name, f"{ASSET_PREFIX}{stem}.{digest}{ext}", content_type_for(name), data, ext in COMPRESSIBLE)
+
+
+def build_assets(static_dir: str, names: Iterable[str] = ASSET_FILES, minify: bool = True) -> Dict[str, Asset]:
+    """返回 {原文件名: Asset}；缺失的文件跳过（模板中退回 /static/ 原路径）"""
+    assets = {}
+    for name in names:
+        if os.path.exists(os.path.join(static_dir, name)):
+            assets[name] = build_asset(static_dir, name, minify)
+    return assets
+
+
+def asset_urls(assets: Dict[str, Asset], names: Iterable[str] = ASSET_FILES) -> Dict[str, str]:
+    """模板使用的 {原文件名: URL}；未构建的资源使用 /static/ 原路径"""
+    return {name: assets[name].url if name in assets else f"/static/{name}" for name in names}
+
+
+def write_assets(assets: Dict[str, Asset], out_dir: str) -> List[str]:
+    """把构建结果写入 out_dir（含 .gz / .br 预压缩文件与 manifest.json），返回写入的文件名"""
+    os.makedirs(out_dir, exist_ok=True)
+    suffixes = {"identity": "", "gzip": ".gz", "br": ".br"}
+    written = []
+    for asset in assets.values():
+        filename = asset.url[len(ASSET_PREFIX):]
+        for encoding, data in asset.variants.items():
+            path = filename + suffixes[encoding]
+            with open(os.path.join(out_dir, path), "wb") as f:
+                f.write(data)
+            written.append(path)
+    with open(os.path.join(out_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump({name: asset.url for name, asset in assets.items()}, f, ensure_ascii=False, indent=2)
+    written.append("manifest.json")
+    return written
+
+
+class PageShells:
+    """
+    页面骨架缓存：每个视图只渲染一次模板，结果连同预压缩版本一起缓存
+    render(view) -> str；模板与资源在进程生命周期内不变，无需失效
+    """
+
+    def __init__(self, render: Callable[[str], str]):
+        self._render = render
+        self._shells: Dict[str, Asset] = {}
+        self.renders = 0
+
+    def get(self, view: str) -> Asset:
+        shell = self._shells.get(view)
+        if shell is None:
+            self.renders += 1
+            shell = self._shells[view] = Asset(
+                f"{view}.html", "", "text/html; charset=utf-8", self._render(view).encode("utf-8")
+            )
+        return shell
+
+    def stats(self) -> dict:
+        return {"renders": self.renders, "views": {view: shell.stats() for view, shell in self._shells.items()}}
+
+
+def _main(argv: List[str]):
+    root = os.path.dirname(os.path.abspath(__file__))
+    static_dir = os.path.join(root, "static")
+    if not argv or argv[0] != "build":
+        print("用法: python assets.py build [输出目录，默认 static/dist]")
+        sys.exit(1)
+    out_dir = argv[1] if len(argv) > 1 else os.path.join(static_dir, "dist")
+    assets = build_assets(static_dir)
+    for name in write_assets(assets, out_dir):
+        print(f"{out_dir}/{name}")
+    for name, asset in assets.items():
+        sizes = ", ".join(f"{encoding} {len(data)}" for encoding, data in asset.variants.items())
+        print(f"--- {name} -> {asset.url}（{sizes}） ---")
+
+
+if __name__ == "__main__":
+    _main(sys.argv[1:])
@@ -0,0 +1,243 @@
+"""
+断开取消验证：客户端中途断开 SSE 后，上游模型调用应立即被关闭，不再继续生成 token
+
+启动本地模拟模型（fake_llm.py）与指向它的 ChatTutor 实例，依次验证：
+  - mid-stream：读到若干事件后断开，上游应在短时间内关闭连接，之后不再发送 token
+  - stalled：上游迟迟不出首个 token 时断开，同样应及时取消
+  - shared：多个相同请求合并为一个上游调用，最后一个订阅者离开后才取消
+  - resume：可续传请求断开后上游继续生成，携带 Last-Event-ID 重连从断点续上；
+    再次断开且宽限期（SSE_RESUME_GRACE）内没有重连时才取消上游
+
+    python benchmarks/bench_disconnect.py
+    python benchmarks/bench_disconnect.py --clients 8 --max-abort-latency 1.0
+    python benchmarks/bench_disconnect.py --asgi-spec 2.4   # 模拟不主动通知断开的服务器
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_llm import FakeLLM  # noqa: E402
+from harness import free_port, start_app, start_fake, stop_process, wait_ready  # noqa: E402
+
+
+async def open_and_drop(base_url: str, topic: str, read_events: int, hold: float = 0.0, bypass: bool = True) -> int:
+    """发起 /generate，读取 read_events 个事件（或等待 hold 秒）后直接断开连接"""
+    headers = {"X-Cache-Bypass": "1"} if bypass else {}
+    received = 0
+    async with httpx.AsyncClient(timeout=None) as client:
+        async with client.stream("POST", f"{base_url}/generate", json={"topic": topic}, headers=headers) as response:
+            if read_events <= 0:
+                await asyncio.sleep(hold)
+                return 0
+            async for line in response.aiter_lines():
+                if line.startswith("data: "):
+                    received += 1
+                    if received >= read_events:
+                        break
+    return received
+
+
+async def read_resumable(base_url: str, read_events: int, topic: str = "", last_event_id: str = "") -> list:
+    """发起可续传的 /generate（或带 Last-Event-ID 续传），读取 read_events 个事件后断开，返回收到的事件 id"""
+    ids = []
+    async with httpx.AsyncClient(timeout=None) as client:
+        if last_event_id:
+            generation_id = last_event_id.rpartition(":")[0]
+            request = client.stream(
+                "GET", f"{base_url}/api/generations/{generation_id}/events", headers={"Last-Event-ID": last_event_id}
+            )
+        else:
+            request = client.stream(
+                "POST", f"{base_url}/generate", json={"topic": topic, "resumable": True}, headers={"X-Cache-Bypass": "1"}
+            )
+        async with request as response:
+            async for line in response.aiter_lines():
+                if line.startswith("id: "):
+                    ids.append(line[4:])
+                    if len(ids) >= read_events:
+                        break
+    return ids
+
+
+async def wait_for(condition, timeout: float, interval: float = 0.01) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        await asyncio.sleep(interval)
+    return condition()
+
+
+async def measure_abort(fake: FakeLLM, dropped_at: float, settle: float, timeout: float) -> dict:
+    """等待上游流被关闭，返回关闭延迟与关闭后仍发送的 token 数"""
+    closed = await wait_for(lambda: fake.stats["active"] == 0, timeout)
+    latency = (fake.last_abort_at - dropped_at) if closed and fake.last_abort_at else None
+    sent_at_close = fake.stats["tokens_sent"]
+    await asyncio.sleep(settle)
+    return {
+        "closed": closed,
+        "abort_latency": latency,
+        "tokens_after_close": fake.stats["tokens_sent"] - sent_at_close,
+    }
+
+
+async def scenario_mid_stream(fake: FakeLLM, base_url: str, args) -> dict:
+    fake.reset()
+    fake.first_token_delay = 0.0
+    await open_and_drop(base_url, "mid-stream", args.read_events)
+    dropped_at = time.monotonic()
+    tokens_at_drop = fake.stats["tokens_sent"]
+    result = await measure_abort(fake, dropped_at, args.settle, args.timeout)
+    result["tokens_at_drop"] = tokens_at_drop
+    result["tokens_total"] = fake.stats["tokens_sent"]
+    result["tokens_planned"] = fake.tokens
+    result["ok"] = (
+        result["closed"]
+        and fake.stats["aborted"] == 1
+        and result["abort_latency"] is not None
+        and result["abort_latency"] <= args.max_abort_latency
+        and result["tokens_after_close"] == 0
+    )
+    return result
+
+
+async def scenario_stalled(fake: FakeLLM, base_url: str, args) -> dict:
+    fake.reset()
+    fake.first_token_delay = 60.0
+    await open_and_drop(base_url, "stalled", 0, hold=1.0)
+    dropped_at = time.monotonic()
+    result = await measure_abort(fake, dropped_at, args.settle, args.timeout)
+    fake.first_token_delay = 0.0
+    result["tokens_total"] = fake.stats["tokens_sent"]
+    result["ok"] = (
+        result["closed"]
+        and fake.stats["tokens_sent"] == 0
+        and result["abort_latency"] is not None
+        and result["abort_latency"] <= args.max_abort_latency
+    )
+    return result
+
+
+async def scenario_shared(fake: FakeLLM, base_url: str, args) -> dict:
+    fake.reset()
+    fake.first_token_delay = 0.0
+    # 合并的请求不能带 bypass；主题带时间戳，避免命中之前的缓存
+    topic = f"shared-{time.time()}"
+    tasks = [
+        asyncio.create_task(open_and_drop(base_url, topic, args.read_events * (i + 1), bypass=False))
+        for i in range(args.clients)
+    ]
+    # 前 clients-1 个客户端断开后上游应仍在运行
+    for task in tasks[:-1]:
+        await task
+    still_running = fake.stats["active"] == 1 and fake.stats["aborted"] == 0
+    await tasks[-1]
+    dropped_at = time.monotonic()
+    result = await measure_abort(fake, dropped_at, args.settle, args.timeout)
+    result["upstream_requests"] = fake.stats["requests"]
+    result["running_until_last_left"] = still_running
+    result["ok"] = (
+        result["closed"]
+        and still_running
+        and fake.stats["requests"] == 1
+        and result["abort_latency"] is not None
+        and result["abort_latency"] <= args.max_abort_latency
+        and result["tokens_after_close"] == 0
+    )
+    return result
+
+
+async def scenario_resume(fake: FakeLLM, base_url: str, args) -> dict:
+    fake.reset()
+    fake.first_token_delay = 0.0
+    first = await read_resumable(base_url, args.read_events, topic="resume")
+    await asyncio.sleep(args.resume_grace / 2)
+    # 断开后、宽限期内上游应继续生成
+    kept_running = fake.stats["active"] == 1 and fake.stats["aborted"] == 0
+    second = await read_resumable(base_url, args.read_events, last_event_id=first[-1])
+    dropped_at = time.monotonic()
+    seqs = [int(event_id.rpartition(":")[2]) for event_id in first + second]
+    result = await measure_abort(fake, dropped_at, args.settle, args.resume_grace + args.timeout)
+    if result["abort_latency"] is not None:
+        result["abort_latency"] -= args.resume_grace
+    result["kept_running"] = kept_running
+    result["contiguous"] = seqs == list(range(1, len(seqs) + 1))
+    result["upstream_requests"] = fake.stats["requests"]
+    result["ok"] = (
+        result["closed"]
+        and kept_running
+        and result["contiguous"]
+        and fake.stats["requests"] == 1
+        and result["abort_latency"] is not None
+        and result["abort_latency"] <= args.max_abort_latency
+        and result["tokens_after_close"] == 0
+    )
+    return result
+
+
+def format_result(name: str, result: dict) -> str:
+    latency = result.get("abort_latency")
+    latency_text = f"{latency * 1000:.0f}ms" if latency is not None else "-"
+    details = ", ".join(f"{k}={v}" for k, v in result.items() if k not in ("ok", "abort_latency", "closed"))
+    return f"{'PASS' if result['ok'] else 'FAIL'}  {name:<10} abort_latency={latency_text}  {details}"
+
+
+async def main_async(args) -> bool:
+    fake = FakeLLM(tokens=args.tokens, token_interval=args.token_interval)
+    fake_port, app_port = free_port(), free_port()
+    server, server_task = await start_fake(fake, fake_port)
+    workdir = tempfile.mkdtemp(prefix="chattutor-disconnect-")
+    process = start_app(
+        fake_port,
+        app_port,
+        workdir,
+        {"DISCONNECT_POLL_INTERVAL": args.poll_interval, "SSE_RESUME_GRACE": args.resume_grace},
+        args.asgi_spec,
+    )
+    base_url = f"http://127.0.0.1:{app_port}"
+    try:
+        await wait_ready(base_url)
+        results = {
+            "mid-stream": await scenario_mid_stream(fake, base_url, args),
+            "stalled": await scenario_stalled(fake, base_url, args),
+            "shared": await scenario_shared(fake, base_url, args),
+            "resume": await scenario_resume(fake, base_url, args),
+        }
+        for name, result in results.items():
+            print(format_result(name, result))
+        async with httpx.AsyncClient() as client:
+            stats = (await client.get(f"{base_url}/api/cache/stats")).json()
+        print("streams:", stats.get("streams"), "generate_in_flight:", stats.get("generate_in_flight"))
+        return all(result["ok"] for result in results.values())
+    finally:
+        stop_process(process)
+        server.should_exit = True
+        await server_task
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, default=2000, help="模拟模型每次输出的 token 数")
+    parser.add_argument("--token-interval", type=float, default=0.01)
+    parser.add_argument("--read-events", type=int, default=10, help="断开前读取的 SSE 事件数")
+    parser.add_argument("--clients", type=int, default=4, help="shared 场景的并发客户端数")
+    parser.add_argument("--poll-interval", type=float, default=0.5, help="服务端 DISCONNECT_POLL_INTERVAL")
+    parser.add_argument("--max-abort-latency", type=float, default=2.0, help="允许的最大取消延迟（秒）")
+    parser.add_argument("--settle", type=float, default=1.0, help="关闭后继续观察是否还有 token 的时长（秒）")
+    parser.add_argument("--resume-grace", type=float, default=2.0, help="服务端 SSE_RESUME_GRACE（秒）")
+    parser.add_argument("--timeout", type=float, default=10.0)
+    parser.add_argument("--asgi-spec", default="", help="覆盖 ASGI spec_version，例如 2.4")
+    args = parser.parse_args()
+    ok = asyncio.run(main_async(args))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
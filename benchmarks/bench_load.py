@@ -0,0 +1,469 @@
+"""
+压测：启动本地模拟上游（OpenAI 兼容 / Gemini / DashScope TTS，见 fake_llm.py）与指向它的 ChatTutor 实例，
+用大量并发客户端驱动各接口，报告 TTFB、p50/p99 延迟、吞吐、每个流的内存占用与事件循环延迟
+
+场景：
+  - stream：并发 SSE 客户端请求 POST /generate（每个请求主题不同并跳过缓存，全部走上游）
+  - model：并发请求 POST /api/model/generate/stream
+  - chats：对话增删改查（新建、追加消息、读取、分页列表、检索、重命名、删除），先预置 --seed-chats 个对话
+  - tts：POST /api/tts/generate，先全部未命中缓存，再重复请求同样的文本（命中缓存）
+
+    python benchmarks/bench_load.py
+    python benchmarks/bench_load.py --scenarios stream --concurrency 50 --requests 200 --token-rate 200
+    python benchmarks/bench_load.py --provider gemini --first-token-delay 0.5 --fail-rate 0.05
+    python benchmarks/bench_load.py --set STORAGE_BACKEND=sqlite --json results.json
+
+默认放开单客户端并发限制（所有压测请求都来自 127.0.0.1），--keep-admission 保留 credentials 中的准入配置。
+每个流的内存 = (压测期间 RSS 峰值 - 压测前 RSS) / 同时进行的流数，仅 Linux 可用；
+事件循环延迟取自服务端 GET /metrics 的 chattutor_event_loop_lag_seconds（分位数为所在分桶上界）。
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import (  # noqa: E402
+    free_port,
+    parse_metrics,
+    process_rss,
+    start_app,
+    start_fake_process,
+    stop_process,
+    wait_ready,
+)
+
+BYPASS = {"X-Cache-Bypass": "1"}
+QUEUE_PREFIXES = ('{"event":"queued"', '{"event":"admitted"')
+LAG_METRIC = "chattutor_event_loop_lag_seconds"
+TOPICS = ["二次函数", "牛顿第二定律", "光合作用", "勾股定理", "电磁感应", "细胞分裂", "化学平衡", "概率统计"]
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))]
+
+
+def summarize(samples: List[dict], elapsed: float) -> dict:
+    ok = [s for s in samples if s["ok"]]
+    errors: Dict[str, int] = defaultdict(int)
+    for s in samples:
+        if not s["ok"]:
+            errors[str(s.get("status"))] += 1
+    latencies = [s["latency"] for s in ok]
+    ttfbs = [s["ttfb"] for s in ok if s.get("ttfb") is not None]
+    events = sum(s.get("events", 0) for s in ok)
+    result = {
+        "requests": len(samples),
+        "ok": len(ok),
+        "errors": dict(errors),
+        "elapsed": elapsed,
+        "throughput": len(ok) / elapsed if elapsed > 0 else 0.0,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p99": percentile(latencies, 99),
+        "latency_max": max(latencies) if latencies else None,
+    }
+    if ttfbs:
+        result["ttfb_p50"] = percentile(ttfbs, 50)
+        result["ttfb_p99"] = percentile(ttfbs, 99)
+    if events:
+        result["events_per_second"] = events / elapsed if elapsed > 0 else 0.0
+        result["bytes"] = sum(s.get("bytes", 0) for s in ok)
+    return result
+
+
+class Sampler:
+    """压测期间定时采样服务进程 RSS 与同时进行的流数"""
+
+    def __init__(self, pid: int, interval: float):
+        self.pid = pid
+        self.interval = interval
+        self.active = 0
+        self.peak_active = 0
+        self.peak_rss: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def stream_started(self):
+        self.active += 1
+        self.peak_active = max(self.peak_active, self.active)
+
+    def stream_finished(self):
+        self.active -= 1
+
+    async def _run(self):
+        while True:
+            rss = process_rss(self.pid)
+            if rss is not None and (self.peak_rss is None or rss > self.peak_rss):
+                self.peak_rss = rss
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self.active = self.peak_active = 0
+        self.peak_rss = None
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+async def scrape_lag(client: httpx.AsyncClient) -> Dict[str, float]:
+    samples = parse_metrics((await client.get("/metrics")).text)
+    return {key: value for key, value in samples.items() if key.startswith(LAG_METRIC)}
+
+
+def lag_delta(before: Dict[str, float], after: Dict[str, float]) -> dict:
+    """两次抓取之间事件循环延迟直方图的增量：样本数、平均值与分位数（分桶上界）"""
+    count = after.get(f"{LAG_METRIC}_count", 0) - before.get(f"{LAG_METRIC}_count", 0)
+    total = after.get(f"{LAG_METRIC}_sum", 0) - before.get(f"{LAG_METRIC}_sum", 0)
+    if count <= 0:
+        return {"samples": 0}
+    buckets = []
+    for key, value in after.items():
+        if key.startswith(f"{LAG_METRIC}_bucket"):
+            bound = key.split('le="', 1)[1].rstrip('"}')
+            buckets.append((float(bound), value - before.get(key, 0)))
+    buckets.sort()
+
+    def quantile(q: float) -> float:
+        for bound, cumulative in buckets:
+            if cumulative >= q * count:
+                return bound
+        return math.inf
+
+    return {"samples": int(count), "mean": total / count, "p50": quantile(0.5), "p99": quantile(0.99), "max_bucket": quantile(1.0)}
+
+
+async def sse_request(client: httpx.AsyncClient, url: str, body: dict, sampler: Sampler) -> dict:
+    """发起一个 SSE 请求并读完：TTFB 记到第一个非排队事件"""
+    started = time.perf_counter()
+    sample = {"ok": False, "ttfb": None, "events": 0, "bytes": 0}
+    sampler.stream_started()
+    try:
+        async with client.stream("POST", url, json=body, headers=BYPASS) as response:
+            sample["status"] = response.status_code
+            if response.status_code != 200:
+                await response.aread()
+                return sample
+            done = False
+            async for line in response.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                payload = line[6:]
+                sample["bytes"] += len(line) + 2
+                if payload.startswith(QUEUE_PREFIXES):
+                    continue
+                if sample["ttfb"] is None:
+                    sample["ttfb"] = time.perf_counter() - started
+                if payload.startswith('{"error"'):
+                    sample["status"] = "error_event"
+                    return sample
+                sample["events"] += 1
+                if "[DONE]" in payload:
+                    done = True
+            sample["ok"] = done
+            if not done:
+                sample["status"] = "incomplete"
+    except httpx.HTTPError as e:
+        sample["status"] = type(e).__name__
+    finally:
+        sampler.stream_finished()
+        sample["latency"] = time.perf_counter() - started
+    return sample
+
+
+async def run_pool(concurrency: int, total: int, job) -> tuple:
+    """concurrency 个并发 worker 依次执行 job(i)，i 取 0..total-1；返回 (结果列表, 总耗时)"""
+    results = []
+    counter = iter(range(total))
+
+    async def worker():
+        for i in counter:
+            results.append(await job(i))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return results, time.perf_counter() - started
+
+
+async def measured(client: httpx.AsyncClient, sampler: Sampler, args, run) -> dict:
+    """执行一个场景，附带内存与事件循环延迟统计"""
+    rss_before = process_rss(sampler.pid)
+    lag_before = await scrape_lag(client)
+    sampler.start()
+    try:
+        result = await run()
+    finally:
+        await sampler.stop()
+    result["event_loop_lag"] = lag_delta(lag_before, await scrape_lag(client))
+    result["rss_before"] = rss_before
+    result["rss_peak"] = sampler.peak_rss
+    result["peak_streams"] = sampler.peak_active
+    if rss_before is not None and sampler.peak_rss is not None and sampler.peak_active:
+        result["memory_per_stream"] = max(0, sampler.peak_rss - rss_before) / sampler.peak_active
+    return result
+
+
+async def scenario_stream(client: httpx.AsyncClient, sampler: Sampler, args, run_id: str) -> dict:
+    async def job(i):
+        body = {"topic": f"{random.choice(TOPICS)} {run_id}-{i}", "mode": args.mode, "html_events": args.html_events}
+        return await sse_request(client, "/generate", body, sampler)
+
+    async def run():
+        samples, elapsed = await run_pool(args.concurrency, args.requests, job)
+        return summarize(samples, elapsed)
+
+    return await measured(client, sampler, args, run)
+
+
+async def scenario_model(client: httpx.AsyncClient, sampler: Sampler, args, run_id: str) -> dict:
+    async def job(i):
+        body = {"prompt": f"{random.choice(TOPICS)} 建模 {run_id}-{i}"}
+        return await sse_request(client, "/api/model/generate/stream", body, sampler)
+
+    async def run():
+        samples, elapsed = await run_pool(args.concurrency, args.requests, job)
+        return summarize(samples, elapsed)
+
+    return await measured(client, sampler, args, run)
+
+
+async def timed(samples: Dict[str, list], op: str, request) -> Optional[httpx.Response]:
+    started = time.perf_counter()
+    try:
+        response = await request
+    except httpx.HTTPError as e:
+        samples[op].append({"ok": False, "status": type(e).__name__, "latency": time.perf_counter() - started})
+        return None
+    samples[op].append({
+        "ok": response.status_code < 400,
+        "status": response.status_code,
+        "latency": time.perf_counter() - started,
+    })
+    return response
+
+
+def assistant_html(size: int, i: int) -> str:
+    body = "".join(f"<div class='step'>第 {n} 步 {random.choice(TOPICS)}</div>" for n in range(max(1, size // 48)))
+    return f"```html\n<!DOCTYPE html><html><head><title>演示 {i}</title></head><body>{body}</body></html>\n```"
+
+
+async def seed_chats(client: httpx.AsyncClient, args, run_id: str):
+    async def job(i):
+        chat = (await client.post("/api/chats", json={})).json()
+        await client.post(f"/api/chats/{chat['id']}/messages", json={"role": "user", "content": f"{TOPICS[i % len(TOPICS)]} seed {run_id} {i}"})
+        await client.post(f"/api/chats/{chat['id']}/messages", json={"role": "assistant", "content": assistant_html(args.html_size, i)})
+
+    await run_pool(args.concurrency, args.seed_chats, job)
+
+
+async def scenario_chats(client: httpx.AsyncClient, sampler: Sampler, args, run_id: str) -> dict:
+    """每个会话依次执行新建、追加两条消息、读取（摘要）、读取单条消息、分页列表、检索、重命名，一半会话最后删除"""
+    samples: Dict[str, list] = defaultdict(list)
+
+    async def session(i):
+        topic = TOPICS[i % len(TOPICS)]
+        response = await timed(samples, "create", client.post("/api/chats", json={}))
+        if response is None or response.status_code != 200:
+            return
+        chat_id = response.json()["id"]
+        await timed(samples, "append_user", client.post(
+            f"/api/chats/{chat_id}/messages", json={"role": "user", "content": f"{topic} {run_id} {i}"}
+        ))
+        await timed(samples, "append_assistant", client.post(
+            f"/api/chats/{chat_id}/messages", json={"role": "assistant", "content": assistant_html(args.html_size, i)}
+        ))
+        await timed(samples, "get_summary", client.get(f"/api/chats/{chat_id}", params={"summary": 1}))
+        await timed(samples, "get_message", client.get(f"/api/chats/{chat_id}/messages/1"))
+        await timed(samples, "list_page", client.get("/api/chats", params={"limit": 20}))
+        await timed(samples, "search", client.get("/api/chats", params={"q": topic, "limit": 20}))
+        await timed(samples, "rename", client.patch(f"/api/chats/{chat_id}", json={"title": f"{topic} {i}"}))
+        if i % 2:
+            await timed(samples, "delete", client.delete(f"/api/chats/{chat_id}"))
+
+    async def run():
+        _, elapsed = await run_pool(args.concurrency, args.chat_sessions, session)
+        all_samples = [s for op_samples in samples.values() for s in op_samples]
+        result = summarize(all_samples, elapsed)
+        result["ops"] = {op: summarize(op_samples, elapsed) for op, op_samples in samples.items()}
+        return result
+
+    if args.seed_chats:
+        await seed_chats(client, args, run_id)
+    return await measured(client, sampler, args, run)
+
+
+async def scenario_tts(client: httpx.AsyncClient, sampler: Sampler, args, run_id: str) -> dict:
+    texts = [f"第 {i} 段字幕：{random.choice(TOPICS)} {run_id}" for i in range(args.requests)]
+
+    async def job(i):
+        samples: Dict[str, list] = defaultdict(list)
+        response = await timed(samples, "tts", client.post("/api/tts/generate", json={"text": texts[i], "language": "zh"}))
+        sample = samples["tts"][0]
+        if response is not None and sample["ok"]:
+            sample["bytes"] = len(response.content)
+        return sample
+
+    async def run():
+        misses, miss_elapsed = await run_pool(args.concurrency, args.requests, job)
+        hits, hit_elapsed = await run_pool(args.concurrency, args.requests, job)
+        result = summarize(misses, miss_elapsed)
+        result["ops"] = {"miss": summarize(misses, miss_elapsed), "hit": summarize(hits, hit_elapsed)}
+        return result
+
+    return await measured(client, sampler, args, run)
+
+
+SCENARIOS = {
+    "stream": scenario_stream,
+    "model": scenario_model,
+    "chats": scenario_chats,
+    "tts": scenario_tts,
+}
+
+
+def ms(value: Optional[float]) -> str:
+    return f"{value * 1000:.1f}ms" if value is not None else "-"
+
+
+def format_line(name: str, result: dict) -> str:
+    parts = [
+        f"{name:<18}",
+        f"n={result['requests']:<5}",
+        f"err={sum(result['errors'].values()):<4}",
+        f"{result['throughput']:8.1f} req/s",
+        f"p50={ms(result['latency_p50']):>9}",
+        f"p99={ms(result['latency_p99']):>9}",
+    ]
+    if "ttfb_p50" in result:
+        parts.append(f"ttfb p50={ms(result['ttfb_p50'])} p99={ms(result['ttfb_p99'])}")
+    if "events_per_second" in result:
+        parts.append(f"{result['events_per_second']:.0f} events/s")
+    return "  ".join(parts)
+
+
+def print_report(results: dict, upstream: dict):
+    for name, result in results.items():
+        print(format_line(name, result))
+        for op, op_result in result.get("ops", {}).items():
+            print("  " + format_line(op, op_result))
+        if result["errors"]:
+            print(f"  errors: {result['errors']}")
+        lag = result["event_loop_lag"]
+        if lag.get("samples"):
+            print(
+                f"  event loop lag: mean={ms(lag['mean'])} p50<={ms(lag['p50'])} "
+                f"p99<={ms(lag['p99'])} max<={ms(lag['max_bucket'])} ({lag['samples']} samples)"
+            )
+        if result.get("rss_peak") is not None:
+            line = f"  memory: rss {result['rss_before'] / 2**20:.1f}MB -> peak {result['rss_peak'] / 2**20:.1f}MB"
+            if result.get("memory_per_stream") is not None:
+                line += f", {result['peak_streams']} concurrent streams, {result['memory_per_stream'] / 1024:.1f}KB per stream"
+            print(line)
+    print("upstream:", upstream)
+
+
+def parse_overrides(items: List[str]) -> dict:
+    overrides = {}
+    for item in items:
+        key, _, value = item.partition("=")
+        try:
+            overrides[key] = json.loads(value)
+        except json.JSONDecodeError:
+            overrides[key] = value
+    return overrides
+
+
+async def main_async(args) -> bool:
+    fake_port, app_port = free_port(), free_port()
+    token_interval = 1.0 / args.token_rate if args.token_rate > 0 else 0.0
+    fake = start_fake_process(fake_port, [
+        "--tokens", str(args.tokens),
+        "--token-interval", str(token_interval),
+        "--first-token-delay", str(args.first_token_delay),
+        "--fail-rate", str(args.fail_rate),
+        "--tts-latency", str(args.tts_latency),
+    ])
+    extra = {"TIMING_LOG": False}
+    if not args.keep_admission:
+        limit = max(args.concurrency, 1)
+        extra.update({
+            "LLM_MAX_CONCURRENCY": limit,
+            "LLM_MAX_PER_CLIENT": limit,
+            "LLM_QUEUE_SIZE": limit * 2,
+            "TTS_MAX_CONCURRENCY": limit,
+            "TTS_MAX_PER_CLIENT": limit,
+            "TTS_QUEUE_SIZE": limit * 2,
+        })
+    extra.update(parse_overrides(args.set))
+    workdir = tempfile.mkdtemp(prefix="chattutor-load-")
+    process = start_app(fake_port, app_port, workdir, extra, provider=args.provider)
+    base_url = f"http://127.0.0.1:{app_port}"
+    run_id = uuid.uuid4().hex[:8]
+    limits = httpx.Limits(max_connections=args.concurrency + 8, max_keepalive_connections=args.concurrency + 8)
+    try:
+        await wait_ready(f"http://127.0.0.1:{fake_port}", "/_stats")
+        await wait_ready(base_url)
+        sampler = Sampler(process.pid, args.sample_interval)
+        results = {}
+        async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+            # 预热：首次请求的导入与连接建立不计入结果
+            await sse_request(client, "/generate", {"topic": f"warmup {run_id}"}, Sampler(process.pid, 1))
+            for name in args.scenarios:
+                results[name] = await SCENARIOS[name](client, sampler, args, run_id)
+            async with httpx.AsyncClient() as fake_client:
+                upstream = (await fake_client.get(f"http://127.0.0.1:{fake_port}/_stats")).json()
+        print_report(results, upstream)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"args": vars(args), "results": results, "upstream": upstream}, f, ensure_ascii=False, indent=2)
+        return not any(result["errors"] for result in results.values())
+    finally:
+        stop_process(process)
+        stop_process(fake)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=20, help="并发客户端数")
+    parser.add_argument("--requests", type=int, default=100, help="stream / model / tts 场景的请求总数")
+    parser.add_argument("--mode", choices=["animation", "text"], default="animation")
+    parser.add_argument("--html-events", action="store_true", help="/generate 使用 html_* 事件")
+    parser.add_argument("--provider", choices=["openai", "gemini"], default="openai", help="主提供方接口类型")
+    parser.add_argument("--tokens", type=int, default=200, help="模拟模型每次输出的 token 数")
+    parser.add_argument("--token-rate", type=float, default=200.0, help="模拟模型每秒输出的 token 数，0 表示不限速")
+    parser.add_argument("--first-token-delay", type=float, default=0.2, help="模拟模型首 token 延迟（秒）")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="上游故障注入概率")
+    parser.add_argument("--tts-latency", type=float, default=0.1, help="模拟 TTS 延迟（秒）")
+    parser.add_argument("--chat-sessions", type=int, default=200, help="chats 场景的会话数（每个会话 8~9 个请求）")
+    parser.add_argument("--seed-chats", type=int, default=500, help="chats 场景开始前预置的对话数")
+    parser.add_argument("--html-size", type=int, default=20000, help="助手消息（HTML）的大致字节数")
+    parser.add_argument("--sample-interval", type=float, default=0.05, help="RSS 采样间隔（秒）")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--keep-admission", action="store_true", help="不放开准入控制的并发限制")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="额外写入 credentials.json 的配置")
+    parser.add_argument("--json", default="", help="结果另存为 JSON，便于对比回归")
+    args = parser.parse_args()
+    ok = asyncio.run(main_async(args))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+对话检索基准：随对话数量增长，比较倒排索引检索与原线性扫描的查询延迟
+
+    python benchmarks/bench_search.py                      # 1k / 10k / 100k 对话
+    python benchmarks/bench_search.py --sizes 1000 10000 --backend memory
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import MemoryStore, SQLiteStore  # noqa: E402
+
+TOPICS = ["二次函数", "牛顿第二定律", "光合作用", "勾股定理", "电磁感应", "细胞分裂", "化学平衡", "概率统计"]
+WORDS = ["python", "matrix", "vector", "energy", "history", "language", "music", "planet"]
+# 宽泛查询命中约 1/8 的对话，结果集随数据量线性增长
+BROAD_QUERIES = ["函数", "光合作用", "python", "电磁 energy"]
+# 选择性查询：每个关键词固定命中约 50 个对话，用于观察延迟是否随数据量保持平稳
+SELECTIVE_QUERIES = ["kw1", "kw7 python", "kw23", "不存在的词"]
+CHATS_PER_KEYWORD = 50
+
+
+def make_chat(i: int, size: int, html_size: int) -> dict:
+    rng = random.Random(i)
+    topic = rng.choice(TOPICS)
+    word = rng.choice(WORDS)
+    keyword = f"kw{i % max(size // CHATS_PER_KEYWORD, 1)}"
+    html = f"<html><style>body{{margin:0}}</style><p>{topic} {word}</p>" + "<div>x</div>" * (html_size // 12) + "</html>"
+    stamp = f"2024-01-01T00:00:{i:09d}"
+    return {
+        "id": f"chat-{i}",
+        "title": f"{topic} {i}",
+        "created_at": stamp,
+        "updated_at": stamp,
+        "project_id": None,
+        "messages": [
+            {"role": "user", "content": f"讲讲{topic}和 {word} {keyword}"},
+            {"role": "assistant", "content": html},
+        ],
+    }
+
+
+def linear_search(chats: dict, query: str) -> list:
+    """原 list_chats 的实现：每次查询对所有标题与消息做小写化子串匹配"""
+    query = query.lower()
+    result = []
+    for chat in chats.values():
+        if query in (chat["title"] or "").lower() or any(
+            query in (msg["content"] or "").lower() for msg in chat["messages"]
+        ):
+            result.append(chat["id"])
+    return result
+
+
+async def time_queries(search, queries: list, repeat: int) -> float:
+    """返回单次查询延迟的中位数（毫秒）"""
+    samples = []
+    for _ in range(repeat):
+        for query in queries:
+            start = time.perf_counter()
+            await search(query)
+            samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+async def bench_size(size: int, backend: str, html_size: int, repeat: int, legacy: bool):
+    chats = [make_chat(i, size, html_size) for i in range(size)]
+    row = {"chats": size}
+
+    if backend in ("memory", "all"):
+        store = MemoryStore()
+        for chat in chats:
+            await store.create_chat(chat)
+        search = lambda q: store.search_chats(q, limit=50)
+        row["memory_selective_ms"] = await time_queries(search, SELECTIVE_QUERIES, repeat)
+        row["memory_broad_ms"] = await time_queries(search, BROAD_QUERIES, repeat)
+        if legacy:
+            async def scan(q):
+                return linear_search(store.chats, q)
+            row["linear_scan_ms"] = await time_queries(scan, SELECTIVE_QUERIES, max(1, repeat // 5))
+
+    if backend in ("sqlite", "all"):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = SQLiteStore(os.path.join(tmp, "bench.db"))
+            await store.init()
+            try:
+                await store.import_snapshot({"chats": chats})
+                search = lambda q: store.search_chats(q, limit=50)
+                row["sqlite_selective_ms"] = await time_queries(search, SELECTIVE_QUERIES, repeat)
+                row["sqlite_broad_ms"] = await time_queries(search, BROAD_QUERIES, repeat)
+            finally:
+                await store.close()
+
+    print("  ".join(f"{k}={v:.3f}" if isinstance(v, float) else f"{k}={v}" for k, v in row.items()))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="对话全文检索基准")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--backend", choices=["memory", "sqlite", "all"], default="all")
+    parser.add_argument("--html-size", type=int, default=2000, help="每条助手回复的 HTML 字节数")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--no-legacy", action="store_true", help="跳过原线性扫描的对照测量")
+    args = parser.parse_args()
+    for size in args.sizes:
+        await bench_size(size, args.backend, args.html_size, args.repeat, not args.no_legacy)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,228 @@
+"""
+SSE 输出路径基准：以每核每秒处理的上游 token 数（events/sec per core）比较原实现与精简后的输出路径
+
+在当前进程中导入 app.py，用内存中的模拟 token 流驱动与 /generate 相同的链路：
+sse_token_events → admitted_stream → SingleFlight → relay_stream → sse_response（Starlette StreamingResponse），
+发送端只计数不写网络。CPU 时间取 time.process_time()，单进程单线程，即每核吞吐。
+
+  - legacy：原实现（每个 token json.dumps + f-string、llm_event_stream 逐帧转发、generate 中多一层 wrapped_stream）
+  - lean：逐 token 输出（SSE_BATCH_INTERVAL=0），标准库 / orjson 编码器
+  - batched：token 微批（默认 20ms 窗口），可选 gzip / br 压缩
+
+    python benchmarks/bench_sse.py
+    python benchmarks/bench_sse.py --tokens 20000 --streams 20 --burst 4 --html-events
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from harness import ROOT, prepare_workdir  # noqa: E402
+
+HEADERS = {
+    "Cache-Control": "no-store",
+    "Content-Type": "text/event-stream; charset=utf-8",
+    "X-Accel-Buffering": "no",
+}
+
+
+def load_app():
+    """在临时目录中准备配置后导入 app.py（不连接任何上游）"""
+    workdir = tempfile.mkdtemp(prefix="chattutor-sse-")
+    prepare_workdir(workdir, {
+        "API_KEY": "sk-fake",
+        "BASE_URL": "http://127.0.0.1:9/v1",
+        "MODEL": "fake-model",
+        "STORAGE_BACKEND": "memory",
+        "TIMING_LOG": False,
+        "EVENT_LOOP_LAG_INTERVAL": 0,
+        "LLM_MAX_CONCURRENCY": 1000,
+        "LLM_MAX_PER_CLIENT": 1000,
+    })
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    import app
+    return app
+
+
+def make_tokens(count: int, seed: int = 0) -> list:
+    """把一段带中文字幕的 HTML 切成 2~10 个字符的 token，接近模型的实际输出"""
+    rng = random.Random(seed)
+    page = (
+        "```html\n<!DOCTYPE html><html><head><style>body{margin:0;font-family:sans-serif}"
+        ".subtitle-text{position:fixed;bottom:20px}</style></head><body>"
+        + "".join(
+            f'<div class="step" data-i="{i}"><p class="subtitle-text">第{i}步：二次函数的顶点 "y=ax²+bx+c"</p>'
+            f"<svg><circle cx='{i}' cy='20' r='5'/></svg></div>\n"
+            for i in range(count // 8 + 1)
+        )
+        + "</body></html>\n```"
+    )
+    tokens, position = [], 0
+    while len(tokens) < count and position < len(page):
+        size = rng.randint(2, 10)
+        tokens.append(page[position:position + size])
+        position += size
+    return tokens
+
+
+async def upstream(tokens: list, burst: int):
+    """模拟上游：每 burst 个 token 让出一次事件循环（相当于一次网络读取）"""
+    for i, token in enumerate(tokens):
+        yield token
+        if (i + 1) % burst == 0:
+            await asyncio.sleep(0)
+
+
+async def legacy_token_events(tokens, extractor):
+    async for token in tokens:
+        if extractor is None:
+            yield f"data: {json.dumps({'token': token}, ensure_ascii=False)}\n\n"
+            continue
+        for name, data in extractor.feed(token):
+            yield f"data: {json.dumps({'event': name, **data}, ensure_ascii=False)}\n\n"
+    if extractor is not None:
+        for name, data in extractor.finish():
+            yield f"data: {json.dumps({'event': name, **data}, ensure_ascii=False)}\n\n"
+    yield 'data: {"event":"[DONE]"}\n\n'
+
+
+async def legacy_llm_event_stream(tokens, extractor):
+    async for frame in legacy_token_events(tokens, extractor):
+        yield frame
+
+
+class BenchRequest:
+    def __init__(self, accept_encoding: str):
+        self.headers = {"accept-encoding": accept_encoding}
+
+    async def is_disconnected(self) -> bool:
+        return False
+
+
+async def run_stream(app, variant: dict, tokens: list, args) -> dict:
+    from html_stream import HtmlStreamExtractor
+    from singleflight import SingleFlight
+
+    extractor = HtmlStreamExtractor() if args.html_events else None
+    source = upstream(tokens, args.burst)
+    if variant["legacy"]:
+        def frames():
+            return legacy_llm_event_stream(source, extractor)
+    else:
+        def frames():
+            timing = app.GenerationTiming("generate", "animation")
+            return app.sse_token_events(source, extractor, "error", timing)
+
+    request = BenchRequest(variant.get("accept_encoding", ""))
+    shared = SingleFlight().stream(
+        "bench",
+        lambda: app.admitted_stream(app.llm_scheduler, "bench", "animation", frames),
+        share=False,
+    )
+    body = app.relay_stream(shared, request)
+    if variant["legacy"]:
+        relayed = body
+
+        async def wrapped_stream():
+            async for chunk in relayed:
+                yield chunk
+
+        body = wrapped_stream()
+    response = app.sse_response(body, request, dict(HEADERS))
+
+    counts = {"frames": 0, "bytes": 0}
+    never = asyncio.Event()
+
+    async def receive():
+        await never.wait()
+
+    async def send(message):
+        if message["type"] == "http.response.body" and message.get("body"):
+            counts["frames"] += 1
+            counts["bytes"] += len(message["body"])
+
+    scope = {"type": "http", "asgi": {"spec_version": "2.3"}, "method": "POST", "headers": []}
+    await response(scope, receive, send)
+    return counts
+
+
+async def run_variant(app, variant: dict, tokens: list, args) -> dict:
+    import sse
+
+    app.SSE_BATCH_INTERVAL = variant.get("batch", 0.0)
+    app.SSE_COMPRESSION = bool(variant.get("accept_encoding"))
+    sse.set_json_encoder(variant.get("encoder", "json"))
+    # 预热一次
+    await run_stream(app, variant, tokens[: len(tokens) // 10 or 1], args)
+    cpu_started, wall_started = time.process_time(), time.perf_counter()
+    results = await asyncio.gather(*(run_stream(app, variant, tokens, args) for _ in range(args.streams)))
+    cpu = time.process_time() - cpu_started
+    wall = time.perf_counter() - wall_started
+    total_tokens = len(tokens) * args.streams
+    return {
+        "events_per_core_second": total_tokens / cpu if cpu > 0 else 0.0,
+        "cpu": cpu,
+        "wall": wall,
+        "frames": sum(r["frames"] for r in results),
+        "bytes": sum(r["bytes"] for r in results),
+        "tokens": total_tokens,
+    }
+
+
+def build_variants(args) -> list:
+    import sse
+
+    variants = [
+        {"name": "legacy", "legacy": True},
+        {"name": "lean/json", "legacy": False, "encoder": "json"},
+    ]
+    if "orjson" in sse.JSON_ENCODERS:
+        variants.append({"name": "lean/orjson", "legacy": False, "encoder": "orjson"})
+    encoder = "orjson" if "orjson" in sse.JSON_ENCODERS else "json"
+    variants.append({"name": f"batched/{encoder}", "legacy": False, "encoder": encoder, "batch": args.batch})
+    for encoding in sse.supported_encodings():
+        variants.append({
+            "name": f"batched/{encoding}",
+            "legacy": False,
+            "encoder": encoder,
+            "batch": args.batch,
+            "accept_encoding": encoding,
+        })
+    return variants
+
+
+async def main_async(args):
+    app = load_app()
+    tokens = make_tokens(args.tokens)
+    baseline = None
+    print(f"{len(tokens)} tokens x {args.streams} streams, burst={args.burst}, html_events={args.html_events}")
+    for variant in build_variants(args):
+        result = await run_variant(app, variant, tokens, args)
+        baseline = baseline or result["events_per_core_second"]
+        print(
+            f"{variant['name']:<16} {result['events_per_core_second']:>10.0f} events/s/core"
+            f"  x{result['events_per_core_second'] / baseline:4.2f}"
+            f"  cpu={result['cpu']:.3f}s  frames={result['frames']:<7} bytes={result['bytes']}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, default=10000, help="每个流的 token 数")
+    parser.add_argument("--streams", type=int, default=10, help="并发流数")
+    parser.add_argument("--burst", type=int, default=4, help="每次让出事件循环前到达的 token 数")
+    parser.add_argument("--batch", type=float, default=0.02, help="微批窗口（秒）")
+    parser.add_argument("--html-events", action="store_true", help="走 HTML 提取事件路径")
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
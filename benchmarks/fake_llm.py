@@ -0,0 +1,273 @@
+"""
+本地模拟的上游接口，用于基准测试、压测与断开取消验证，不调用真实模型：
+  - OpenAI 兼容接口：POST /v1/chat/completions（流式与非流式）
+  - Gemini 接口：POST /v1beta/models/{model}:streamGenerateContent?alt=sse 与 :generateContent
+    （ChatTutor 主提供方为 Gemini 时，设置环境变量 GOOGLE_GEMINI_BASE_URL 指向本服务）
+  - DashScope TTS：POST /api/v1/services/audio/tts/generation，返回 base64 音频
+    （Base_TTS_URL 设为 http://host:port/compatible-mode/v1）
+
+token 速率、首 token 延迟、TTS 延迟与故障注入（按概率返回错误状态码）对所有接口生效
+
+前缀缓存（粗略模拟，按 2 个字符 1 个 token 计）：OpenAI 兼容接口在请求 stream_options.include_usage 时
+返回 usage，系统提示词此前出现过则计为 cached_tokens；Gemini 支持 POST /v1beta/cachedContents，
+引用 cachedContent 的请求把其中的系统提示词计为 cachedContentTokenCount
+
+    python benchmarks/fake_llm.py --port 9100 --tokens 400 --token-interval 0.02
+    python benchmarks/fake_llm.py --token-rate 100 --first-token-delay 0.5 --fail-rate 0.05
+
+GET /_stats 返回计数：请求数、进行中的流、正常结束 / 中途被断开的流、已发送 token 数、TTS 请求数、
+输入 / 命中缓存的 token 数、创建的 cached content 数
+"""
+import argparse
+import asyncio
+import base64
+import json
+import random
+import time
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+HTML_PREFIX = "```html\n<!DOCTYPE html><html><head><title>Fake</title></head><body>"
+HTML_SUFFIX = "</body></html>\n```"
+
+
+class FakeLLM:
+    def __init__(
+        self,
+        tokens: int = 200,
+        token_interval: float = 0.02,
+        first_token_delay: float = 0.0,
+        fail_rate: float = 0.0,
+        fail_status: int = 500,
+        tts_latency: float = 0.2,
+        tts_bytes: int = 16384,
+    ):
+        self.tokens = tokens
+        self.token_interval = token_interval
+        self.first_token_delay = first_token_delay
+        # 按概率直接返回错误状态码，用于验证重试与故障转移
+        self.fail_rate = fail_rate
+        self.fail_status = fail_status
+        self.tts_latency = tts_latency
+        self.tts_audio = base64.b64encode(bytes(i % 251 for i in range(tts_bytes))).decode()
+        self.reset()
+        self.app = Starlette(routes=[
+            Route("/v1/chat/completions", self.chat_completions, methods=["POST"]),
+            Route("/chat/completions", self.chat_completions, methods=["POST"]),
+            Route("/v1beta/models/{action:path}", self.gemini, methods=["POST"]),
+            Route("/v1beta/cachedContents", self.create_cached_content, methods=["POST"]),
+            Route("/api/v1/services/audio/tts/generation", self.tts, methods=["POST"]),
+            Route("/_stats", self.get_stats, methods=["GET"]),
+        ])
+
+    def reset(self):
+        self.stats = {
+            "requests": 0,
+            "failed": 0,
+            "active": 0,
+            "completed": 0,
+            "aborted": 0,
+            "tokens_sent": 0,
+            "tts_requests": 0,
+            "prompt_tokens": 0,
+            "cached_tokens": 0,
+            "cached_contents": 0,
+        }
+        self.seen_prefixes = set()
+        self.cached_contents = {}
+        # 最近一次流被断开的时间（time.monotonic()）
+        self.last_abort_at = None
+
+    def token_text(self, i: int) -> str:
+        if i == 0:
+            return HTML_PREFIX
+        if i == self.tokens - 1:
+            return HTML_SUFFIX
+        return f"<p>token {i}</p>"
+
+    def chunk(self, model: str, content: str, finish_reason=None) -> str:
+        data = {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": finish_reason}],
+        }
+        return f"data: {json.dumps(data)}\n\n"
+
+    def gemini_chunk(self, content: str, finish_reason=None) -> dict:
+        candidate = {"content": {"parts": [{"text": content}], "role": "model"}, "index": 0}
+        if finish_reason:
+            candidate["finishReason"] = finish_reason
+        return {"candidates": [candidate]}
+
+    def usage(self, prompt: str, cached_prefix: str = "") -> tuple:
+        """(输入 token 数, 命中缓存的 token 数)"""
+        prompt_tokens = (len(prompt) + len(cached_prefix)) // 2
+        cached_tokens = len(cached_prefix) // 2
+        self.stats["prompt_tokens"] += prompt_tokens
+        self.stats["cached_tokens"] += cached_tokens
+        return prompt_tokens, cached_tokens
+
+    def openai_usage(self, body: dict) -> tuple:
+        messages = body.get("messages") or []
+        system = messages[0]["content"] if messages and messages[0].get("role") == "system" else ""
+        rest = "".join(str(message.get("content", "")) for message in messages[1 if system else 0:])
+        seen = system in self.seen_prefixes
+        self.seen_prefixes.add(system)
+        prompt_tokens, cached_tokens = self.usage(rest + ("" if seen else system), system if seen else "")
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": self.tokens,
+            "total_tokens": prompt_tokens + self.tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+        }
+
+    def gemini_usage(self, body: dict) -> dict:
+        text = "".join(
+            part.get("text", "") for content in body.get("contents") or [] for part in content.get("parts") or []
+        )
+        prompt_tokens, cached_tokens = self.usage(text, self.cached_contents.get(body.get("cachedContent"), ""))
+        return {
+            "promptTokenCount": prompt_tokens,
+            "cachedContentTokenCount": cached_tokens,
+            "candidatesTokenCount": self.tokens,
+            "totalTokenCount": prompt_tokens + self.tokens,
+        }
+
+    async def create_cached_content(self, request: Request):
+        body = await request.json()
+        instruction = "".join(part.get("text", "") for part in (body.get("systemInstruction") or {}).get("parts") or [])
+        self.stats["cached_contents"] += 1
+        name = f"cachedContents/fake-{self.stats['cached_contents']}"
+        self.cached_contents[name] = instruction
+        return JSONResponse({"name": name, "model": body.get("model", ""), "displayName": body.get("displayName", "")})
+
+    def injected_failure(self):
+        """按 fail_rate 注入故障，返回错误响应或 None"""
+        if self.fail_rate and random.random() < self.fail_rate:
+            self.stats["failed"] += 1
+            return JSONResponse(
+                {"error": {"code": self.fail_status, "message": "injected failure", "type": "server_error"}},
+                status_code=self.fail_status,
+            )
+        return None
+
+    async def full_text(self) -> str:
+        await asyncio.sleep(self.first_token_delay + self.token_interval * self.tokens)
+        self.stats["tokens_sent"] += self.tokens
+        self.stats["completed"] += 1
+        return "".join(self.token_text(i) for i in range(self.tokens))
+
+    async def chat_completions(self, request: Request):
+        body = await request.json()
+        model = body.get("model", "fake")
+        self.stats["requests"] += 1
+        failure = self.injected_failure()
+        if failure is not None:
+            return failure
+        if not body.get("stream"):
+            text = await self.full_text()
+            return JSONResponse({
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": self.openai_usage(body),
+            })
+        usage = self.openai_usage(body) if (body.get("stream_options") or {}).get("include_usage") else None
+        return StreamingResponse(self.stream(model, usage=usage), media_type="text/event-stream")
+
+    async def gemini(self, request: Request):
+        # 路径形如 {model}:streamGenerateContent 或 {model}:generateContent
+        action = request.path_params["action"].rsplit(":", 1)[-1]
+        self.stats["requests"] += 1
+        failure = self.injected_failure()
+        if failure is not None:
+            return failure
+        usage = self.gemini_usage(await request.json())
+        if action == "generateContent":
+            return JSONResponse({**self.gemini_chunk(await self.full_text(), "STOP"), "usageMetadata": usage})
+        if action != "streamGenerateContent":
+            return JSONResponse({"error": {"code": 404, "message": f"unknown action {action}"}}, status_code=404)
+        return StreamingResponse(self.stream("", gemini=True, usage=usage), media_type="text/event-stream")
+
+    async def tts(self, request: Request):
+        await request.json()
+        self.stats["tts_requests"] += 1
+        failure = self.injected_failure()
+        if failure is not None:
+            return failure
+        await asyncio.sleep(self.tts_latency)
+        return JSONResponse({"output": {"audio": self.tts_audio}, "request_id": "fake"})
+
+    async def stream(self, model: str, gemini: bool = False, usage: dict = None):
+        self.stats["active"] += 1
+        finished = False
+        try:
+            await asyncio.sleep(self.first_token_delay)
+            for i in range(self.tokens):
+                if gemini:
+                    yield f"data: {json.dumps(self.gemini_chunk(self.token_text(i)))}\r\n\r\n"
+                else:
+                    yield self.chunk(model, self.token_text(i))
+                self.stats["tokens_sent"] += 1
+                await asyncio.sleep(self.token_interval)
+            if gemini:
+                last = self.gemini_chunk('', 'STOP')
+                if usage:
+                    last["usageMetadata"] = usage
+                yield f"data: {json.dumps(last)}\r\n\r\n"
+            else:
+                yield self.chunk(model, "", "stop")
+                if usage:
+                    yield f"data: {json.dumps({'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model, 'choices': [], 'usage': usage})}\n\n"
+                yield "data: [DONE]\n\n"
+            finished = True
+        finally:
+            self.stats["active"] -= 1
+            if finished:
+                self.stats["completed"] += 1
+            else:
+                # 客户端（即被测服务）关闭了连接
+                self.stats["aborted"] += 1
+                self.last_abort_at = time.monotonic()
+
+    async def get_stats(self, request: Request):
+        return JSONResponse(self.stats)
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--tokens", type=int, default=200)
+    parser.add_argument("--token-interval", type=float, default=0.02)
+    parser.add_argument("--token-rate", type=float, default=0.0, help="每秒 token 数，指定时覆盖 --token-interval")
+    parser.add_argument("--first-token-delay", type=float, default=0.0)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--fail-status", type=int, default=500)
+    parser.add_argument("--tts-latency", type=float, default=0.2)
+    parser.add_argument("--tts-bytes", type=int, default=16384, help="每段模拟音频的字节数")
+    args = parser.parse_args()
+    token_interval = 1.0 / args.token_rate if args.token_rate > 0 else args.token_interval
+    fake = FakeLLM(
+        args.tokens,
+        token_interval,
+        args.first_token_delay,
+        args.fail_rate,
+        args.fail_status,
+        args.tts_latency,
+        args.tts_bytes,
+    )
+    uvicorn.run(fake.app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
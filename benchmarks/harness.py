@@ -0,0 +1,148 @@
+"""
+基准与压测脚本共用的启动工具：空闲端口、进程内 / 子进程模拟上游（fake_llm.py）、指向模拟上游的 ChatTutor 实例
+"""
+import asyncio
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict, Optional
+
+import httpx
+
+from fake_llm import FakeLLM
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+
+# ASGI spec_version >= 2.4 时 Starlette 不再并发监听 http.disconnect，只能靠应用自己检测断开
+SPEC_WRAPPER = """
+import sys, uvicorn
+from app import app
+async def wrapped(scope, receive, send):
+    if scope["type"] == "http":
+        scope = dict(scope, asgi=dict(scope.get("asgi", {}), spec_version=sys.argv[2]))
+    await app(scope, receive, send)
+uvicorn.run(wrapped, host="127.0.0.1", port=int(sys.argv[1]), log_level="warning")
+"""
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def start_fake(fake: FakeLLM, port: int):
+    """在当前事件循环中运行模拟上游，便于直接读取 fake.stats"""
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(fake.app, host="127.0.0.1", port=port, log_level="warning"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    return server, task
+
+
+def start_fake_process(port: int, args: list) -> subprocess.Popen:
+    """在独立进程中运行模拟上游（压测时不与客户端争抢 CPU），计数通过 GET /_stats 读取"""
+    command = [sys.executable, os.path.join(BENCHMARKS, "fake_llm.py"), "--port", str(port), *args]
+    return subprocess.Popen(command)
+
+
+def prepare_workdir(workdir: str, credentials: dict):
+    """写入 credentials.json 并链接 templates / static，使 app.py 可以在 workdir 中导入"""
+    with open(os.path.join(workdir, "credentials.json"), "w") as f:
+        json.dump(credentials, f)
+    for name in ("templates", "static"):
+        link = os.path.join(workdir, name)
+        if not os.path.exists(link):
+            os.symlink(os.path.join(ROOT, name), link)
+
+
+def start_app(
+    fake_port: int,
+    port: int,
+    workdir: str,
+    extra: dict,
+    asgi_spec: str = "",
+    provider: str = "openai",
+) -> subprocess.Popen:
+    """
+    在 workdir 中写入 credentials.json 并启动 ChatTutor；provider 为 "gemini" 时主提供方走 Gemini 接口
+    （通过 GOOGLE_GEMINI_BASE_URL 指向模拟上游），TTS 始终指向模拟上游
+    """
+    fake_url = f"http://127.0.0.1:{fake_port}"
+    credentials = {
+        "API_KEY": "sk-fake" if provider == "openai" else "fake-gemini-key",
+        "BASE_URL": f"{fake_url}/v1",
+        "MODEL": "fake-model",
+        "STORAGE_BACKEND": "memory",
+        "QWEN_TTS_API_KEY": "fake-tts-key",
+        "Base_TTS_URL": f"{fake_url}/compatible-mode/v1",
+        **extra,
+    }
+    prepare_workdir(workdir, credentials)
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    if provider == "gemini":
+        env["GOOGLE_GEMINI_BASE_URL"] = fake_url
+    if asgi_spec:
+        command = [sys.executable, "-c", SPEC_WRAPPER, str(port), asgi_spec]
+    else:
+        command = [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"]
+    return subprocess.Popen(command, cwd=workdir, env=env)
+
+
+def stop_process(process: subprocess.Popen, timeout: float = 10.0):
+    process.terminate()
+    try:
+        process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        # 仍有未取消的上游流时服务可能无法正常退出
+        process.kill()
+        process.wait()
+
+
+async def wait_ready(base_url: str, path: str = "/api/cache/stats", timeout: float = 30.0):
+    url = base_url + path
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get(url)).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"服务启动超时：{url}")
+
+
+def process_rss(pid: int) -> Optional[int]:
+    """进程当前常驻内存（字节），仅 Linux 可用"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+_SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})?\s+(\S+)$')
+
+
+def parse_metrics(text: str) -> Dict[str, float]:
+    """把 Prometheus 文本格式解析为 {"name{labels}": value}"""
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        match = _SAMPLE.match(line)
+        if match:
+            name, labels, value = match.groups()
+            samples[name + (labels or "")] = float(value)
+    return samples
@@ -0,0 +1,207 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Optional, Union
+
+CacheValue = Union[str, bytes]
+
+
+def make_cache_key(*parts) -> str:
+    """
+    根据任意可 JSON 序列化的字段生成内容寻址的缓存键（sha256 十六进制）
+    """
+    raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def normalize_text(text: str) -> str:
+    """
+    规范化用户输入：去首尾空白、折叠连续空白、英文统一小写
+    """
+    return " ".join((text or "").split()).lower()
+
+
+def history_digest(history) -> str:
+    """
+    对历史消息求摘要，空历史返回空字符串
+    """
+    if not history:
+        return ""
+    return make_cache_key(history)
+
+
+class ResponseCache:
+    """
+    LRU + TTL 内存缓存，可选共享层（多 worker 共享）与磁盘层（重启后仍可命中）
+
+    - 内存层按条目数上限（以及可选的总字节数上限）做 LRU 淘汰
+    - 共享层为 shared_state.SharedState，查找顺序：内存 -> 共享 -> 磁盘
+    - 磁盘层每个键一个文件，按文件修改时间判断过期
+    - 所有内存操作都在事件循环内同步完成，无需额外加锁；磁盘读写放到线程中执行
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_entries: int = 256,
+        ttl: float = 3600.0,
+        disk_dir: Optional[str] = None,
+        binary: bool = False,
+        max_bytes: int = 0,
+        shared=None,
+    ):
+        self.name = name
+        self.max_entries = max(1, int(max_entries))
+        self.max_bytes = max(0, int(max_bytes))
+        self.total_bytes = 0
+        self.ttl = float(ttl)
+        self.disk_dir = disk_dir
+        self.binary = binary
+        self.shared = shared
+        self._entries: "OrderedDict[str, tuple[float, CacheValue]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.shared_hits = 0
+        self.bypasses = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    # ---------------- 内存层 ----------------
+    def _expired(self, created_at: float) -> bool:
+        return self.ttl > 0 and time.time() - created_at > self.ttl
+
+    def _get_memory(self, key: str) -> Optional[CacheValue]:
+        item = self._entries.get(key)
+        if item is None:
+            return None
+        created_at, value = item
+        if self._expired(created_at):
+            self._pop_memory(key)
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _pop_memory(self, key: str):
+        item = self._entries.pop(key, None)
+        if item is not None:
+            self.total_bytes -= len(item[1])
+
+    def _set_memory(self, key: str, value: CacheValue, created_at: Optional[float] = None):
+        if self.max_bytes and len(value) > self.max_bytes:
+            return
+        self._pop_memory(key)
+        self._entries[key] = (created_at or time.time(), value)
+        self.total_bytes += len(value)
+        while len(self._entries) > self.max_entries or (
+            self.max_bytes and self.total_bytes > self.max_bytes
+        ):
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self.total_bytes -= len(evicted)
+
+    # ---------------- 磁盘层 ----------------
+    def _path(self, key: str) -> str:
+        ext = ".bin" if self.binary else ".txt"
+        return os.path.join(self.disk_dir, key + ext)
+
+    def _read_disk(self, key: str) -> Optional[tuple[float, CacheValue]]:
+        path = self._path(key)
+        try:
+            created_at = os.path.getmtime(path)
+            if self._expired(created_at):
+                os.remove(path)
+                return None
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        return created_at, data if self.binary else data.decode("utf-8")
+
+    def _write_disk(self, key: str, value: CacheValue):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        data = value if isinstance(value, bytes) else value.encode("utf-8")
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def _delete_disk(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    # ---------------- 共享层 ----------------
+    def _shared_key(self, key: str) -> str:
+        return f"cache:{self.name}:{key}"
+
+    # ---------------- 对外接口 ----------------
+    async def get(self, key: str) -> Optional[CacheValue]:
+        value = self._get_memory(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        if self.shared is not None:
+            data = await self.shared.get(self._shared_key(key))
+            if data is not None:
+                value = data if self.binary else data.decode("utf-8")
+                self._set_memory(key, value)
+                self.hits += 1
+                self.shared_hits += 1
+                return value
+        if self.disk_dir:
+            item = await asyncio.to_thread(self._read_disk, key)
+            if item is not None:
+                created_at, value = item
+                self._set_memory(key, value, created_at)
+                self.hits += 1
+                self.disk_hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, value: CacheValue):
+        self._set_memory(key, value)
+        if self.shared is not None:
+            data = value if isinstance(value, bytes) else value.encode("utf-8")
+            await self.shared.set(self._shared_key(key), data, self.ttl if self.ttl > 0 else 24 * 3600)
+        if self.disk_dir:
+            await asyncio.to_thread(self._write_disk, key, value)
+
+    async def delete(self, key: str):
+        self._pop_memory(key)
+        if self.shared is not None:
+            await self.shared.delete(self._shared_key(key))
+        if self.disk_dir:
+            await asyncio.to_thread(self._delete_disk, key)
+
+    def record_bypass(self):
+        self.bypasses += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "name": self.name,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "shared": self.shared is not None,
+            "disk": bool(self.disk_dir),
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "bypasses": self.bypasses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
@@ -0,0 +1,143 @@
+import math
+import re
+from typing import List
+
+from cache import normalize_text
+from search_index import strip_markup
+
+# -----------------------------------------------------------------------
+# 对话上下文窗口
+#
+# /generate 的历史消息在送入模型前按 token 预算裁剪：
+#   - 之前生成的 HTML 动画替换为简短描述（标题、标题栏、字幕要点），
+#     最近一次的 HTML 在预算允许时保留原文，便于"在上一版基础上修改"
+#   - 过长的文字回复截断
+#   - 从最新消息往前保留，超出预算的更早消息合并为一条摘要
+# token 数按字符粗略估算，无需调用分词器
+# -----------------------------------------------------------------------
+
+_CJK_RE = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]")
+_ARTIFACT_RE = re.compile(r"<(?:!doctype|html|body|svg|canvas|script)\b", re.IGNORECASE)
+_TITLE_RE = re.compile(r"<title[^>]*>([\s\S]*?)</title>", re.IGNORECASE)
+_HEADING_RE = re.compile(r"<h[1-3][^>]*>([\s\S]*?)</h[1-3]>", re.IGNORECASE)
+_SUBTITLE_RE = re.compile(
+    r"<(\w+)[^>]*(?:class=[\"'][^\"']*subtitle-text[^\"']*[\"']|id=[\"']subtitle[\"'])[^>]*>([\s\S]*?)</\1>",
+    re.IGNORECASE,
+)
+
+# 每条消息固定的格式开销（角色标记等）
+MESSAGE_OVERHEAD_TOKENS = 4
+DESCRIPTION_MAX_CHARS = 200
+
+
+def estimate_tokens(text: str) -> int:
+    """中文约 1 字 1 token，其余约 4 字符 1 token"""
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def is_html_artifact(content: str) -> bool:
+    return bool(content) and _ARTIFACT_RE.search(content) is not None
+
+
+def _clean(fragment: str) -> str:
+    return " ".join(strip_markup(fragment).split())
+
+
+def describe_artifact(content: str) -> str:
+    """把生成的 HTML 替换为一行描述"""
+    parts = []
+    title = _TITLE_RE.search(content)
+    if title and _clean(title.group(1)):
+        parts.append(f"标题：{_clean(title.group(1))}")
+    points = [_clean(m.group(1)) for m in _HEADING_RE.finditer(content)]
+    points += [_clean(m.group(2)) for m in _SUBTITLE_RE.finditer(content)]
+    points = [p for p in dict.fromkeys(points) if p][:4]
+    if points:
+        parts.append("要点：" + " / ".join(points))
+    description = f"[此前生成的动画 HTML（约 {len(content)} 字符）已省略"
+    if parts:
+        description += "，" + "；".join(parts)
+    if len(description) > DESCRIPTION_MAX_CHARS - 1:
+        description = description[:DESCRIPTION_MAX_CHARS - 2] + "…"
+    return description + "]"
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    # 按比例估算截断位置，再逐步收缩
+    end = max(int(len(text) * max_tokens / estimate_tokens(text)), 1)
+    while end > 1 and estimate_tokens(text[:end]) > max_tokens:
+        end = int(end * 0.9)
+    return text[:end] + "…（已截断）"
+
+
+def summarize_dropped(messages: List[dict]) -> str:
+    topics = [
+        " ".join((msg.get("content") or "").split())[:30]
+        for msg in messages
+        if msg.get("role") == "user" and (msg.get("content") or "").strip()
+    ]
+    summary = f"（更早的 {len(messages)} 条对话已省略"
+    if topics:
+        summary += "，用户曾提到：" + "；".join(topics[-5:])
+    return summary + "）"
+
+
+def build_history(
+    messages: List[dict],
+    topic: str,
+    token_budget: int,
+    keep_latest_artifact: bool = True,
+) -> List[dict]:
+    """
+    把存储的对话消息整理为送入模型的历史：[{"role", "content"}]
+    末尾与本次 topic 相同的用户消息会被去掉（本次提问由调用方单独拼接）
+    """
+    history = [
+        {"role": msg["role"], "content": msg.get("content") or ""}
+        for msg in messages or []
+        if isinstance(msg, dict) and msg.get("role") in ("user", "assistant")
+    ]
+    if history and history[-1]["role"] == "user" and normalize_text(history[-1]["content"]) == normalize_text(topic):
+        history.pop()
+    if not history or token_budget <= 0:
+        return []
+
+    latest_artifact = None
+    if keep_latest_artifact:
+        for i in range(len(history) - 1, -1, -1):
+            if history[i]["role"] == "assistant" and is_html_artifact(history[i]["content"]):
+                latest_artifact = i
+                break
+
+    # 单条文字消息最多占预算的 1/4
+    message_max_tokens = max(token_budget // 4, 1)
+    kept: List[dict] = []
+    used = 0
+    cut = 0
+    for i in range(len(history) - 1, -1, -1):
+        msg = history[i]
+        content = msg["content"]
+        artifact = msg["role"] == "assistant" and is_html_artifact(content)
+        if artifact and i != latest_artifact:
+            content = describe_artifact(content)
+        elif not artifact:
+            content = truncate_to_tokens(content, message_max_tokens)
+        cost = estimate_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+        if artifact and i == latest_artifact and used + cost > token_budget:
+            # 最近一次的 HTML 放不下时同样退化为描述
+            content = describe_artifact(content)
+            cost = estimate_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+        if used + cost > token_budget:
+            cut = i + 1
+            break
+        kept.append({"role": msg["role"], "content": content})
+        used += cost
+    kept.reverse()
+    if cut:
+        kept.insert(0, {"role": "system", "content": summarize_dropped(history[:cut])})
+    return kept
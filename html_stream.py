@@ -0,0 +1,133 @@
+import re
+from typing import List, Tuple
+
+# -----------------------------------------------------------------------
+# 流式 HTML 提取
+#
+# 模型输出形如 "说明文字 ```html\n<!DOCTYPE html>...</html>\n``` 说明文字"，
+# 也可能不带代码块直接输出 <!DOCTYPE html> / <html>。
+# 提取器逐个 token 喂入，实时产生事件：
+#   ("html_start", {"source": "fence" | "tag"})
+#   ("html_chunk", {"html": 片段})            HTML 正文增量，拼接即为完整 HTML
+#   ("html_body", {"offset": n})              <body ...> 标签结束位置，html[:n] 即可渲染的页面骨架
+#   ("html_done", {"length": n, "complete": bool})
+# 跨 token 的标记（```、html 语言标识、<html、</html>）通过保留末尾少量字符处理
+# -----------------------------------------------------------------------
+
+Event = Tuple[str, dict]
+
+FENCE = "```"
+_OPEN_FENCE_RE = re.compile(r"```[ \t]*(?:html|HTML)?[ \t]*\r?\n?")
+_TAG_START_RE = re.compile(r"<!doctype\s+html|<html[\s>]", re.IGNORECASE)
+_BODY_RE = re.compile(r"<body[^>]*>", re.IGNORECASE)
+_HTML_END = "</html>"
+
+# 查找起始标记时最多保留的末尾字符数（"```html\r\n"、"<!doctype html"）
+_START_HOLDBACK = 16
+
+
+class HtmlStreamExtractor:
+    def __init__(self):
+        self._state = "before"  # before -> inside -> after
+        self._source = None
+        self._pending = ""      # 尚未确定归属的末尾字符
+        self._length = 0        # 已输出的 HTML 字符数
+        self._tail = ""         # 已输出 HTML 的末尾若干字符，用于跨 chunk 查找 <body> / </html>
+        self._body_seen = False
+
+    @property
+    def started(self) -> bool:
+        return self._state != "before"
+
+    def feed(self, token: str) -> List[Event]:
+        if self._state == "after" or not token:
+            return []
+        self._pending += token
+        events: List[Event] = []
+        if self._state == "before":
+            self._find_start(events)
+        if self._state == "inside":
+            self._consume(events, final=False)
+        return events
+
+    def finish(self) -> List[Event]:
+        """流结束时调用：输出保留的字符，未闭合的 HTML 以 complete=False 结束"""
+        events: List[Event] = []
+        if self._state == "inside":
+            self._consume(events, final=True)
+            if self._state == "inside":
+                self._done(events, complete=False)
+        self._pending = ""
+        return events
+
+    # ---------------- 内部 ----------------
+    def _find_start(self, events: List[Event]):
+        text = self._pending
+        fence = text.find(FENCE)
+        tag = _TAG_START_RE.search(text)
+        if fence != -1 and (tag is None or fence < tag.start()):
+            # 语言标识与换行可能还没到齐
+            after = text[fence + len(FENCE):]
+            if "\n" not in after and len(after) < _START_HOLDBACK:
+                return
+            opening = _OPEN_FENCE_RE.match(text, fence)
+            self._begin(events, "fence", text[opening.end():])
+            return
+        if tag is not None:
+            self._begin(events, "tag", text[tag.start():])
+            return
+        self._pending = text[-_START_HOLDBACK:]
+
+    def _begin(self, events: List[Event], source: str, rest: str):
+        self._state = "inside"
+        self._source = source
+        self._pending = rest
+        events.append(("html_start", {"source": source}))
+
+    def _consume(self, events: List[Event], final: bool):
+        text = self._pending
+        end = -1
+        if self._source == "fence":
+            end = text.find(FENCE)
+            if end == -1 and not final:
+                # 末尾的反引号可能是闭合标记的一部分
+                keep = min(len(text) - len(text.rstrip("`")), len(FENCE) - 1)
+                self._emit(events, text[:len(text) - keep])
+                self._pending = text[len(text) - keep:]
+                return
+        else:
+            window = self._tail + text
+            found = window.lower().find(_HTML_END)
+            if found != -1:
+                end = found + len(_HTML_END) - len(self._tail)
+            elif not final:
+                keep = min(len(text), len(_HTML_END) - 1)
+                self._emit(events, text[:len(text) - keep])
+                self._pending = text[len(text) - keep:]
+                return
+        if end == -1:
+            self._emit(events, text)
+            self._pending = ""
+            return
+        self._emit(events, text[:end].rstrip() if self._source == "fence" else text[:end])
+        self._pending = ""
+        self._done(events, complete=True)
+
+    def _emit(self, events: List[Event], html: str):
+        if not html:
+            return
+        events.append(("html_chunk", {"html": html}))
+        if not self._body_seen:
+            window = self._tail + html
+            match = _BODY_RE.search(window)
+            if match:
+                self._body_seen = True
+                offset = self._length - len(self._tail) + match.end()
+                events.append(("html_body", {"offset": offset}))
+        self._length += len(html)
+        # <body ...> 标签可能较长，保留足够的末尾字符
+        self._tail = (self._tail + html)[-256:]
+
+    def _done(self, events: List[Event], complete: bool):
+        self._state = "after"
+        events.append(("html_done", {"length": self._length, "complete": complete}))
@@ -0,0 +1,227 @@
+import asyncio
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, tzinfo
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from storage import JOB_FINISHED, ChatStore
+
+# -----------------------------------------------------------------------
+# 后台任务
+#
+# 提交即返回任务 ID，concurrency 个 worker 协程从存储中领取任务并执行：
+# - 任务记录保存在 ChatStore 中（SQLite 时多个进程共享同一个库），web 进程可以只提交不执行
+#   （JOB_WORKERS=0），由单独部署的 worker 进程执行：python jobs.py [--workers N]
+# - 执行中每 heartbeat_interval 秒写入一次进度与心跳；心跳超过 stale_after 秒未更新的任务
+#   视为 worker 已失联，由其他 worker 重新领取
+# - 取消任务只修改状态，执行中的 worker 在下一次心跳时发现并停止
+# - 结束超过 ttl 秒的任务定期清理，结果产物在不再被引用后随之删除
+#
+# handler(job, progress) -> {"content": 结果正文, "message_index": 可选, "original": 可选（压缩 HTML 之前的原文）}
+#   progress(n) 报告当前进度（已生成的字符数），出错时直接抛出异常
+# -----------------------------------------------------------------------
+
+Handler = Callable[[dict, Callable[[int], None]], Awaitable[dict]]
+
+
+class JobRunner:
+    def __init__(
+        self,
+        store: ChatStore,
+        concurrency: int = 2,
+        poll_interval: float = 1.0,
+        heartbeat_interval: float = 2.0,
+        stale_after: float = 60.0,
+        ttl: float = 86400.0,
+        tz: Optional[tzinfo] = None,
+    ):
+        self.store = store
+        self.handlers: Dict[str, Handler] = {}
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_after = stale_after
+        self.ttl = ttl
+        # 与对话时间戳使用相同时区，清理时按 ISO 字符串比较
+        self.tz = tz
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._workers: List[asyncio.Task] = []
+        self._wakeup = asyncio.Event()
+        self._last_purge = 0.0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+
+    def now_iso(self, delta: float = 0.0) -> str:
+        return (datetime.now(self.tz) - timedelta(seconds=delta)).isoformat()
+
+    def register(self, kind: str, handler: Handler):
+        self.handlers[kind] = handler
+
+    async def submit(self, kind: str, payload: dict, chat_id: Optional[str] = None) -> dict:
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        job = {
+            "id": uuid.uuid4().hex,
+            "kind": kind,
+            "status": "queued",
+            "payload": payload,
+            "chat_id": chat_id,
+            "progress": 0,
+            "error": None,
+            "artifact": None,
+            "message_index": None,
+            "worker": None,
+            "created_at": self.now_iso(),
+            "finished_at": None,
+        }
+        await self.store.create_job(job)
+        # 唤醒本进程空闲的 worker；其他进程的 worker 在下一次轮询时领取
+        self._wakeup.set()
+        return job
+
+    def start(self):
+        if self.concurrency > 0 and not self._workers:
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        workers, self._workers = self._workers, []
+        for task in workers:
+            task.cancel()
+        if workers:
+            await asyncio.wait(workers)
+
+    async def _worker(self):
+        while True:
+            try:
+                await self._maybe_purge()
+                now = time.time()
+                job = await self.store.claim_job(self.worker_id, now, now - self.stale_after)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"--- 领取后台任务失败: {e} ---")
+                job = None
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run(job)
+
+    async def _run(self, job: dict):
+        handler = self.handlers.get(job["kind"])
+        progress = {"value": job.get("progress") or 0}
+
+        def report(value: int):
+            progress["value"] = value
+
+        task = asyncio.create_task(handler(job, report)) if handler else None
+        heartbeat = asyncio.create_task(self._heartbeat(job["id"], progress, task)) if task else None
+        self.running += 1
+        status, result, error = "failed", None, None
+        try:
+            if task is None:
+                raise ValueError(f"Unknown job kind: {job['kind']}")
+            result = await task
+            status = "succeeded"
+        except asyncio.CancelledError:
+            if task is not None and not task.cancelled():
+                raise
+            # 心跳发现任务已被取消（或被其他 worker 接管）
+            status = "cancelled"
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        finally:
+            self.running -= 1
+            if heartbeat is not None:
+                heartbeat.cancel()
+            if task is not None and not task.done():
+                task.cancel()
+                await asyncio.wait((task,))
+        if status == "cancelled":
+            self.cancelled += 1
+            return
+        if status == "succeeded":
+            self.completed += 1
+        else:
+            self.failed += 1
+        try:
+            await self.store.finish_job(
+                job["id"],
+                self.worker_id,
+                status,
+                self.now_iso(),
+                content=result.get("content") if result else None,
+                error=error,
+                message_index=result.get("message_index") if result else None,
+                original=result.get("original") if result else None,
+            )
+        except Exception as e:
+            print(f"--- 保存后台任务结果失败 ({job['id']}): {e} ---")
+
+    async def _heartbeat(self, job_id: str, progress: dict, task: asyncio.Task):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                status = await self.store.heartbeat_job(job_id, self.worker_id, progress["value"], time.time())
+            except Exception as e:
+                print(f"--- 后台任务心跳失败 ({job_id}): {e} ---")
+                continue
+            if status != "running":
+                task.cancel()
+                return
+
+    async def _maybe_purge(self):
+        if self.ttl <= 0 or time.monotonic() - self._last_purge < 60:
+            return
+        self._last_purge = time.monotonic()
+        await self.store.purge_jobs(self.now_iso(self.ttl))
+
+    def stats(self) -> dict:
+        return {
+            "worker_id": self.worker_id,
+            "concurrency": len(self._workers),
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+        }
+
+
+def is_finished(job: dict) -> bool:
+    return job["status"] in JOB_FINISHED
+
+
+# -----------------------------------------------------------------------
+# 独立 worker 进程：与 web 进程共享 credentials.json 与 SQLite 存储，只执行任务不提供 HTTP 服务
+#   python jobs.py [--workers N]
+# -----------------------------------------------------------------------
+async def _main(argv: List[str]):
+    import app
+
+    if app.STORAGE_BACKEND == "memory":
+        raise RuntimeError("独立 worker 需要与 web 进程共享存储，请将 STORAGE_BACKEND 设置为 sqlite")
+    runner = app.job_runner
+    # open_store 会按 runner.concurrency 启动 worker，命令行的并发数须在此之前设置
+    runner.concurrency = int(argv[argv.index("--workers") + 1]) if "--workers" in argv else max(app.JOB_WORKERS, 1)
+    await app.open_store()
+    runner.start()
+    print(f"--- 后台任务 worker 已启动（{runner.stats()['concurrency']} 个并发，{runner.worker_id}） ---")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.stop()
+        await app.close_store()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(_main(sys.argv[1:]))
+    except KeyboardInterrupt:
+        print("\n--- worker 已停止 ---")
@@ -0,0 +1,70 @@
+import hashlib
+
+# -----------------------------------------------------------------------
+# 提示词模板
+#
+# 系统提示词在导入时构建一次，请求之间保持逐字节相同；主题等可变内容只出现在用户消息中，
+# 位于固定前缀与对话历史之后。这样上游的前缀缓存可以复用同一段前缀：
+#   - OpenAI 兼容接口的自动 prompt caching（可附带 prompt_cache_key 提高命中率）
+#   - Gemini 的隐式缓存，或预先创建的 cached content（显式 context caching）
+# cache_key 由系统提示词内容得出，提示词修改后自动换用新的缓存
+# -----------------------------------------------------------------------
+
+
+class PromptTemplate:
+    def __init__(self, name: str, system: str, user: str = "{topic}"):
+        self.name = name
+        self.system = system
+        self.user = user
+        self.cache_key = f"chattutor-{name}-{hashlib.sha256(system.encode('utf-8')).hexdigest()[:16]}"
+
+    def user_prompt(self, **values) -> str:
+        return self.user.format(**values)
+
+
+TEXT_PROMPT = PromptTemplate(
+    "text",
+    """你是一个友好的AI助手，擅长用清晰、易懂的方式回答问题。
+请用中文回答用户的问题，回答要准确、详细、有条理。
+如果问题涉及复杂概念，请用通俗易懂的语言解释，可以适当举例说明。
+回答要自然流畅，就像在和朋友聊天一样。""",
+)
+
+# 字幕语言要求：强制使用中文
+_SUBTITLE_REQUIREMENT = """**字幕语言要求（严格）：字幕必须100%使用中文，绝对不允许出现任何英文单词、英文句子或混合语言。所有字幕内容必须完全用中文表达，包括专业术语也要用中文。无论用户输入什么语言，生成的字幕必须全部是中文，这是强制要求。**"""
+_SUBTITLE_LANG_NOTE = "（必须全部中文，禁止英文）"
+
+ANIMATION_PROMPT = PromptTemplate(
+    "animation",
+    f"""请你根据用户消息中的主题生成一个非常精美的动态动画
+要动态的,要像一个完整的,正在播放的视频。包含一个完整的过程，能把知识点讲清楚。
+页面极为精美，好看，有设计感，同时能够很好的传达知识。知识和图像要准确
+附带一些旁白式的文字解说,从头到尾讲清楚一个小的知识点
+不需要任何互动按钮,直接开始播放
+使用和谐好看，广泛采用的浅色配色方案，使用很多的，丰富的视觉元素。
+{_SUBTITLE_REQUIREMENT}
+**布局要求：使用全屏或接近全屏的布局，主容器应该占据至少80%的视口宽度和70%以上的视口高度，减少不必要的边距和空白，让内容充满整个显示区域，提供沉浸式的视觉体验。主内容区域应该是一个大的、居中的白色或浅色卡片，占据屏幕的大部分空间。**
+**字幕要求：字幕必须放置在动画内容的下方，使用固定定位或绝对定位在容器底部，确保字幕清晰可见且不会遮挡任何动画元素。字幕区域应该有足够的背景色或半透明背景，确保文字可读性。字幕与动画内容之间要有明确的视觉分隔。字幕内容{_SUBTITLE_LANG_NOTE}**
+**字幕元素标识要求：所有字幕文本必须包含在具有 class="subtitle-text" 或 id="subtitle" 的元素中，每个字幕段落应该是一个独立的元素，便于程序识别和朗读。如果有多段字幕，每个字幕元素都应该有 class="subtitle-text"。**
+**请保证任何一个元素都在一个2k分辨率的容器中被摆在了正确的位置，避免穿模，字幕遮挡，图形位置错误等等问题影响正确的视觉传达**
+html+css+js+svg，放进一个html里""",
+    "请你生成一个非常精美的动态动画,讲讲 {topic}",
+)
+
+MODEL_PROMPT = PromptTemplate(
+    "model",
+    """你是一个教育建模助手。请根据用户输入的知识点或模型名称，生成一个可交互式的数学/教育模型页面。
+要求：
+1) 只输出一个完整的 HTML（包含 CSS + JS），不要输出 markdown 或代码块。
+2) 页面布局：左侧说明卡片（模型名称、定义、公式/参数说明），右侧为可交互的模型展示区域。
+3) 交互：至少包含 2 个可调参数（滑块/输入框），参数变化实时影响图形/模型。
+4) 语言：全部中文。
+5) 只使用原生 HTML/CSS/JS，不使用外部库或远程资源。
+6) 画面清爽，背景浅色，文字清晰，元素不拥挤。
+7) 模型需与主题匹配（例如圆锥曲线、三角函数、立体几何等）。""",
+    "用户需求：{topic}",
+)
+
+
+def prompt_for_mode(mode: str) -> PromptTemplate:
+    return TEXT_PROMPT if mode == "text" else ANIMATION_PROMPT
@@ -0,0 +1,525 @@
+import asyncio
+import random
+import time
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+
+# -----------------------------------------------------------------------
+# 上游模型提供方池
+#
+# 每个提供方是一组 (接口类型, base_url, key, model)，可以同时配置多个 OpenAI 兼容接口与 Gemini。
+# ProviderPool 在首个 token 之前负责容错：
+#   - 失败时按指数退避换下一个提供方重试（首个 token 之后出错不再重试，错误交给调用方）
+#   - 对冲请求：首个 token 超过 hedge_after 秒仍未到达时，向下一个提供方再发一次，先出 token 的胜出，另一个立即关闭
+#   - 熔断：连续失败（或首 token 过慢）达到阈值的提供方暂停使用 breaker_cooldown 秒，之后放行一次试探请求
+# 前缀缓存：调用方传入 cache_key（标识固定不变的系统提示词，见 prompts.py）
+#   - OpenAI 兼容接口：prompt_cache_key 开启时随请求发送 prompt_cache_key，并请求流式 usage 以统计缓存命中
+#   - Gemini：context_cache_ttl > 0 时为每个 (模型, 系统提示词) 创建一次 cached content，之后的请求只发送可变部分；
+#     创建失败（如提示词短于最小缓存长度）时在 ttl 内不再尝试，退回普通请求（仍可命中隐式缓存）
+# -----------------------------------------------------------------------
+
+
+class Provider:
+    """单个上游；子类实现 stream() / complete()"""
+
+    kind = ""
+
+    def __init__(self, name: str, client, model: str):
+        self.name = name
+        self.client = client
+        self.model = model
+        self.requests = 0
+        self.successes = 0
+        self.failures = 0
+        self.slow = 0
+        # 未读完即关闭的流（客户端断开、对冲落败等）
+        self.aborted = 0
+        self.consecutive_failures = 0
+        # 首 token 延迟的指数滑动平均（秒）
+        self.ttft_avg: Optional[float] = None
+        self.open_until = 0.0
+        self.last_error = ""
+        # 上游报告的输入 token 数及其中命中前缀缓存的部分（上游不返回用量时不计）
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+    def stream(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        history: List[dict],
+        model: Optional[str],
+        temperature: float,
+        gemini_contents: Optional[str],
+        cache_key: Optional[str] = None,
+    ) -> AsyncIterator[str]:
+        raise NotImplementedError
+
+    async def complete(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        model: Optional[str],
+        temperature: float,
+        gemini_contents: Optional[str],
+        cache_key: Optional[str] = None,
+    ) -> str:
+        raise NotImplementedError
+
+    def record_usage(self, prompt_tokens: Optional[int], cached_tokens: Optional[int]):
+        self.prompt_tokens += prompt_tokens or 0
+        self.cached_tokens += cached_tokens or 0
+
+    # ---------------- 健康状态 ----------------
+    def state(self, now: float) -> str:
+        if self.open_until <= 0:
+            return "closed"
+        return "open" if now < self.open_until else "half_open"
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "kind": self.kind,
+            "model": self.model,
+            "state": self.state(time.monotonic()),
+            "requests": self.requests,
+            "successes": self.successes,
+            "failures": self.failures,
+            "slow": self.slow,
+            "aborted": self.aborted,
+            "consecutive_failures": self.consecutive_failures,
+            "ttft_avg": round(self.ttft_avg, 3) if self.ttft_avg is not None else None,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "last_error": self.last_error,
+        }
+
+
+class OpenAIProvider(Provider):
+    kind = "openai"
+
+    def __init__(self, name: str, client, model: str, prompt_cache_key: bool = False):
+        super().__init__(name, client, model)
+        # 并非所有兼容接口都接受 prompt_cache_key / stream_options，按提供方开启
+        self.prompt_cache_key = prompt_cache_key
+
+    def cache_options(self, cache_key: Optional[str], stream: bool) -> dict:
+        if not self.prompt_cache_key:
+            return {}
+        options = {"stream_options": {"include_usage": True}} if stream else {}
+        if cache_key:
+            options["prompt_cache_key"] = cache_key
+        return options
+
+    def record_response_usage(self, usage):
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        self.record_usage(usage.prompt_tokens, getattr(details, "cached_tokens", None) if details else None)
+
+    async def stream(self, system_prompt, user_prompt, history, model, temperature, gemini_contents, cache_key=None):
+        # 系统提示词在前、本次主题在最后，请求之间的公共前缀最长
+        response = await self.client.chat.completions.create(
+            model=model or self.model,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                *history,
+                {"role": "user", "content": user_prompt},
+            ],
+            stream=True,
+            temperature=temperature,
+            **self.cache_options(cache_key, stream=True),
+        )
+        completed = False
+        try:
+            async for chunk in response:
+                if getattr(chunk, "usage", None) is not None:
+                    self.record_response_usage(chunk.usage)
+                if not chunk.choices:
+                    continue
+                token = chunk.choices[0].delta.content or ""
+                if token:
+                    yield token
+            completed = True
+        finally:
+            await close_upstream(response, completed, self)
+
+    async def complete(self, system_prompt, user_prompt, model, temperature, gemini_contents, cache_key=None):
+        response = await self.client.chat.completions.create(
+            model=model or self.model,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt},
+            ],
+            temperature=temperature,
+            **self.cache_options(cache_key, stream=False),
+        )
+        self.record_response_usage(response.usage)
+        return response.choices[0].message.content or ""
+
+
+class GeminiProvider(Provider):
+    kind = "gemini"
+
+    def __init__(self, name: str, client, model: str, context_cache_ttl: float = 0.0):
+        super().__init__(name, client, model)
+        self.context_cache_ttl = context_cache_ttl
+        # (模型, cache_key) -> (cached content 名称，创建失败时为 None, 到期时间)
+        self._context_caches: Dict[Tuple[str, str], Tuple[Optional[str], float]] = {}
+        self._context_cache_locks: Dict[Tuple[str, str], asyncio.Lock] = {}
+        self.context_caches_created = 0
+
+    @staticmethod
+    def contents(
+        system_prompt: Optional[str],
+        user_prompt: str,
+        history: List[dict],
+        gemini_contents: Optional[str],
+    ) -> str:
+        # Gemini 使用拼接后的单段文本（gemini_contents 可覆盖）；固定的系统提示词在最前，
+        # 其后依次为对话历史与本次主题。system_prompt 为 None 时由 cached content 提供
+        if gemini_contents is not None:
+            return gemini_contents
+        parts = [system_prompt] if system_prompt is not None else []
+        if history:
+            parts.append("\n".join([f"{msg['role']}: {msg['content']}" for msg in history]))
+        parts.append(user_prompt)
+        return "\n\n".join(parts)
+
+    async def cached_content(self, model: str, system_prompt: str, cache_key: Optional[str]) -> Optional[str]:
+        """取得（必要时创建）系统提示词对应的 cached content 名称；未开启或不可用时返回 None"""
+        if self.context_cache_ttl <= 0 or not cache_key:
+            return None
+        key = (model, cache_key)
+        entry = self._context_caches.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            return entry[0]
+        lock = self._context_cache_locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            entry = self._context_caches.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                return entry[0]
+            from google.genai import types
+
+            name = None
+            try:
+                cache = await self.client.aio.caches.create(
+                    model=model,
+                    config=types.CreateCachedContentConfig(
+                        system_instruction=system_prompt,
+                        display_name=cache_key,
+                        ttl=f"{int(self.context_cache_ttl)}s",
+                    ),
+                )
+                name = cache.name
+                self.context_caches_created += 1
+            except Exception as e:
+                print(f"--- 创建 Gemini 上下文缓存失败（{self.name}，{cache_key}），改用普通请求: {e} ---")
+            # 提前一成续期，避免使用即将过期的缓存
+            self._context_caches[key] = (name, time.monotonic() + self.context_cache_ttl * 0.9)
+            return name
+
+    async def request_options(self, system_prompt, user_prompt, history, model, gemini_contents, cache_key) -> dict:
+        model = model or self.model
+        name = await self.cached_content(model, system_prompt, cache_key) if gemini_contents is None else None
+        if name is None:
+            return {"model": model, "contents": self.contents(system_prompt, user_prompt, history, gemini_contents)}
+        from google.genai import types
+
+        return {
+            "model": model,
+            "contents": self.contents(None, user_prompt, history, None),
+            "config": types.GenerateContentConfig(cached_content=name),
+        }
+
+    def record_response_usage(self, usage):
+        if usage is not None:
+            self.record_usage(usage.prompt_token_count, usage.cached_content_token_count)
+
+    async def stream(self, system_prompt, user_prompt, history, model, temperature, gemini_contents, cache_key=None):
+        # 使用原生异步流式接口，token 到达即转发
+        stream = await self.client.aio.models.generate_content_stream(
+            **await self.request_options(system_prompt, user_prompt, history, model, gemini_contents, cache_key)
+        )
+        completed = False
+        usage = None
+        try:
+            async for chunk in stream:
+                # 每个 chunk 都带累计用量，只记录最后一次
+                usage = getattr(chunk, "usage_metadata", None) or usage
+                token = chunk.text or ""
+                if token:
+                    yield token
+            completed = True
+        finally:
+            self.record_response_usage(usage)
+            await close_upstream(stream, completed, self)
+
+    async def complete(self, system_prompt, user_prompt, model, temperature, gemini_contents, cache_key=None):
+        response = await self.client.aio.models.generate_content(
+            **await self.request_options(system_prompt, user_prompt, [], model, gemini_contents, cache_key)
+        )
+        self.record_response_usage(getattr(response, "usage_metadata", None))
+        return response.text or ""
+
+    def stats(self) -> dict:
+        return {**super().stats(), "context_caches_created": self.context_caches_created}
+
+
+async def close_upstream(stream, completed: bool, provider: Optional[Provider] = None):
+    """
+    提前结束（客户端断开、取消、出错）时立即关闭上游流式响应，释放连接并让上游停止生成，
+    不依赖垃圾回收时机
+    """
+    if not completed and provider is not None:
+        provider.aborted += 1
+    aclose = getattr(stream, "aclose", None)
+    if aclose is None:
+        return
+    try:
+        await aclose()
+    except Exception:
+        pass
+
+
+class _Attempt:
+    """一次上游调用：后台任务等待首个 token"""
+
+    def __init__(self, provider: Provider, tokens: AsyncIterator[str]):
+        self.provider = provider
+        self.tokens = tokens
+        self.started = time.monotonic()
+        self.task = asyncio.create_task(self._first_token())
+
+    async def _first_token(self) -> Optional[str]:
+        try:
+            return await self.tokens.__anext__()
+        except StopAsyncIteration:
+            return None
+
+    async def close(self):
+        if not self.task.done():
+            self.task.cancel()
+        try:
+            await self.task
+        except BaseException:
+            pass
+        try:
+            await self.tokens.aclose()
+        except Exception:
+            pass
+
+
+class ProviderPool:
+    def __init__(
+        self,
+        providers: List[Provider],
+        retries: int = 2,
+        backoff_base: float = 0.5,
+        backoff_max: float = 8.0,
+        hedge_after: float = 0.0,
+        slow_threshold: float = 0.0,
+        breaker_failures: int = 3,
+        breaker_cooldown: float = 30.0,
+    ):
+        if not providers:
+            raise RuntimeError("至少需要配置一个模型提供方")
+        self.providers = providers
+        self.retries = max(0, retries)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_after = hedge_after
+        self.slow_threshold = slow_threshold
+        self.breaker_failures = max(1, breaker_failures)
+        self.breaker_cooldown = breaker_cooldown
+        self.retried = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    @property
+    def primary(self) -> Provider:
+        return self.providers[0]
+
+    @property
+    def aborted(self) -> int:
+        return sum(provider.aborted for provider in self.providers)
+
+    # ---------------- 健康状态 ----------------
+    def candidates(self) -> List[Provider]:
+        """可用的提供方（按配置顺序，熔断中的排除；全部熔断时按恢复时间排序全部返回）"""
+        now = time.monotonic()
+        available = [provider for provider in self.providers if provider.state(now) != "open"]
+        if available:
+            return available
+        return sorted(self.providers, key=lambda provider: provider.open_until)
+
+    def record_success(self, provider: Provider, ttft: Optional[float] = None):
+        provider.successes += 1
+        if ttft is not None:
+            provider.ttft_avg = ttft if provider.ttft_avg is None else provider.ttft_avg * 0.8 + ttft * 0.2
+        if self.slow_threshold > 0 and ttft is not None and ttft > self.slow_threshold:
+            self.record_slow(provider)
+            return
+        provider.consecutive_failures = 0
+        provider.open_until = 0.0
+
+    def record_slow(self, provider: Provider):
+        provider.slow += 1
+        self._trip(provider)
+
+    def record_failure(self, provider: Provider, error: BaseException):
+        provider.failures += 1
+        provider.last_error = f"{type(error).__name__}: {error}"[:200]
+        self._trip(provider)
+
+    def _trip(self, provider: Provider):
+        provider.consecutive_failures += 1
+        now = time.monotonic()
+        # 半开状态下的试探失败立即重新熔断
+        if provider.consecutive_failures >= self.breaker_failures or provider.state(now) == "half_open":
+            provider.open_until = now + self.breaker_cooldown
+
+    def backoff(self, failures: int) -> float:
+        delay = min(self.backoff_max, self.backoff_base * (2 ** (failures - 1)))
+        return delay * (0.5 + random.random() / 2)
+
+    # ---------------- 调用 ----------------
+    async def stream(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        history: Optional[List[dict]] = None,
+        model: Optional[str] = None,
+        temperature: float = 0.8,
+        gemini_contents: Optional[str] = None,
+        trace: Optional[dict] = None,
+        cache_key: Optional[str] = None,
+    ) -> AsyncIterator[str]:
+        """
+        逐个产出 token；首个 token 之前的失败自动退避重试 / 换提供方，并按需发出对冲请求
+        model 为空时各提供方使用自己配置的模型；cache_key 标识可缓存的系统提示词前缀
+        trace 不为空时写入实际使用的 provider / model 与尝试次数，供计时日志与指标使用
+        """
+        history = history or []
+        candidates = self.candidates()
+        next_index = 0
+        failures = 0
+        hedged: Optional[_Attempt] = None
+        last_error: Optional[BaseException] = None
+        pending: List[_Attempt] = []
+        winner: Optional[_Attempt] = None
+
+        def launch() -> _Attempt:
+            nonlocal next_index
+            provider = candidates[next_index % len(candidates)]
+            next_index += 1
+            provider.requests += 1
+            tokens = provider.stream(system_prompt, user_prompt, history, model, temperature, gemini_contents, cache_key)
+            return _Attempt(provider, tokens)
+
+        try:
+            while winner is None:
+                if not pending:
+                    if failures > self.retries:
+                        raise last_error
+                    if failures:
+                        self.retried += 1
+                        await asyncio.sleep(self.backoff(failures))
+                    pending.append(launch())
+                timeout = None
+                if self.hedge_after > 0 and hedged is None and len(candidates) > 1:
+                    timeout = max(0.0, pending[0].started + self.hedge_after - time.monotonic())
+                done, _ = await asyncio.wait(
+                    [attempt.task for attempt in pending],
+                    timeout=timeout,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    # 首 token 迟迟未到：向下一个提供方发出对冲请求，两者谁先出 token 用谁
+                    hedged = launch()
+                    self.hedged += 1
+                    pending.append(hedged)
+                    continue
+                for attempt in list(pending):
+                    if attempt.task not in done:
+                        continue
+                    error = attempt.task.exception()
+                    if error is None:
+                        winner = attempt
+                        break
+                    pending.remove(attempt)
+                    failures += 1
+                    last_error = error
+                    self.record_failure(attempt.provider, error)
+                    await attempt.close()
+
+            for attempt in pending:
+                if attempt is winner:
+                    continue
+                if attempt.started < winner.started:
+                    # 先发出却更晚出 token：计为慢请求
+                    self.record_slow(attempt.provider)
+                await attempt.close()
+            if winner is hedged:
+                self.hedge_wins += 1
+            if trace is not None:
+                trace.update(
+                    provider=winner.provider.name,
+                    model=model or winner.provider.model,
+                    attempts=next_index,
+                    hedged=hedged is not None,
+                )
+            pending = [winner]
+            ttft = time.monotonic() - winner.started
+            first = winner.task.result()
+            if first is not None:
+                yield first
+            try:
+                async for token in winner.tokens:
+                    yield token
+            except Exception as e:
+                self.record_failure(winner.provider, e)
+                raise
+            self.record_success(winner.provider, ttft)
+        finally:
+            for attempt in pending:
+                await attempt.close()
+
+    async def complete(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        model: Optional[str] = None,
+        temperature: float = 0.6,
+        gemini_contents: Optional[str] = None,
+        trace: Optional[dict] = None,
+        cache_key: Optional[str] = None,
+    ) -> str:
+        """非流式调用：失败时退避重试并换提供方"""
+        candidates = self.candidates()
+        last_error: Optional[BaseException] = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.retried += 1
+                await asyncio.sleep(self.backoff(attempt))
+            provider = candidates[attempt % len(candidates)]
+            provider.requests += 1
+            try:
+                text = await provider.complete(system_prompt, user_prompt, model, temperature, gemini_contents, cache_key)
+            except Exception as e:
+                last_error = e
+                self.record_failure(provider, e)
+                continue
+            self.record_success(provider)
+            if trace is not None:
+                trace.update(provider=provider.name, model=model or provider.model, attempts=attempt + 1)
+            return text
+        raise last_error
+
+    def stats(self) -> dict:
+        return {
+            "providers": [provider.stats() for provider in self.providers],
+            "retried": self.retried,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+        }
@@ -0,0 +1,442 @@
+import asyncio
+import itertools
+import time
+import uuid
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from sse import encode_event
+
+# -----------------------------------------------------------------------
+# 可续传的 SSE 生成流
+#
+# - 每次生成分配一个 ID，每个 SSE 事件带序号：id: <generation_id>:<seq>（seq 从 1 开始）
+# - 后台任务驱动生成流并把事件写入该生成的环形缓冲区（最多 max_events 条），与客户端连接无关
+# - 客户端断线后携带 Last-Event-ID 重连，从断点之后继续接收（上游已结束时直接回放）
+# - 没有客户端连接的进行中生成保留 grace 秒，超时后取消上游（只用于网络断开；客户端主动放弃时调用 cancel 立即取消）
+# - 结束后的缓冲区保留 ttl 秒；总占用超过 max_bytes 时先淘汰最早结束的，再淘汰无人连接的进行中生成
+#
+# 多 worker 部署（传入 shared_state.SharedState）时，每个事件同时追加到共享列表，与 DistributedSingleFlight 相同：
+# - 续传请求落到其他 worker 时由 RemoteFollower 轮询该列表回放并跟随（follow_remote）
+# - 其他 worker 上的跟随者计入共享计数，生成所在的 worker 据此判断是否仍有客户端连接
+# - 取消请求落到其他 worker 时写入取消标记，生成所在的 worker 在下一次检查时取消上游
+# 共享列表不受 max_events / max_bytes 限制，生成结束 ttl 秒后过期
+# -----------------------------------------------------------------------
+
+
+def parse_last_event_id(value: Optional[str]) -> Tuple[Optional[str], int]:
+    """把 Last-Event-ID 解析为 (generation_id, seq)；只有序号时 generation_id 为 None，无法解析时 seq 为 0"""
+    generation_id, _, seq = (value or "").strip().rpartition(":")
+    try:
+        return generation_id or None, max(int(seq), 0)
+    except ValueError:
+        return None, 0
+
+
+def split_frames(chunk: str) -> List[str]:
+    """把可能由多个事件拼接成的 chunk 拆为单个事件（不含结尾空行）"""
+    frames = chunk.split("\n\n")
+    if not frames[-1]:
+        frames.pop()
+    return frames
+
+
+class Generation:
+    """单次生成的事件缓冲区"""
+
+    def __init__(self, generation_id: str, max_events: int):
+        self.id = generation_id
+        self.events: Deque[str] = deque()
+        self.first_seq = 1  # events[0] 的序号
+        self.next_seq = 1
+        self.max_events = max_events
+        self.size = 0
+        self.done = False
+        self.expired = False
+        self.consumers = 0
+        self._changed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._grace_timer: Optional[asyncio.TimerHandle] = None
+        self.published_seq = 0  # 已追加到共享列表的最后一个序号
+        self.shared_checked = 0.0  # 上一次续租共享标记、检查取消标记的时间
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def append(self, frame: str) -> int:
+        """写入一个事件，返回缓冲区大小的变化"""
+        event = f"id: {self.id}:{self.next_seq}\n{frame}\n\n"
+        self.events.append(event)
+        self.next_seq += 1
+        delta = len(event)
+        while len(self.events) > self.max_events:
+            delta -= len(self.events.popleft())
+            self.first_seq += 1
+        self.size += delta
+        return delta
+
+    def events_between(self, after_seq: int, last_seq: int) -> List[str]:
+        """序号在 (after_seq, last_seq] 之间且仍在缓冲区内的事件"""
+        start = max(after_seq + 1 - self.first_seq, 0)
+        return list(itertools.islice(self.events, start, max(last_seq + 1 - self.first_seq, start)))
+
+    def events_after(self, seq: int) -> Optional[List[str]]:
+        """序号大于 seq 的全部事件；seq 之后的部分已被环形缓冲区覆盖时返回 None"""
+        if seq + 1 < self.first_seq:
+            return None
+        return list(itertools.islice(self.events, min(seq + 1 - self.first_seq, len(self.events)), None))
+
+
+class Follower:
+    """
+    单个客户端对某次生成的跟随：先取走 after_seq 之后已缓冲的事件，再跟随实时尾部
+    与 singleflight.Subscription 相同，aclose() 可以在迭代进行中由其他任务调用
+    """
+
+    def __init__(self, streams: "ResumableStreams", generation: Generation, after_seq: int):
+        self._streams = streams
+        self._generation = generation
+        self._seq = after_seq
+        self._closed = False
+        generation.consumers += 1
+        streams._attached(generation)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        generation = self._generation
+        while not self._closed:
+            events = None if generation.expired else generation.events_after(self._seq)
+            if events is None:
+                await self.aclose()
+                return encode_event({
+                    "error": "resume window expired",
+                    "type": "ResumeExpired",
+                    "message": "断点已过期，请重新生成",
+                })
+            if events:
+                self._seq = generation.next_seq - 1
+                return events[0] if len(events) == 1 else "".join(events)
+            if generation.done:
+                break
+            await generation._changed.wait()
+        await self.aclose()
+        raise StopAsyncIteration
+
+    async def aclose(self):
+        if not self._closed:
+            self._closed = True
+            self._generation.consumers -= 1
+            self._streams._detached(self._generation)
+            self._generation._notify()
+
+
+class RemoteFollower:
+    """跟随其他 worker 进程上的生成：轮询共享列表，先取走 after_seq 之后已有的事件，再跟随实时尾部"""
+
+    def __init__(self, streams: "ResumableStreams", generation_id: str, after_seq: int):
+        self._streams = streams
+        self._id = generation_id
+        self._seq = after_seq
+        self._closed = False
+        self._ended = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        streams = self._streams
+        events_key, meta_key, _, _ = streams._keys(self._id)
+        while not self._closed and not self._ended:
+            items = await streams.state.lrange(events_key, self._seq)
+            events = []
+            for item in items:
+                if item == streams.END:
+                    self._ended = True
+                    break
+                events.append(item.decode("utf-8"))
+            self._seq += len(events)
+            if events:
+                return events[0] if len(events) == 1 else "".join(events)
+            if self._ended:
+                break
+            if await streams.state.get(meta_key) is None:
+                # 生成所在的 worker 已退出且没有写入结束标记
+                await self.aclose()
+                return encode_event({
+                    "error": "generation lost",
+                    "type": "GenerationAborted",
+                    "message": "生成已中断，请重新生成",
+                })
+            await asyncio.sleep(streams.poll_interval)
+        await self.aclose()
+        raise StopAsyncIteration
+
+    async def aclose(self):
+        if not self._closed:
+            self._closed = True
+            _, _, followers_key, _ = self._streams._keys(self._id)
+            await self._streams.state.incr(followers_key, -1, self._streams.shared_ttl)
+
+
+class ResumableStreams:
+    """可续传生成登记表（进程内；传入 state 时事件同时写入共享状态，供其他 worker 续传）"""
+
+    END = b"\x00end"
+    CANCEL = b"1"
+
+    def __init__(
+        self,
+        ttl: float = 300.0,
+        max_bytes: int = 64 * 1024 * 1024,
+        max_events: int = 10000,
+        grace: float = 60.0,
+        state=None,
+        poll_interval: float = 0.1,
+        max_duration: float = 3600.0,
+    ):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_events = max_events
+        self.grace = grace
+        self.state = state
+        self.poll_interval = poll_interval
+        # 共享列表中每个元素单独计算过期时间，按最长的生成时长保留，避免进行中生成的早期事件先过期
+        self.shared_ttl = ttl + max_duration
+        # 进行中生成的共享标记按租约续期：所在 worker 退出后，其他 worker 上的跟随者在租约过期后结束
+        self.lease_ttl = max(grace, 60.0)
+        # 按创建顺序排列（dict 保持插入顺序）
+        self._generations: Dict[str, Generation] = {}
+        self.bytes = 0
+        self.started = 0
+        self.resumed = 0
+        self.evicted = 0
+        self.abandoned = 0
+        self.cancelled = 0
+        self.remote_followed = 0
+
+    def start(
+        self,
+        frames: AsyncIterator[str],
+        on_close: Optional[Callable[[], Awaitable[None]]] = None,
+    ) -> Generation:
+        """在后台驱动 frames 并缓冲其事件；结束或取消时调用 on_close（如关闭上游订阅）"""
+        generation = Generation(uuid.uuid4().hex, self.max_events)
+        self._generations[generation.id] = generation
+        generation._task = asyncio.create_task(self._drive(generation, frames, on_close))
+        generation._task.add_done_callback(lambda task: self._never_started(generation, on_close))
+        self.started += 1
+        return generation
+
+    def get(self, generation_id: str) -> Optional[Generation]:
+        return self._generations.get(generation_id)
+
+    def _keys(self, generation_id: str):
+        prefix = f"resume:{generation_id}"
+        return f"{prefix}:events", prefix, f"{prefix}:followers", f"{prefix}:cancel"
+
+    async def follow_remote(self, generation_id: str, after_seq: int = 0) -> Optional[RemoteFollower]:
+        """生成不在本进程时从共享状态续传；未启用共享状态或生成不存在时返回 None"""
+        if self.state is None:
+            return None
+        _, meta_key, followers_key, _ = self._keys(generation_id)
+        if await self.state.get(meta_key) is None:
+            return None
+        self.remote_followed += 1
+        if after_seq > 0:
+            self.resumed += 1
+        await self.state.incr(followers_key, 1, self.shared_ttl)
+        return RemoteFollower(self, generation_id, after_seq)
+
+    async def cancel_remote(self, generation_id: str) -> Optional[bool]:
+        """生成在其他 worker 上：写入取消标记；生成不存在时返回 None"""
+        if self.state is None:
+            return None
+        _, meta_key, _, cancel_key = self._keys(generation_id)
+        meta = await self.state.get(meta_key)
+        if meta is None:
+            return None
+        if meta == self.END:
+            return False
+        await self.state.set(cancel_key, self.CANCEL, self.shared_ttl)
+        return True
+
+    def cancel(self, generation: Generation) -> bool:
+        """客户端主动取消：立即取消上游，不等待宽限期；已结束时返回 False"""
+        if generation.done or generation._task is None:
+            return False
+        self.cancelled += 1
+        generation._task.cancel()
+        return True
+
+    def follow(self, generation: Generation, after_seq: int = 0) -> Follower:
+        if after_seq > 0:
+            self.resumed += 1
+        return Follower(self, generation, after_seq)
+
+    def _append(self, generation: Generation, frame: str):
+        if not generation.expired:
+            self.bytes += generation.append(frame)
+
+    async def _publish(self, generation: Generation, finished: bool = False):
+        """把尚未写入共享列表的事件追加过去；结束时写入结束标记"""
+        if self.state is None:
+            return
+        events_key, meta_key, _, _ = self._keys(generation.id)
+        last_seq = generation.next_seq - 1
+        for event in generation.events_between(generation.published_seq, last_seq):
+            await self.state.rpush(events_key, event.encode("utf-8"), self.shared_ttl)
+        generation.published_seq = last_seq
+        if finished:
+            await self.state.rpush(events_key, self.END, self.shared_ttl)
+            await self.state.set(meta_key, self.END, self.ttl)
+
+    async def _sync_shared(self, generation: Generation) -> bool:
+        """写入新事件，按间隔续租共享标记并检查其他 worker 写入的取消标记；返回是否已被取消"""
+        _, meta_key, _, cancel_key = self._keys(generation.id)
+        try:
+            await self._publish(generation)
+            now = time.monotonic()
+            if now - generation.shared_checked < self.poll_interval:
+                return False
+            if now - generation.shared_checked >= self.lease_ttl / 3:
+                await self.state.set(meta_key, b"live", self.lease_ttl)
+            generation.shared_checked = now
+            return await self.state.get(cancel_key) is not None
+        except Exception as e:
+            # 共享状态不可用只影响跨 worker 续传，不中断生成
+            print(f"--- 写入共享续传事件失败 ({generation.id}): {e} ---")
+            return False
+
+    async def _drive(self, generation: Generation, frames: AsyncIterator[str], on_close):
+        try:
+            if self.state is not None:
+                await self._sync_shared(generation)
+            async for chunk in frames:
+                for frame in split_frames(chunk):
+                    self._append(generation, frame)
+                generation._notify()
+                if self.bytes > self.max_bytes:
+                    self._evict()
+                if self.state is not None and await self._sync_shared(generation):
+                    self.cancelled += 1
+                    raise asyncio.CancelledError()
+        except asyncio.CancelledError:
+            self._append(generation, encode_event({
+                "error": "generation aborted",
+                "type": "GenerationAborted",
+                "message": "生成已中断，请重新生成",
+            })[:-2])
+        except Exception as e:
+            self._append(generation, encode_event({
+                "error": str(e),
+                "type": type(e).__name__,
+                "message": "处理请求时发生错误",
+            })[:-2])
+        finally:
+            aclose = getattr(frames, "aclose", None)
+            for close in (aclose, on_close):
+                if close is not None:
+                    try:
+                        await close()
+                    except Exception:
+                        pass
+            try:
+                if self.state is not None:
+                    await self._publish(generation, finished=True)
+            except Exception as e:
+                print(f"--- 写入共享续传事件失败 ({generation.id}): {e} ---")
+            self._finish(generation)
+
+    def _never_started(self, generation: Generation, on_close):
+        # 任务在开始运行前就被取消时 _drive 的 finally 不会执行
+        if not generation.done:
+            self._finish(generation)
+            if on_close is not None:
+                asyncio.ensure_future(on_close())
+
+    def _finish(self, generation: Generation):
+        generation.done = True
+        generation._notify()
+        if generation._grace_timer is not None:
+            generation._grace_timer.cancel()
+            generation._grace_timer = None
+        if not generation.expired:
+            asyncio.get_running_loop().call_later(self.ttl, self._remove, generation)
+
+    def _attached(self, generation: Generation):
+        if generation._grace_timer is not None:
+            generation._grace_timer.cancel()
+            generation._grace_timer = None
+
+    def _detached(self, generation: Generation):
+        if generation.consumers <= 0 and not generation.done and generation._grace_timer is None:
+            generation._grace_timer = asyncio.get_running_loop().call_later(
+                self.grace, self._abandon, generation
+            )
+
+    def _abandon(self, generation: Generation):
+        # 断线后宽限期内没有客户端重连：取消上游，已缓冲的事件仍保留到 ttl 结束
+        generation._grace_timer = None
+        if generation.consumers <= 0 and not generation.done and generation._task is not None:
+            if self.state is not None:
+                asyncio.ensure_future(self._abandon_unless_followed(generation))
+                return
+            self.abandoned += 1
+            generation._task.cancel()
+
+    async def _abandon_unless_followed(self, generation: Generation):
+        # 其他 worker 上仍有客户端在跟随时重新计时
+        _, _, followers_key, _ = self._keys(generation.id)
+        try:
+            followers = int(await self.state.get(followers_key) or 0)
+        except Exception:
+            followers = 0
+        if generation.consumers > 0 or generation.done:
+            return
+        if followers > 0:
+            self._detached(generation)
+            return
+        self.abandoned += 1
+        generation._task.cancel()
+
+    def _remove(self, generation: Generation):
+        if self._generations.get(generation.id) is generation:
+            del self._generations[generation.id]
+        if not generation.expired:
+            generation.expired = True
+            self.bytes -= generation.size
+            generation.events.clear()
+            generation.size = 0
+            generation._notify()
+
+    def _evict(self):
+        """总占用超过上限：先淘汰最早结束的生成，再淘汰无人连接的进行中生成"""
+        for finished in (True, False):
+            for generation in list(self._generations.values()):
+                if self.bytes <= self.max_bytes:
+                    return
+                if generation.done != finished or (not finished and generation.consumers > 0):
+                    continue
+                self.evicted += 1
+                self._remove(generation)
+                if not finished and generation._task is not None:
+                    generation._task.cancel()
+
+    def stats(self) -> dict:
+        generations = list(self._generations.values())
+        return {
+            "generations": len(generations),
+            "live": sum(1 for g in generations if not g.done),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "started": self.started,
+            "resumed": self.resumed,
+            "evicted": self.evicted,
+            "abandoned": self.abandoned,
+            "cancelled": self.cancelled,
+            "remote_followed": self.remote_followed,
+            "shared": self.state is not None,
+        }
@@ -0,0 +1,141 @@
+import math
+import re
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+# -----------------------------------------------------------------------
+# 对话全文检索
+#
+# 分词规则（索引与查询一致）：
+#   - 中文（CJK）连续片段：切成相邻二字组（bigram），同时保留单字，支持单字查询
+#   - 英文/数字：按单词切分并统一小写
+# 查询时所有词项需出现在同一条记录（标题或同一条消息）中，与原来的子串匹配语义一致
+# -----------------------------------------------------------------------
+
+_TOKEN_RE = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+|[0-9a-z]+", re.IGNORECASE)
+_CJK_RE = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]")
+_STYLE_RE = re.compile(r"<style[\s\S]*?</style>", re.IGNORECASE)
+_TAG_RE = re.compile(r"<[^>]+>")
+
+# 标题命中的权重高于消息正文
+TITLE_WEIGHT = 3.0
+
+
+def strip_markup(text: str) -> str:
+    """去掉 HTML 标签与样式块，只保留可见文字（以及脚本里的字幕文本）"""
+    if "<" not in text:
+        return text
+    return _TAG_RE.sub(" ", _STYLE_RE.sub(" ", text))
+
+
+def tokenize(text: str, for_query: bool = False) -> List[str]:
+    """
+    切分为检索词项（去重，保持首次出现顺序）
+    查询时中文片段只取二字组（单字片段取单字），索引时额外保留单字
+    """
+    terms: Dict[str, None] = {}
+    for match in _TOKEN_RE.finditer(text or ""):
+        piece = match.group(0)
+        if not _CJK_RE.match(piece):
+            terms[piece.lower()] = None
+            continue
+        if len(piece) == 1:
+            terms[piece] = None
+            continue
+        for i in range(len(piece) - 1):
+            terms[piece[i:i + 2]] = None
+        if not for_query:
+            for char in piece:
+                terms[char] = None
+    return list(terms)
+
+
+def index_terms(text: str) -> List[str]:
+    return tokenize(strip_markup(text or ""))
+
+
+def query_terms(query: str) -> List[str]:
+    return tokenize(query or "", for_query=True)
+
+
+class SearchIndex:
+    """
+    进程内倒排索引（MemoryStore 使用）
+
+    文档键为 (chat_id, field)：field 为 "title" 或消息序号，
+    增量维护：追加消息、改标题、删除对话时只更新受影响的文档
+    """
+
+    def __init__(self):
+        self._postings: Dict[str, Set[Tuple[str, object]]] = {}
+        self._doc_terms: Dict[Tuple[str, object], List[str]] = {}
+        self._chat_docs: Dict[str, Set[Tuple[str, object]]] = {}
+
+    def _add(self, doc: Tuple[str, object], terms: List[str]):
+        if not terms:
+            return
+        self._doc_terms[doc] = terms
+        self._chat_docs.setdefault(doc[0], set()).add(doc)
+        for term in terms:
+            self._postings.setdefault(term, set()).add(doc)
+
+    def _remove(self, doc: Tuple[str, object]):
+        terms = self._doc_terms.pop(doc, None)
+        if not terms:
+            return
+        for term in terms:
+            docs = self._postings.get(term)
+            if docs is not None:
+                docs.discard(doc)
+                if not docs:
+                    del self._postings[term]
+        docs = self._chat_docs.get(doc[0])
+        if docs is not None:
+            docs.discard(doc)
+            if not docs:
+                del self._chat_docs[doc[0]]
+
+    def set_title(self, chat_id: str, title: Optional[str]):
+        self._remove((chat_id, "title"))
+        self._add((chat_id, "title"), index_terms(title or ""))
+
+    def add_message(self, chat_id: str, position: int, content: str):
+        self._add((chat_id, position), index_terms(content))
+
+    def remove_chat(self, chat_id: str):
+        for doc in list(self._chat_docs.get(chat_id, ())):
+            self._remove(doc)
+
+    def search(self, query: str) -> List[Tuple[str, float]]:
+        """返回 [(chat_id, score)]，未排序；score 越大越相关"""
+        terms = query_terms(query)
+        if not terms:
+            return []
+        postings = [self._postings.get(term) for term in terms]
+        if any(not docs for docs in postings):
+            return []
+        postings.sort(key=len)
+        docs = set(postings[0])
+        for other in postings[1:]:
+            docs &= other
+            if not docs:
+                return []
+        total = max(len(self._doc_terms), 1)
+        idf = sum(math.log(1 + total / len(self._postings[term])) for term in terms)
+        scores: Dict[str, float] = {}
+        for chat_id, field in docs:
+            # 短文档中的命中更相关
+            score = idf / math.sqrt(len(self._doc_terms[(chat_id, field)]))
+            if field == "title":
+                score *= TITLE_WEIGHT
+            if score > scores.get(chat_id, 0.0):
+                scores[chat_id] = score
+        return list(scores.items())
+
+    def rebuild(self, chats: Iterable[dict]):
+        self._postings.clear()
+        self._doc_terms.clear()
+        self._chat_docs.clear()
+        for chat in chats:
+            self.set_title(chat["id"], chat.get("title"))
+            for position, msg in enumerate(chat.get("messages") or []):
+                self.add_message(chat["id"], position, msg.get("content") or "")
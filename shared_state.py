@@ -0,0 +1,373 @@
+import asyncio
+import os
+import sys
+import time
+from typing import Dict, List, Optional
+
+try:
+    import aiosqlite
+except ModuleNotFoundError:
+    aiosqlite = None
+
+try:
+    import redis.asyncio as aioredis
+except ModuleNotFoundError:
+    aioredis = None
+
+# -----------------------------------------------------------------------
+# 多进程共享状态
+#
+# 多个 uvicorn worker 之间共享生成缓存与进行中请求的合并信息。
+# 只需要少量 Redis 风格的原语：带过期的 KV、SET NX、计数器、追加列表。
+#   - SQLiteSharedState: 同一台机器上的多个进程共享一个 SQLite 文件（默认）
+#   - RedisSharedState:  Redis 协议后端，可指向真实 Redis 或本地替身
+#                        （python shared_state.py serve 启动的简易 RESP 服务）
+# -----------------------------------------------------------------------
+
+
+class SharedState:
+    async def init(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        raise NotImplementedError
+
+    async def add(self, key: str, value: bytes, ttl: float) -> bool:
+        """键不存在时写入并返回 True（SET NX），否则返回 False"""
+        raise NotImplementedError
+
+    async def delete(self, key: str):
+        raise NotImplementedError
+
+    async def incr(self, key: str, amount: int, ttl: float) -> int:
+        raise NotImplementedError
+
+    async def rpush(self, key: str, value: bytes, ttl: float):
+        raise NotImplementedError
+
+    async def lrange(self, key: str, start: int) -> List[bytes]:
+        """返回列表中从 start 开始的全部元素"""
+        raise NotImplementedError
+
+
+class SQLiteSharedState(SharedState):
+    """
+    基于 SQLite 文件的共享状态，适用于单机多 worker
+
+    使用自动提交模式，需要原子性的操作用 BEGIN IMMEDIATE 包裹
+    """
+
+    def __init__(self, path: str):
+        if aiosqlite is None:
+            raise RuntimeError("SQLite 共享状态需要 aiosqlite，请先执行 pip install aiosqlite")
+        self.path = path
+        self._db = None
+        self._lock = asyncio.Lock()
+        self._last_purge = 0.0
+
+    async def init(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._db = await aiosqlite.connect(self.path, isolation_level=None)
+        await self._db.execute("PRAGMA journal_mode=WAL")
+        await self._db.execute("PRAGMA synchronous=NORMAL")
+        await self._db.execute("PRAGMA busy_timeout=5000")
+        await self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS kv (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                expires_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS lists (
+                key TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                value BLOB NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (key, seq)
+            );
+            CREATE INDEX IF NOT EXISTS idx_kv_expires_at ON kv(expires_at);
+            CREATE INDEX IF NOT EXISTS idx_lists_expires_at ON lists(expires_at);
+            """
+        )
+
+    async def close(self):
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    async def _purge_expired(self, now: float):
+        # 每分钟最多清理一次过期数据
+        if now - self._last_purge < 60:
+            return
+        self._last_purge = now
+        await self._db.execute("DELETE FROM kv WHERE expires_at < ?", (now,))
+        await self._db.execute("DELETE FROM lists WHERE expires_at < ?", (now,))
+
+    async def get(self, key: str) -> Optional[bytes]:
+        async with self._db.execute(
+            "SELECT value FROM kv WHERE key = ? AND expires_at >= ?", (key, time.time())
+        ) as cursor:
+            row = await cursor.fetchone()
+        return bytes(row[0]) if row else None
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        now = time.time()
+        async with self._lock:
+            await self._db.execute(
+                "INSERT INTO kv (key, value, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at",
+                (key, value, now + ttl),
+            )
+            await self._purge_expired(now)
+
+    async def add(self, key: str, value: bytes, ttl: float) -> bool:
+        now = time.time()
+        async with self._lock:
+            await self._db.execute("BEGIN IMMEDIATE")
+            try:
+                await self._db.execute("DELETE FROM kv WHERE key = ? AND expires_at < ?", (key, now))
+                cursor = await self._db.execute(
+                    "INSERT OR IGNORE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, value, now + ttl),
+                )
+                await self._db.execute("COMMIT")
+            except BaseException:
+                await self._db.execute("ROLLBACK")
+                raise
+        return cursor.rowcount > 0
+
+    async def delete(self, key: str):
+        async with self._lock:
+            await self._db.execute("DELETE FROM kv WHERE key = ?", (key,))
+            await self._db.execute("DELETE FROM lists WHERE key = ?", (key,))
+
+    async def incr(self, key: str, amount: int, ttl: float) -> int:
+        now = time.time()
+        async with self._lock:
+            await self._db.execute("BEGIN IMMEDIATE")
+            try:
+                async with self._db.execute(
+                    "SELECT value FROM kv WHERE key = ? AND expires_at >= ?", (key, now)
+                ) as cursor:
+                    row = await cursor.fetchone()
+                value = (int(row[0]) if row else 0) + amount
+                await self._db.execute(
+                    "INSERT INTO kv (key, value, expires_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at",
+                    (key, str(value).encode(), now + ttl),
+                )
+                await self._db.execute("COMMIT")
+            except BaseException:
+                await self._db.execute("ROLLBACK")
+                raise
+        return value
+
+    async def rpush(self, key: str, value: bytes, ttl: float):
+        async with self._lock:
+            await self._db.execute(
+                "INSERT INTO lists (key, seq, value, expires_at) VALUES "
+                "(?, (SELECT COALESCE(MAX(seq), -1) + 1 FROM lists WHERE key = ?), ?, ?)",
+                (key, key, value, time.time() + ttl),
+            )
+
+    async def lrange(self, key: str, start: int) -> List[bytes]:
+        async with self._db.execute(
+            "SELECT value FROM lists WHERE key = ? AND seq >= ? AND expires_at >= ? ORDER BY seq",
+            (key, start, time.time()),
+        ) as cursor:
+            rows = await cursor.fetchall()
+        return [bytes(row[0]) for row in rows]
+
+
+class RedisSharedState(SharedState):
+    """
+    Redis 协议后端（redis-py 异步客户端），可跨主机共享
+    """
+
+    def __init__(self, url: str):
+        if aioredis is None:
+            raise RuntimeError("Redis 共享状态需要 redis，请先执行 pip install redis")
+        self.url = url
+        self._redis = None
+
+    async def init(self):
+        self._redis = aioredis.from_url(self.url)
+
+    async def close(self):
+        if self._redis is not None:
+            await self._redis.aclose()
+            self._redis = None
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self._redis.get(key)
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        await self._redis.set(key, value, px=int(ttl * 1000))
+
+    async def add(self, key: str, value: bytes, ttl: float) -> bool:
+        return bool(await self._redis.set(key, value, px=int(ttl * 1000), nx=True))
+
+    async def delete(self, key: str):
+        await self._redis.delete(key)
+
+    async def incr(self, key: str, amount: int, ttl: float) -> int:
+        value = await self._redis.incrby(key, amount)
+        await self._redis.pexpire(key, int(ttl * 1000))
+        return int(value)
+
+    async def rpush(self, key: str, value: bytes, ttl: float):
+        await self._redis.rpush(key, value)
+        await self._redis.pexpire(key, int(ttl * 1000))
+
+    async def lrange(self, key: str, start: int) -> List[bytes]:
+        return await self._redis.lrange(key, start, -1)
+
+
+def create_shared_state(backend: str, path: str = "", url: str = "") -> Optional[SharedState]:
+    backend = (backend or "").lower()
+    if not backend:
+        return None
+    if backend == "sqlite":
+        return SQLiteSharedState(path or os.path.join("data", "shared_state.db"))
+    if backend == "redis":
+        return RedisSharedState(url or "redis://127.0.0.1:6379/0")
+    raise ValueError(f"Unknown shared state backend: {backend}")
+
+
+# -----------------------------------------------------------------------
+# 本地 Redis 替身：只实现 RedisSharedState 用到的命令，数据保存在内存中
+#   python shared_state.py serve [端口，默认 6390]
+# 然后在 credentials.json 中配置：
+#   "SHARED_STATE_BACKEND": "redis", "SHARED_STATE_URL": "redis://127.0.0.1:6390/0"
+# -----------------------------------------------------------------------
+class LocalRedisStandIn:
+    def __init__(self):
+        self._values: Dict[bytes, object] = {}
+        self._expires: Dict[bytes, float] = {}
+
+    def _alive(self, key: bytes) -> bool:
+        expires_at = self._expires.get(key)
+        if expires_at is not None and expires_at < time.time():
+            self._values.pop(key, None)
+            self._expires.pop(key, None)
+        return key in self._values
+
+    def execute(self, args: List[bytes]):
+        command = args[0].upper()
+        if command == b"PING":
+            return "+PONG"
+        if command == b"HELLO":
+            proto = int(args[1]) if len(args) > 1 else 2
+            return {b"server": b"redis", b"version": b"7.0.0", b"proto": proto, b"mode": b"standalone"}
+        if command == b"GET":
+            return self._values.get(args[1]) if self._alive(args[1]) else None
+        if command == b"SET":
+            key, value, options = args[1], args[2], [a.upper() for a in args[3:]]
+            if b"NX" in options and self._alive(key):
+                return None
+            self._values[key] = value
+            self._expires.pop(key, None)
+            for name, scale in ((b"EX", 1.0), (b"PX", 0.001)):
+                if name in options:
+                    self._expires[key] = time.time() + float(args[3 + options.index(name) + 1]) * scale
+            return "+OK"
+        if command == b"DEL":
+            removed = 0
+            for key in args[1:]:
+                if self._alive(key):
+                    removed += 1
+                self._values.pop(key, None)
+                self._expires.pop(key, None)
+            return removed
+        if command == b"INCRBY":
+            value = int(self._values.get(args[1], b"0")) if self._alive(args[1]) else 0
+            value += int(args[2])
+            self._values[args[1]] = str(value).encode()
+            return value
+        if command in (b"EXPIRE", b"PEXPIRE"):
+            if not self._alive(args[1]):
+                return 0
+            scale = 1.0 if command == b"EXPIRE" else 0.001
+            self._expires[args[1]] = time.time() + float(args[2]) * scale
+            return 1
+        if command == b"RPUSH":
+            items = self._values.get(args[1]) if self._alive(args[1]) else None
+            if not isinstance(items, list):
+                items = []
+                self._values[args[1]] = items
+            items.extend(args[2:])
+            return len(items)
+        if command == b"LRANGE":
+            items = self._values.get(args[1]) if self._alive(args[1]) else []
+            start, stop = int(args[2]), int(args[3])
+            stop = len(items) if stop == -1 else stop + 1
+            return list(items[start:stop])
+        return Exception(f"ERR unknown command '{command.decode(errors='replace')}'")
+
+    @staticmethod
+    def encode(reply, resp3: bool = False) -> bytes:
+        if reply is None:
+            return b"_\r\n" if resp3 else b"$-1\r\n"
+        if isinstance(reply, Exception):
+            return f"-{reply}\r\n".encode()
+        if isinstance(reply, str):
+            return reply.encode() + b"\r\n"
+        if isinstance(reply, int):
+            return f":{reply}\r\n".encode()
+        if isinstance(reply, bytes):
+            return b"$%d\r\n%s\r\n" % (len(reply), reply)
+        encode = LocalRedisStandIn.encode
+        if isinstance(reply, dict):
+            items = [encode(k, resp3) + encode(v, resp3) for k, v in reply.items()]
+            header = b"%%%d\r\n" if resp3 else b"*%d\r\n"
+            return header % (len(items) if resp3 else 2 * len(items)) + b"".join(items)
+        return b"*%d\r\n" % len(reply) + b"".join(encode(r, resp3) for r in reply)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        resp3 = False
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.startswith(b"*"):
+                    args = line.split()
+                else:
+                    args = []
+                    for _ in range(int(line[1:])):
+                        size = int((await reader.readline())[1:])
+                        args.append((await reader.readexactly(size + 2))[:-2])
+                if args:
+                    reply = self.execute(args)
+                    if args[0].upper() == b"HELLO":
+                        resp3 = reply[b"proto"] == 3
+                    writer.write(self.encode(reply, resp3))
+                    await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve_stand_in(host: str = "127.0.0.1", port: int = 6390):
+    stand_in = LocalRedisStandIn()
+    server = await asyncio.start_server(stand_in.handle, host, port)
+    print(f"--- 本地 Redis 替身已启动: redis://{host}:{port}/0 ---")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "serve":
+        try:
+            asyncio.run(serve_stand_in(port=int(sys.argv[2]) if len(sys.argv) > 2 else 6390))
+        except KeyboardInterrupt:
+            pass
+    else:
+        print("用法: python shared_state.py serve [端口]")
@@ -0,0 +1,336 @@
+import asyncio
+import time
+import uuid
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+
+class SharedStream:
+    """
+    一个上游流 + 多个订阅者的扇出缓冲区
+
+    - 第一个订阅者到来时启动后台任务驱动上游流，产出的每个 chunk 追加到缓冲区
+    - 后加入的订阅者先收到已产出的 chunk，再继续接收实时尾部
+    - 单个订阅者离开不影响上游；只有全部订阅者都离开且上游未结束时才取消上游
+    """
+
+    def __init__(
+        self,
+        source_factory: Callable[[], AsyncIterator[str]],
+        on_complete: Optional[Callable[[List[str]], Awaitable[None]]] = None,
+        on_finish: Optional[Callable[[], None]] = None,
+        keep_alive: Optional[Callable[[], Awaitable[bool]]] = None,
+    ):
+        self._source_factory = source_factory
+        self._keep_alive = keep_alive
+        self._on_complete = on_complete
+        self._on_finish = on_finish
+        self.chunks: List[str] = []
+        self.done = False
+        self.cancelled = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self._changed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def _drive(self):
+        source = self._source_factory()
+        try:
+            async for chunk in source:
+                self.chunks.append(chunk)
+                self._notify()
+            if self._on_complete is not None:
+                await self._on_complete(self.chunks)
+        except asyncio.CancelledError:
+            self.cancelled = True
+        except Exception as e:
+            self.error = e
+        finally:
+            aclose = getattr(source, "aclose", None)
+            if aclose is not None:
+                try:
+                    await aclose()
+                except Exception:
+                    pass
+            self.done = True
+            self._notify()
+            if self._on_finish is not None:
+                self._on_finish()
+
+    def _release(self):
+        self.subscribers -= 1
+        if self.subscribers <= 0 and not self.done and self._task is not None:
+            if self._keep_alive is None:
+                self._task.cancel()
+            else:
+                asyncio.create_task(self._cancel_unless_kept_alive())
+
+    async def _cancel_unless_kept_alive(self):
+        # 本地订阅者都已离开，但其他进程可能仍在跟随这条流
+        try:
+            keep = await self._keep_alive()
+        except Exception:
+            keep = False
+        if not keep and self.subscribers <= 0 and not self.done:
+            self._task.cancel()
+
+    def subscribe(self) -> "Subscription":
+        # 订阅在创建时立即计数，避免尚未开始迭代的订阅者被误判为已离开
+        self.subscribers += 1
+        if self._task is None:
+            self._task = asyncio.create_task(self._drive())
+        return Subscription(self)
+
+
+class Subscription:
+    """
+    SharedStream 的单个订阅者：异步迭代器，aclose() 时退订（可重复调用）
+    """
+
+    def __init__(self, shared: SharedStream):
+        self._shared = shared
+        self._index = 0
+        self._closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        shared = self._shared
+        while not self._closed:
+            backlog = len(shared.chunks) - self._index
+            if backlog > 0:
+                # 落后（或后加入）的订阅者一次取走全部积压的 chunk，减少逐帧转发与发送
+                if backlog == 1:
+                    chunk = shared.chunks[self._index]
+                else:
+                    chunk = "".join(shared.chunks[self._index:])
+                self._index = len(shared.chunks)
+                return chunk
+            if shared.done:
+                break
+            await shared._changed.wait()
+        await self.aclose()
+        if shared.error is not None:
+            raise shared.error
+        raise StopAsyncIteration
+
+    async def aclose(self):
+        if not self._closed:
+            self._closed = True
+            self._shared._release()
+            # 唤醒正在等待新 chunk 的 __anext__，使其立即结束
+            self._shared._notify()
+
+
+class SingleFlight:
+    """
+    按键合并相同的进行中请求（single-flight）
+
+    - stream(): 流式请求共享一个 SharedStream
+    - do(): 非流式请求共享同一个任务结果；全部等待者取消后才取消任务
+    """
+
+    def __init__(self):
+        self._streams: Dict[str, SharedStream] = {}
+        self._calls: Dict[str, list] = {}
+        self.started = 0
+        self.coalesced = 0
+        # 订阅者全部离开后被取消的上游流
+        self.cancelled = 0
+
+    def stream(
+        self,
+        key: str,
+        source_factory: Callable[[], AsyncIterator[str]],
+        on_complete: Optional[Callable[[List[str]], Awaitable[None]]] = None,
+        share: bool = True,
+    ) -> Subscription:
+        shared = self._streams.get(key) if share else None
+        if shared is not None and not shared.done:
+            self.coalesced += 1
+            return shared.subscribe()
+
+        def on_finish():
+            if shared.cancelled:
+                self.cancelled += 1
+            if share and self._streams.get(key) is shared:
+                self._streams.pop(key, None)
+
+        shared = self._new_stream(key, source_factory, on_complete, on_finish, share)
+        if share:
+            self._streams[key] = shared
+        self.started += 1
+        return shared.subscribe()
+
+    def _new_stream(self, key, source_factory, on_complete, on_finish, share) -> SharedStream:
+        return SharedStream(source_factory, on_complete, on_finish)
+
+    def in_flight(self, key: str) -> bool:
+        """该键是否已有进行中的请求（新请求会合并进去，不再单独调用上游）"""
+        shared = self._streams.get(key)
+        return (shared is not None and not shared.done) or key in self._calls
+
+    async def do(self, key: str, coro_factory: Callable[[], Awaitable]):
+        entry = self._calls.get(key)
+        if entry is None:
+            task = asyncio.create_task(coro_factory())
+            entry = [task, 0]
+            self._calls[key] = entry
+            task.add_done_callback(
+                lambda t: self._calls.pop(key, None) if self._calls.get(key) is entry else None
+            )
+            self.started += 1
+        else:
+            self.coalesced += 1
+        task = entry[0]
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            entry[1] -= 1
+            if entry[1] <= 0 and not task.done():
+                task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "in_flight_streams": len(self._streams),
+            "in_flight_calls": len(self._calls),
+            "started": self.started,
+            "coalesced": self.coalesced,
+            "cancelled": self.cancelled,
+        }
+
+
+class DistributedSingleFlight(SingleFlight):
+    """
+    跨进程的 single-flight（多 worker 部署），依赖 shared_state.SharedState
+
+    - 流式：抢到租约的进程作为 leader 驱动上游，并把每个 chunk 追加到共享列表；
+      其他进程作为 follower 轮询该列表，先拿到已产出的部分再跟随实时尾部
+    - 非流式：leader 把结果写入共享键，follower 轮询结果
+    - 进程内仍先走本地合并，每个进程对同一个键最多只有一个 follower
+    - leader 的本地订阅者全部离开时，若仍有其他进程在跟随，则不取消上游
+    """
+
+    END = b"\x00end"
+    ABORT = b"\x00abort"
+
+    def __init__(self, state, lease_ttl: float = 600.0, poll_interval: float = 0.05):
+        super().__init__()
+        self.state = state
+        self.lease_ttl = lease_ttl
+        self.poll_interval = poll_interval
+        self.remote_followed = 0
+
+    def _keys(self, key: str):
+        return f"flight:{key}:lease", f"flight:{key}:followers"
+
+    def _new_stream(self, key, source_factory, on_complete, on_finish, share) -> SharedStream:
+        if not share:
+            return super()._new_stream(key, source_factory, on_complete, on_finish, share)
+        _, followers_key = self._keys(key)
+
+        async def keep_alive() -> bool:
+            count = await self.state.get(followers_key)
+            return bool(count) and int(count) > 0
+
+        return SharedStream(
+            lambda: self._distributed_source(key, source_factory),
+            on_complete,
+            on_finish,
+            keep_alive=keep_alive,
+        )
+
+    async def _distributed_source(self, key: str, source_factory):
+        lease_key, followers_key = self._keys(key)
+        flight_id = uuid.uuid4().hex
+        if await self.state.add(lease_key, flight_id.encode(), self.lease_ttl):
+            # leader：驱动上游并发布每个 chunk
+            chunks_key = f"flight:{key}:{flight_id}"
+            last_refresh = time.monotonic()
+            finished = False
+            try:
+                async for chunk in source_factory():
+                    await self.state.rpush(chunks_key, chunk.encode("utf-8"), self.lease_ttl)
+                    if time.monotonic() - last_refresh > self.lease_ttl / 3:
+                        await self.state.set(lease_key, flight_id.encode(), self.lease_ttl)
+                        last_refresh = time.monotonic()
+                    yield chunk
+                await self.state.rpush(chunks_key, self.END, self.lease_ttl)
+                finished = True
+            finally:
+                if not finished:
+                    await self.state.rpush(chunks_key, self.ABORT, self.lease_ttl)
+                await self.state.delete(lease_key)
+            return
+
+        # follower：跟随其他进程的上游流
+        self.remote_followed += 1
+        await self.state.incr(followers_key, 1, self.lease_ttl)
+        try:
+            leader_id = await self.state.get(lease_key)
+            if leader_id is None:
+                raise RuntimeError("上游生成已结束，请重试")
+            chunks_key = f"flight:{key}:{leader_id.decode()}"
+            index = 0
+            while True:
+                items = await self.state.lrange(chunks_key, index)
+                for item in items:
+                    index += 1
+                    if item == self.END:
+                        return
+                    if item == self.ABORT:
+                        raise RuntimeError("上游生成已中断，请重试")
+                    yield item.decode("utf-8")
+                if not items:
+                    if await self.state.get(lease_key) != leader_id:
+                        # 租约已释放：再读一次列表，确认是否已经写入结束标记
+                        if not await self.state.lrange(chunks_key, index):
+                            raise RuntimeError("上游生成已中断，请重试")
+                        continue
+                    await asyncio.sleep(self.poll_interval)
+        finally:
+            await self.state.incr(followers_key, -1, self.lease_ttl)
+
+    async def do(self, key: str, coro_factory: Callable[[], Awaitable]):
+        return await super().do(key, lambda: self._distributed_call(key, coro_factory))
+
+    async def _distributed_call(self, key: str, coro_factory: Callable[[], Awaitable]):
+        lease_key, _ = self._keys(key)
+        result_key = f"flight:{key}:result"
+        while True:
+            if await self.state.add(lease_key, b"1", self.lease_ttl):
+                try:
+                    result = await coro_factory()
+                    await self.state.set(result_key, _encode_result(result), 60.0)
+                    return result
+                finally:
+                    await self.state.delete(lease_key)
+            # 其他进程正在执行：等待其结果；租约消失但没有结果则重新竞争租约
+            self.remote_followed += 1
+            while await self.state.get(lease_key) is not None:
+                await asyncio.sleep(self.poll_interval)
+            data = await self.state.get(result_key)
+            if data is not None:
+                return _decode_result(data)
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats["remote_followed"] = self.remote_followed
+        return stats
+
+
+def _encode_result(result) -> bytes:
+    if isinstance(result, bytes):
+        return b"b" + result
+    return b"s" + str(result).encode("utf-8")
+
+
+def _decode_result(data: bytes):
+    if data[:1] == b"b":
+        return data[1:]
+    return data[1:].decode("utf-8")
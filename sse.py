@@ -0,0 +1,238 @@
+import asyncio
+import json
+import zlib
+from typing import AsyncIterator, Callable, Dict, List, Optional
+
+try:
+    import orjson
+except ModuleNotFoundError:
+    orjson = None
+
+try:
+    import brotli
+except ModuleNotFoundError:
+    brotli = None
+
+# -----------------------------------------------------------------------
+# SSE 帧编码
+#
+# - JSON 编码器可替换：默认使用 orjson（已安装时），否则使用标准库；输出均为紧凑格式
+#   （{"token":"..."}），切换编码器不改变帧内容
+# - token 帧直接拼接字符串，不构造 dict
+# - coalesce_tokens 把短时间窗口内到达的 token 合并为一帧，减少每个事件的编码、转发与发送开销
+# - compress_frames 按事件刷新的 gzip / br 压缩，客户端无需等待缓冲区填满即可解出每个事件
+# -----------------------------------------------------------------------
+
+DONE_FRAME = 'data: {"event":"[DONE]"}\n\n'
+
+# 标准库编码器：C 实现的字符串转义，不转义非 ASCII 字符
+_encode_string = json.encoder.encode_basestring
+_std_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+
+def _orjson_dumps(data) -> str:
+    try:
+        return orjson.dumps(data).decode("utf-8")
+    except TypeError:
+        # 孤立代理字符等 orjson 不接受的输入退回标准库
+        return _std_encoder.encode(data)
+
+
+JSON_ENCODERS: Dict[str, Callable[[object], str]] = {"json": _std_encoder.encode}
+if orjson is not None:
+    JSON_ENCODERS["orjson"] = _orjson_dumps
+
+_dumps: Callable[[object], str] = JSON_ENCODERS.get("orjson", _std_encoder.encode)
+
+
+def register_json_encoder(name: str, dumps: Callable[[object], str]):
+    """注册自定义编码器：dumps(obj) -> 紧凑、不转义非 ASCII 的 JSON 字符串"""
+    JSON_ENCODERS[name] = dumps
+
+
+def set_json_encoder(name: str):
+    """选择编码器："auto"（orjson 可用时优先）、"json"、"orjson" 或已注册的名称"""
+    global _dumps
+    if name in ("", "auto"):
+        _dumps = JSON_ENCODERS.get("orjson", _std_encoder.encode)
+        return
+    if name not in JSON_ENCODERS:
+        hint = "（需要 pip install orjson）" if name == "orjson" else ""
+        raise RuntimeError(f"未知或不可用的 SSE JSON 编码器：{name}{hint}")
+    _dumps = JSON_ENCODERS[name]
+
+
+def json_encoder_name() -> str:
+    for name, dumps in JSON_ENCODERS.items():
+        if dumps is _dumps:
+            return name
+    return "custom"
+
+
+def encode_event(data: dict) -> str:
+    return f"data: {_dumps(data)}\n\n"
+
+
+def token_frame(token: str) -> str:
+    return 'data: {"token":' + _encode_string(token) + "}\n\n"
+
+
+async def coalesce_tokens(
+    tokens: AsyncIterator[str],
+    interval: float,
+    max_chars: int,
+    on_token: Optional[Callable[[str], None]] = None,
+) -> AsyncIterator[str]:
+    """
+    把 interval 秒内相继到达的 token 合并为一段输出
+    - 第一段立即输出（不增加首字延迟）
+    - 窗口从缓冲区中第一个 token 到达时开始计时；上游停顿时窗口到期即输出，不等待下一个 token
+    - 累计达到 max_chars 个字符或上游结束时立即输出
+    - 上游出错时先输出已缓冲的内容再抛出异常
+    后台任务读取上游并追加到缓冲区，每个 token 只是一次列表追加；每段输出一个定时器
+    on_token 对每个上游 token 调用（用于按原始 chunk 计时）
+    """
+    loop = asyncio.get_running_loop()
+    buffer: List[str] = []
+    size = 0
+    batch_started = 0.0
+    done = False
+    error: Optional[BaseException] = None
+    waiter: Optional[asyncio.Future] = None
+
+    def wake():
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def pump():
+        nonlocal size, batch_started, done, error
+        try:
+            async for token in tokens:
+                if on_token is not None:
+                    on_token(token)
+                if not buffer:
+                    batch_started = loop.time()
+                    buffer.append(token)
+                    size = len(token)
+                    wake()
+                    continue
+                buffer.append(token)
+                size += len(token)
+                if size >= max_chars:
+                    wake()
+        except Exception as e:
+            error = e
+        finally:
+            done = True
+            wake()
+
+    task = asyncio.create_task(pump())
+    first = True
+    try:
+        while True:
+            if not buffer and not done:
+                waiter = loop.create_future()
+                await waiter
+            if buffer and not first and not done and size < max_chars:
+                remaining = batch_started + interval - loop.time()
+                if remaining > 0:
+                    waiter = loop.create_future()
+                    timer = loop.call_later(remaining, wake)
+                    try:
+                        await waiter
+                    finally:
+                        timer.cancel()
+            if buffer:
+                chunk = buffer[0] if len(buffer) == 1 else "".join(buffer)
+                buffer.clear()
+                size = 0
+                first = False
+                yield chunk
+            elif done:
+                if error is not None:
+                    raise error
+                return
+    finally:
+        if not task.done():
+            task.cancel()
+            await asyncio.wait((task,))
+
+
+# -----------------------------------------------------------------------
+# 压缩
+# -----------------------------------------------------------------------
+
+def supported_encodings() -> list:
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def _accepted_encodings(accept_encoding: str) -> Dict[str, float]:
+    accepted = {}
+    for part in (accept_encoding or "").lower().split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name] = quality
+    return accepted
+
+
+def accepts_encoding(accept_encoding: str, encoding: str) -> bool:
+    """客户端是否接受指定的 Content-Encoding（如已压缩存储的 zstd / gzip 产物可原样发送）"""
+    accepted = _accepted_encodings(accept_encoding)
+    return accepted.get(encoding, accepted.get("*", 0.0)) > 0
+
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """按 Accept-Encoding 选择 br（需要 brotli）或 gzip；q=0 视为不接受"""
+    accepted = _accepted_encodings(accept_encoding)
+    for encoding in supported_encodings():
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+def compress_body(data: bytes, encoding: str, level: int = 5) -> bytes:
+    """整段响应体压缩为 gzip / br"""
+    if encoding == "br":
+        return brotli.compress(data, mode=brotli.MODE_TEXT, quality=min(level, 11))
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+class _GzipFramer:
+    def __init__(self, level: int):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def frame(self, data: bytes) -> bytes:
+        # Z_SYNC_FLUSH：输出到字节边界，客户端可立即解出这一段
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+class _BrotliFramer:
+    def __init__(self, level: int):
+        self._compressor = brotli.Compressor(mode=brotli.MODE_TEXT, quality=min(level, 11))
+
+    def frame(self, data: bytes) -> bytes:
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+async def compress_frames(frames: AsyncIterator[str], encoding: str, level: int = 5) -> AsyncIterator[bytes]:
+    """把 SSE 帧流压缩为 gzip / br 字节流，每段输入单独刷新"""
+    framer = _BrotliFramer(level) if encoding == "br" else _GzipFramer(level)
+    async for chunk in frames:
+        data = framer.frame(chunk.encode("utf-8") if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield framer.finish()
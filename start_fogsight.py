@@ -1,39 +1,63 @@
-
+import argparse
 import webbrowser
 import subprocess
 import threading
 import time
 import os
 
-HOST = "127.0.0.1"  
+HOST = "127.0.0.1"
 PORT = 8000
 
-def start_backend():
-    """使用 subprocess 启动 uvicorn 服务器。"""
-    print(f"--- 后端启动中，请访问 http://{HOST}:{PORT} ---")
-    subprocess.run(
-        [os.sys.executable, "-m", "uvicorn", "app:app", f"--host={HOST}", f"--port={PORT}"]
+def parse_args():
+    parser = argparse.ArgumentParser(description="启动 ChatTutor 后端并打开前端页面")
+    parser.add_argument("--host", default=HOST, help="监听地址")
+    parser.add_argument("--port", type=int, default=PORT, help="监听端口")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.environ.get("WORKERS", "1")),
+        help="uvicorn worker 进程数；大于 1 时对话/缓存/请求合并通过共享状态跨进程共享",
     )
+    parser.add_argument("--no-browser", action="store_true", help="不自动打开浏览器（服务器/容器部署）")
+    return parser.parse_args()
 
-def open_frontend():
+def start_backend(host, port, workers):
+    """使用 subprocess 启动 uvicorn 服务器。"""
+    print(f"--- 后端启动中（{workers} 个 worker），请访问 http://{host}:{port} ---")
+    command = [os.sys.executable, "-m", "uvicorn", "app:app", f"--host={host}", f"--port={port}"]
+    if workers > 1:
+        command.append(f"--workers={workers}")
+    # app.py 根据该变量启用多进程共享状态
+    env = {**os.environ, "CHATTUTOR_WORKERS": str(workers)}
+    subprocess.run(command, env=env)
+
+def open_frontend(host, port):
     """在默认浏览器中打开前端页面。"""
 
     time.sleep(2)
-    url = f"http://{HOST}:{PORT}"
-    
+    url = f"http://{host}:{port}"
+
     print(f"--- 在默认浏览器中打开前端: {url} ---")
     webbrowser.open(url)
 
 if __name__ == "__main__":
+    args = parse_args()
+
+    if args.no_browser:
+        try:
+            start_backend(args.host, args.port, args.workers)
+        except KeyboardInterrupt:
+            print("\n--- 程序已关闭 ---")
+        raise SystemExit(0)
 
-    backend_thread = threading.Thread(target=start_backend)
-    backend_thread.daemon = True 
+    backend_thread = threading.Thread(target=start_backend, args=(args.host, args.port, args.workers))
+    backend_thread.daemon = True
     backend_thread.start()
-    open_frontend()
+    open_frontend(args.host, args.port)
 
 
     try:
         backend_thread.join()
     except KeyboardInterrupt:
         print("\n--- 程序已关闭 ---")
-        os._exit(0)
\ No newline at end of file
+        os._exit(0)
@@ -57,6 +57,9 @@ document.addEventListener('DOMContentLoaded', () => {
         errorMessage: { zh: "抱歉，服务出现了一点问题。请稍后重试。", en: "Sorry, something went wrong. Please try again later." },
         errorFetchFailed: {zh: "LLM服务不可用，请稍后再试", en: "LLM service is unavailable. Please try again later."},
         errorTooManyRequests: {zh: "今天已经使用太多，请明天再试", en: "Too many requests today. Please try again tomorrow."},
+        errorServerBusy: {zh: "当前请求较多，请稍后重试", en: "The server is busy. Please try again shortly."},
+        queuedStatus: {zh: "当前请求较多，正在排队（第 {position} 位）...", en: "Waiting in queue (position {position})..."},
+        modelProgress: {zh: "正在生成模型，已接收 {count} 字符...", en: "Generating model, {count} characters received..."},
         errorLLMParseError: {zh: "返回的动画代码解析失败，请调整提示词重新生成。", en: "Failed to parse the returned animation code. Please adjust your prompt and try again."},
     };
 
@@ -139,6 +142,7 @@ document.addEventListener('DOMContentLoaded', () => {
         // 用于跟踪正在进行的生成请求
         currentGenerationAbortController: null,
         currentGenerationChatId: null,
+        currentGenerationId: null, // 可续传生成的 ID（响应头 X-Generation-Id），主动取消时通知服务端
         pendingChatLoadId: null
     };
 
@@ -289,6 +293,53 @@ document.addEventListener('DOMContentLoaded', () => {
             }
         },
         
+        /**
+         * 批量预取字幕音频：服务端并发合成，每完成一段就推送可缓存的音频 URL
+         */
+        async prefetch(texts) {
+            if (!this.config.enabled || !texts || texts.length === 0) {
+                return;
+            }
+            const pending = [...new Set(texts.map(t => this.preprocessText(t)).filter(Boolean))]
+                .filter(t => !this.getCachedAudio(t));
+            if (pending.length === 0) {
+                return;
+            }
+            try {
+                const response = await fetch(`${config.apiBaseUrl}/api/tts/prefetch`, {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({
+                        texts: pending,
+                        language: 'zh',
+                        speed: this.config.speed,
+                    }),
+                });
+                if (!response.ok || !response.body) {
+                    return;
+                }
+                const reader = response.body.getReader();
+                const decoder = new TextDecoder('utf-8');
+                let buffer = '';
+                while (true) {
+                    const { value, done } = await reader.read();
+                    if (done) break;
+                    buffer += decoder.decode(value, { stream: true });
+                    const events = buffer.split('\n\n');
+                    buffer = events.pop();
+                    for (const event of events) {
+                        if (!event.startsWith('data: ')) continue;
+                        const item = JSON.parse(event.slice(6));
+                        if (item.url && item.text) {
+                            this.cacheAudio(item.text, `${config.apiBaseUrl}${item.url}`);
+                        }
+                    }
+                }
+            } catch (error) {
+                console.error('TTS prefetch failed:', error);
+            }
+        },
+        
         /**
          * 播放音频
          */
@@ -673,10 +724,12 @@ document.addEventListener('DOMContentLoaded', () => {
                 appState.conversationHistory.push({ role: 'user', content: prompt });
             }
 
-            const response = await fetch(`${config.apiBaseUrl}/api/model/generate`, {
+            // 流式接口：首个 token 到达即开始接收，页面显示已接收的进度
+            const response = await fetch(`${config.apiBaseUrl}/api/model/generate/stream`, {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ prompt }),
+                // 带对话 ID 时由服务端在生成完成后直接保存 HTML
+                body: JSON.stringify(chatId ? { prompt, chat_id: chatId } : { prompt }),
             });
 
             if (!response.ok) {
@@ -684,15 +737,49 @@ document.addEventListener('DOMContentLoaded', () => {
                 throw new Error(errorData.detail || `HTTP error! status: ${response.status}`);
             }
 
-            const data = await response.json();
-            const html = data?.html || '';
-            if (!html.trim()) {
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            let streamedHtml = '';
+            let fallbackText = '';
+            let savedByServer = false;
+            let finished = false;
+            while (!finished) {
+                const { done, value } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+                const frames = buffer.split('\n\n');
+                buffer = frames.pop();
+                for (const frame of frames) {
+                    if (!frame.startsWith('data: ')) continue;
+                    const data = JSON.parse(frame.substring(6));
+                    if (data.error) throw new Error(data.message || data.error);
+                    if (data.event === '[DONE]') {
+                        finished = true;
+                        break;
+                    }
+                    if (data.event === 'saved') {
+                        savedByServer = true;
+                    } else if (data.event === 'queued') {
+                        const placeholder = modelOutput.querySelector('.model-placeholder p');
+                        if (placeholder) placeholder.textContent = translations.queuedStatus[currentLang].replace('{position}', data.position);
+                    } else if (data.event === 'html_chunk') {
+                        streamedHtml += data.html;
+                        const placeholder = modelOutput.querySelector('.model-placeholder p');
+                        if (placeholder) placeholder.textContent = translations.modelProgress[currentLang].replace('{count}', streamedHtml.length);
+                    } else if (data.token) {
+                        fallbackText += data.token;
+                    }
+                }
+            }
+            const html = (streamedHtml || fallbackText).trim();
+            if (!html) {
                 throw new Error('Empty model response');
             }
 
             // 保存生成的模型HTML到对话记录
             if (chatId) {
-                await appendMessageToChat(chatId, 'assistant', html);
+                if (!savedByServer) await appendMessageToChat(chatId, 'assistant', html);
                 appState.conversationHistory.push({ role: 'assistant', content: html });
                 // 刷新对话列表以显示新创建的对话
                 refreshChats();
@@ -762,15 +849,30 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
-    async function startGeneration(topic, chatId, options = {}) {
-        const { renderUI = true, targetLog = null, mode = "animation" } = options;
-        console.log('Getting generation from backend.');
-        
-        // 取消之前的请求（如果有）
+    // 主动放弃当前生成：中止请求，并通知服务端立即取消
+    // （只断开连接时服务端会在续传宽限期内继续生成，结束后仍把结果保存到对话）
+    async function cancelCurrentGeneration() {
+        const generationId = appState.currentGenerationId;
+        appState.currentGenerationId = null;
         if (appState.currentGenerationAbortController) {
             appState.currentGenerationAbortController.abort();
             appState.currentGenerationAbortController = null;
         }
+        if (generationId) {
+            try {
+                await fetch(`${config.apiBaseUrl}/api/generations/${generationId}`, { method: 'DELETE' });
+            } catch (e) {
+                // 生成已结束或已过期时忽略
+            }
+        }
+    }
+
+    async function startGeneration(topic, chatId, options = {}) {
+        const { renderUI = true, targetLog = null, mode = "animation" } = options;
+        console.log('Getting generation from backend.');
+        
+        // 取消之前的请求（如果有），等服务端取消后再开始新的生成，避免旧结果晚于新消息保存
+        await cancelCurrentGeneration();
         
         // 创建新的 AbortController
         const abortController = new AbortController();
@@ -803,27 +905,64 @@ document.addEventListener('DOMContentLoaded', () => {
             submitButton.classList.add('disabled');
         }
         appState.accumulatedCode = '';
+        let savedByServer = false; // 服务端已在 [DONE] 之前保存助手消息（saved 事件）
         let inCodeBlock = false;
         let codeBlockElement = null;
         let textMessageElement = null; // 文字模式下的消息元素
         let reader = null; // 在函数作用域内定义，确保 finally 可以访问
+        // 断线续传：记录最后收到的事件 id，连接在 [DONE] 之前中断时从断点之后继续接收
+        let lastEventId = null;
+        let generationId = null;
+        let resumeAttempts = 0;
+        const MAX_RESUME_ATTEMPTS = 3;
+        const reconnect = async () => {
+            const resumeId = lastEventId.substring(0, lastEventId.lastIndexOf(':'));
+            while (true) {
+                resumeAttempts++;
+                await new Promise(resolve => setTimeout(resolve, 1000 * resumeAttempts));
+                try {
+                    const resumed = await fetch(`${config.apiBaseUrl}/api/generations/${resumeId}/events`, {
+                        headers: { 'Last-Event-ID': lastEventId },
+                        signal: abortController.signal
+                    });
+                    if (!resumed.ok) throw new Error(`HTTP error! status: ${resumed.status}`);
+                    return resumed.body.getReader();
+                } catch (err) {
+                    if (abortController.signal.aborted || resumeAttempts >= MAX_RESUME_ATTEMPTS) throw err;
+                }
+            }
+        };
 
         try {
             const response = await fetch(`${config.apiBaseUrl}/generate`, {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ 
-                    topic: topic, 
+                // 有对话 ID 时由服务端读取并裁剪历史，不再上传整段对话（含旧的 HTML）
+                // 动画模式由服务端流式提取 HTML，返回 html_start / html_chunk / html_done 事件
+                body: JSON.stringify(chatId ? {
+                    topic: topic,
+                    chat_id: chatId,
+                    mode: mode,  // "animation" 或 "text"
+                    html_events: mode !== "text",
+                    resumable: true
+                } : {
+                    topic: topic,
                     history: appState.conversationHistory,
-                    mode: mode  // "animation" 或 "text"
+                    mode: mode,
+                    html_events: mode !== "text",
+                    resumable: true
                 }),
                 signal: abortController.signal
             });
 
             if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
+            generationId = response.headers.get('X-Generation-Id');
+            if (generationId && appState.currentGenerationAbortController === abortController) {
+                appState.currentGenerationId = generationId;
+            }
 
             reader = response.body.getReader();
-            const decoder = new TextDecoder();
+            let decoder = new TextDecoder();
             let buffer = '';
 
             try {
@@ -839,8 +978,24 @@ document.addEventListener('DOMContentLoaded', () => {
                         break;
                     }
                     
-                    const { done, value } = await reader.read();
-                    if (done) break;
+                    let result;
+                    try {
+                        result = await reader.read();
+                    } catch (err) {
+                        if (abortController.signal.aborted || !lastEventId) throw err;
+                        result = { done: true };
+                    }
+                    const { done, value } = result;
+                    if (done) {
+                        // 收到 [DONE] 时已经返回，走到这里说明连接提前中断
+                        if (lastEventId && !abortController.signal.aborted && resumeAttempts < MAX_RESUME_ATTEMPTS) {
+                            reader = await reconnect();
+                            decoder = new TextDecoder();
+                            buffer = '';
+                            continue;
+                        }
+                        break;
+                    }
                     
                     // 再次检查是否已被取消
                     if (abortController.signal.aborted) {
@@ -857,14 +1012,22 @@ document.addEventListener('DOMContentLoaded', () => {
                     const lines = buffer.split('\n\n');
                     buffer = lines.pop();
 
-                    for (const line of lines) {
+                    for (let line of lines) {
+                        // 可续传的流中每个事件前有一行 "id: <generation_id>:<seq>"
+                        if (line.startsWith('id: ')) {
+                            const newline = line.indexOf('\n');
+                            lastEventId = line.substring(4, newline);
+                            line = line.substring(newline + 1);
+                        }
                         if (!line.startsWith('data: ')) continue;
 
                         const jsonStr = line.substring(6);
                     if (jsonStr.includes('[DONE]')) {
                         console.log('Streaming complete');
                         appState.conversationHistory.push({ role: 'assistant', content: appState.accumulatedCode });
-                        appendMessageToChat(chatId, 'assistant', appState.accumulatedCode);
+                        if (!savedByServer) {
+                            appendMessageToChat(chatId, 'assistant', appState.accumulatedCode);
+                        }
                             if (renderUI) {
                                 refreshChats();
                             }
@@ -915,9 +1078,44 @@ document.addEventListener('DOMContentLoaded', () => {
                         }
 
                         if (data.error) {
+                            if (data.type === 'AdmissionRejected') {
+                                throw new Error('Server busy, status: 503');
+                            }
                             const errorMessage = data.message || data.error || '未知错误';
                             throw new LLMParseError(errorMessage, data.type || 'SERVER_ERROR');
                         }
+
+                        if (data.event) {
+                            if (data.event === 'queued' || data.event === 'admitted') {
+                                // 上游并发已满时服务端排队，显示排队位置
+                                const statusText = agentThinkingMessage && agentThinkingMessage.querySelector('p');
+                                if (statusText) {
+                                    statusText.textContent = data.event === 'queued'
+                                        ? translations.queuedStatus[currentLang].replace('{position}', data.position)
+                                        : translations.agentThinking[currentLang];
+                                }
+                                continue;
+                            }
+                            if (data.event === 'saved') {
+                                savedByServer = true;
+                                continue;
+                            }
+                            // 服务端提取的 HTML 事件，无需在前端解析代码块标记
+                            if (data.event === 'html_start') {
+                                inCodeBlock = true;
+                                if (agentThinkingMessage) {
+                                    agentThinkingMessage.remove();
+                                    agentThinkingMessage = null;
+                                }
+                                if (renderUI) codeBlockElement = appendCodeBlock(logContainer);
+                            } else if (data.event === 'html_chunk') {
+                                appState.accumulatedCode += data.html;
+                                if (renderUI && codeBlockElement) updateCodeBlock(codeBlockElement, data.html);
+                            } else if (data.event === 'html_done') {
+                                inCodeBlock = false;
+                            }
+                            continue;
+                        }
                         const token = data.token || '';
 
                         if (mode === "text") {
@@ -989,8 +1187,8 @@ document.addEventListener('DOMContentLoaded', () => {
 
             if (error instanceof TypeError && error.message.includes('Failed to fetch')) {
                 showWarning(translations.errorFetchFailed[currentLang]);
-            } else if (error.message.includes('status: 429')) {
-                showWarning(translations.errorTooManyRequests[currentLang]);
+            } else if (error.message.includes('status: 429') || error.message.includes('status: 503')) {
+                showWarning(translations.errorServerBusy[currentLang]);
             } else if (error instanceof LLMParseError) {
                 showWarning(translations.errorLLMParseError[currentLang]);
             } else {
@@ -999,6 +1197,9 @@ document.addEventListener('DOMContentLoaded', () => {
 
             appendErrorMessage(translations.errorMessage[currentLang], logContainer);  // 保留日志中的提示
         } finally {
+            if (generationId && appState.currentGenerationId === generationId) {
+                appState.currentGenerationId = null;
+            }
             // 清理 AbortController（如果请求正常完成且未被取消）
             if (appState.currentGenerationChatId === chatId && appState.currentGenerationAbortController) {
                 appState.currentGenerationAbortController = null;
@@ -1444,6 +1645,9 @@ document.addEventListener('DOMContentLoaded', () => {
                     
                     console.log(`Found ${subtitleElements.length} subtitle elements`);
                     
+                    // 预取全部字幕音频，播放时无需再等待 TTS 往返
+                    TTSManager.prefetch(subtitleElements.map(el => el.textContent || ''));
+                    
                     // 为每个字幕元素设置监听
                     subtitleElements.forEach((subtitleEl) => {
                         // 使用 MutationObserver 监听文本变化和 class 变化
@@ -2077,8 +2281,7 @@ document.addEventListener('DOMContentLoaded', () => {
             // 如果正在为该对话生成内容，取消请求
             if (appState.currentGenerationChatId === chatId && appState.currentGenerationAbortController) {
                 console.log('Cancelling ongoing generation for deleted chat:', chatId);
-                appState.currentGenerationAbortController.abort();
-                appState.currentGenerationAbortController = null;
+                await cancelCurrentGeneration();
                 appState.currentGenerationChatId = null;
             }
             
@@ -0,0 +1,1276 @@
+import asyncio
+import bisect
+import hashlib
+import heapq
+import json
+import os
+import sys
+from typing import Dict, Iterable, List, Optional, Tuple
+
+try:
+    import aiosqlite
+except ModuleNotFoundError:
+    aiosqlite = None
+
+from artifacts import pack, unpack
+from search_index import TITLE_WEIGHT, SearchIndex, index_terms, query_terms
+
+# -----------------------------------------------------------------------
+# 对话 / 项目存储层
+#
+# 记录结构与原先内存字典保持一致：
+#   project: {"id", "name", "updated_at"}
+#   chat:    {"id", "title", "created_at", "updated_at", "project_id", "messages": [{"role", "content"}]}
+# 列表接口返回不含 messages 的摘要：{"id", "title", "updated_at", "project_id"}
+# 消息只追加不删除，消息在对话中的序号（从 0 开始）即为其稳定句柄
+#
+# 列表按 (updated_at, id) 倒序分页：after 为上一页最后一条的 (updated_at, id)，
+# 返回严格排在其后的记录；limit 为 None 时返回全部
+#
+# 产物存储：不少于 ARTIFACT_MIN_SIZE 个字符的消息正文（生成的 HTML 动画等）按 sha256 内容寻址，
+# 相同内容只存一份，消息只记录其哈希（消息中的 "artifact" 字段）；读取时透明还原正文，
+# 最后一条引用被删除时产物随之删除。产物压缩存储（见 artifacts.pack）；写入的消息可以带 "original"
+# （压缩 HTML 之前的原文），与产物一起压缩保存，按需通过 get_artifact(original=True) 取回
+#
+# 后台任务：job: {"id", "kind", "status", "payload", "chat_id", "progress", "error", "artifact",
+#                 "message_index", "worker", "created_at", "finished_at"}
+# status 依次为 queued -> running -> succeeded / failed，queued / running 时可被取消（cancelled）；
+# 结果正文存入产物表，job 只记录其哈希
+# -----------------------------------------------------------------------
+
+Cursor = Tuple[str, str]
+
+ARTIFACT_MIN_SIZE = 1024
+
+
+JOB_FINISHED = ("succeeded", "failed", "cancelled")
+
+
+def content_hash(content: str) -> str:
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def message_range(count: int, offset: int = 0, limit: Optional[int] = None) -> Tuple[int, int]:
+    """把 (offset, limit) 换算为 [start, end)；offset 为负数时从末尾倒数"""
+    start = max(count + offset, 0) if offset < 0 else min(offset, count)
+    end = count if limit is None else min(start + max(limit, 0), count)
+    return start, end
+
+
+def is_omitted(role: str, size: int, max_content: Optional[int]) -> bool:
+    """摘要模式：超过 max_content 字符的助手消息不返回正文，只返回长度"""
+    return max_content is not None and role == "assistant" and size > max_content
+
+
+def plain_message(message: dict) -> dict:
+    """导出用的原始结构 {"role", "content"}（去掉产物引用）"""
+    return {"role": message["role"], "content": message["content"]}
+
+def chat_summary(chat: dict) -> dict:
+    return {
+        "id": chat["id"],
+        "title": chat.get("title"),
+        "updated_at": chat["updated_at"],
+        "project_id": chat.get("project_id"),
+    }
+
+
+class OrderedIndex:
+    """
+    按 (updated_at, id) 升序维护的有序键列表（MemoryStore 使用）
+    分页只需二分定位游标再切片，不必每次复制并排序整个集合
+    """
+
+    def __init__(self):
+        self._keys: List[Cursor] = []
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def add(self, key: Cursor):
+        bisect.insort(self._keys, key)
+
+    def remove(self, key: Cursor):
+        pos = bisect.bisect_left(self._keys, key)
+        if pos < len(self._keys) and self._keys[pos] == key:
+            del self._keys[pos]
+
+    def page(self, limit: Optional[int] = None, after: Optional[Cursor] = None) -> List[str]:
+        """倒序返回 id 列表"""
+        end = bisect.bisect_left(self._keys, tuple(after)) if after else len(self._keys)
+        start = 0 if limit is None else max(end - limit, 0)
+        return [key[1] for key in reversed(self._keys[start:end])]
+
+
+class ChatStore:
+    """
+    存储后端接口，路由只通过这些方法访问对话与项目
+    """
+
+    async def init(self):
+        pass
+
+    async def close(self):
+        pass
+
+    # ---------------- 项目 ----------------
+    async def list_projects(self, limit: Optional[int] = None, after: Optional[Cursor] = None) -> List[dict]:
+        raise NotImplementedError
+
+    async def get_project(self, project_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def create_project(self, project: dict):
+        raise NotImplementedError
+
+    async def rename_project(self, project_id: str, name: str, updated_at: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def delete_project(self, project_id: str) -> bool:
+        """删除项目及其下所有对话，项目不存在返回 False"""
+        raise NotImplementedError
+
+    # ---------------- 对话 ----------------
+    async def list_chats(self, limit: Optional[int] = None, after: Optional[Cursor] = None) -> List[dict]:
+        raise NotImplementedError
+
+    async def list_project_chats(
+        self, project_id: str, limit: Optional[int] = None, after: Optional[Cursor] = None
+    ) -> List[dict]:
+        raise NotImplementedError
+
+    async def search_chats(self, query: str, limit: int = 50, offset: int = 0) -> List[dict]:
+        """
+        全文检索标题与消息正文（分词规则见 search_index.py）
+        按相关度排序，相关度相同按更新时间倒序
+        """
+        raise NotImplementedError
+
+    async def create_chat(self, chat: dict):
+        raise NotImplementedError
+
+    async def get_chat(
+        self,
+        chat_id: str,
+        offset: int = 0,
+        limit: Optional[int] = None,
+        max_content: Optional[int] = None,
+    ) -> Optional[dict]:
+        """
+        返回对话及 [offset, offset + limit) 范围内的消息，附带 message_count / message_offset
+        max_content 不为 None 时大段助手消息正文替换为 None（见 is_omitted），通过 get_message 单独获取
+        """
+        raise NotImplementedError
+
+    async def get_message(self, chat_id: str, index: int) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def chat_exists(self, chat_id: str) -> bool:
+        raise NotImplementedError
+
+    async def append_message(
+        self,
+        chat_id: str,
+        message: dict,
+        updated_at: str,
+        default_title: Optional[str] = None,
+    ) -> Optional[dict]:
+        """
+        追加一条消息；对话尚无标题时使用 default_title
+        返回更新后的对话摘要（附带新消息的序号 message_index 与产物哈希 artifact），对话不存在返回 None
+        """
+        raise NotImplementedError
+
+    async def get_artifact(self, artifact_id: str, original: bool = False) -> Optional[str]:
+        """按内容哈希读取产物正文；original 为 True 时返回压缩 HTML 之前的原文（未单独保存时即正文）"""
+        packed = await self.get_artifact_data(artifact_id, original)
+        return unpack(*packed) if packed else None
+
+    async def get_artifact_data(self, artifact_id: str, original: bool = False) -> Optional[Tuple[bytes, Optional[str]]]:
+        """产物的压缩存储 (字节, 编码)，可直接作为对应 Content-Encoding 的响应体"""
+        raise NotImplementedError
+
+    async def artifact_stats(self) -> dict:
+        """产物数、正文字符数与压缩后的存储字节数"""
+        raise NotImplementedError
+
+    # ---------------- 后台任务 ----------------
+    async def create_job(self, job: dict):
+        raise NotImplementedError
+
+    async def get_job(self, job_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def claim_job(self, worker: str, now: float, stale_before: float) -> Optional[dict]:
+        """
+        领取最早排队的任务（或心跳早于 stale_before 的执行中任务，即 worker 已失联）并标记为 running
+        多个进程同时领取时每个任务只会被一个 worker 拿到
+        """
+        raise NotImplementedError
+
+    async def heartbeat_job(self, job_id: str, worker: str, progress: int, now: float) -> Optional[str]:
+        """记录进度与心跳，返回任务当前状态；已被取消时不再写入，被其他 worker 接管时返回 lost"""
+        raise NotImplementedError
+
+    async def finish_job(
+        self,
+        job_id: str,
+        worker: str,
+        status: str,
+        finished_at: str,
+        content: Optional[str] = None,
+        error: Optional[str] = None,
+        message_index: Optional[int] = None,
+        original: Optional[str] = None,
+    ) -> bool:
+        """结束任务并保存结果（content 存入产物表，original 同上）；任务已被取消或被其他 worker 接管时返回 False"""
+        raise NotImplementedError
+
+    async def cancel_job(self, job_id: str, finished_at: str) -> Optional[dict]:
+        """取消排队中或执行中的任务，返回任务当前记录，任务不存在返回 None"""
+        raise NotImplementedError
+
+    async def purge_jobs(self, finished_before: str) -> int:
+        """删除 finished_before 之前结束的任务，返回删除数"""
+        raise NotImplementedError
+
+    async def rename_chat(self, chat_id: str, title: Optional[str], updated_at: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def delete_chat(self, chat_id: str) -> bool:
+        raise NotImplementedError
+
+    # ---------------- 迁移 ----------------
+    async def export_snapshot(self) -> dict:
+        """导出为原内存字典结构：{"projects": {id: project}, "chats": {id: chat}}"""
+        raise NotImplementedError
+
+    async def import_snapshot(self, snapshot: dict):
+        """导入原内存字典结构（PROJECTS_DICT / CHAT_STORE 形状），已存在的记录会被覆盖"""
+        raise NotImplementedError
+
+
+class _Artifact:
+    """MemoryStore 中的产物：压缩后的正文与原文、正文字符数、引用数"""
+
+    __slots__ = ("data", "encoding", "original", "size", "refs")
+
+    def __init__(self, content: str, original: Optional[str] = None):
+        self.data, self.encoding = pack(content)
+        self.original = pack(original, self.encoding)[0] if original and original != content else None
+        self.size = len(content)
+        self.refs = 0
+
+
+class MemoryStore(ChatStore):
+    """
+    进程内字典存储（原 PROJECTS_DICT / CHAT_STORE 行为），重启即丢失，仅适合开发调试
+    """
+
+    def __init__(self):
+        # 使用字典优化查找性能 O(1) 替代 O(n)
+        self.projects: Dict[str, dict] = {}
+        self.chats: Dict[str, dict] = {}
+        # 并发保护锁
+        self._projects_lock = asyncio.Lock()
+        self._chats_lock = asyncio.Lock()
+        # 全文索引，随写操作增量维护（受 _chats_lock 保护）
+        self.search_index = SearchIndex()
+        # 按更新时间排序的索引，以及 project_id -> 该项目对话的有序索引
+        self._project_order = OrderedIndex()
+        self._chat_order = OrderedIndex()
+        self._project_chats: Dict[str, OrderedIndex] = {}
+        # 内容哈希 -> 压缩后的产物（受 _chats_lock 保护），消息只保留哈希与长度
+        self.artifacts: Dict[str, _Artifact] = {}
+        # 后台任务（按提交顺序），心跳时间单独记录
+        self.jobs: Dict[str, dict] = {}
+        self._job_heartbeats: Dict[str, float] = {}
+
+    def _intern(self, message: dict) -> dict:
+        """大段正文登记为产物（相同内容只压缩保存一份），消息只记录哈希与长度"""
+        content = message.get("content") or ""
+        if len(content) < ARTIFACT_MIN_SIZE:
+            return {"role": message["role"], "content": content}
+        artifact_id = self._retain(content, message.get("original"))
+        return {"role": message["role"], "artifact": artifact_id, "size": len(content)}
+
+    def _release(self, messages: List[dict]):
+        for msg in messages:
+            entry = self.artifacts.get(msg.get("artifact") or "")
+            if entry is not None:
+                entry.refs -= 1
+                if entry.refs <= 0:
+                    del self.artifacts[msg["artifact"]]
+
+    def _retain(self, content: str, original: Optional[str] = None) -> str:
+        artifact_id = content_hash(content)
+        entry = self.artifacts.get(artifact_id)
+        if entry is None:
+            entry = self.artifacts[artifact_id] = _Artifact(content, original)
+        entry.refs += 1
+        return artifact_id
+
+    def _content(self, message: dict) -> str:
+        if message.get("artifact"):
+            entry = self.artifacts[message["artifact"]]
+            return unpack(entry.data, entry.encoding)
+        return message["content"]
+
+    def _view(self, message: dict, max_content: Optional[int] = None) -> dict:
+        size = message["size"] if message.get("artifact") else len(message["content"])
+        if is_omitted(message["role"], size, max_content):
+            result = {"role": message["role"], "content": None, "size": size}
+        else:
+            result = {"role": message["role"], "content": self._content(message)}
+        if message.get("artifact"):
+            result["artifact"] = message["artifact"]
+        return result
+
+    def _order_chat(self, chat: dict):
+        key = (chat["updated_at"], chat["id"])
+        self._chat_order.add(key)
+        self._project_chats.setdefault(chat.get("project_id") or "", OrderedIndex()).add(key)
+
+    def _unorder_chat(self, chat: dict):
+        key = (chat["updated_at"], chat["id"])
+        self._chat_order.remove(key)
+        project_key = chat.get("project_id") or ""
+        index = self._project_chats.get(project_key)
+        if index is not None:
+            index.remove(key)
+            if not index:
+                del self._project_chats[project_key]
+
+    async def list_projects(self, limit=None, after=None) -> List[dict]:
+        async with self._projects_lock:
+            return [dict(self.projects[pid]) for pid in self._project_order.page(limit, after)]
+
+    async def get_project(self, project_id: str) -> Optional[dict]:
+        async with self._projects_lock:
+            project = self.projects.get(project_id)
+            return dict(project) if project else None
+
+    async def create_project(self, project: dict):
+        async with self._projects_lock:
+            old = self.projects.get(project["id"])
+            if old:
+                self._project_order.remove((old["updated_at"], old["id"]))
+            self.projects[project["id"]] = dict(project)
+            self._project_order.add((project["updated_at"], project["id"]))
+
+    async def rename_project(self, project_id: str, name: str, updated_at: str) -> Optional[dict]:
+        async with self._projects_lock:
+            project = self.projects.get(project_id)
+            if not project:
+                return None
+            self._project_order.remove((project["updated_at"], project_id))
+            project["name"] = name
+            project["updated_at"] = updated_at
+            self._project_order.add((updated_at, project_id))
+            return dict(project)
+
+    async def delete_project(self, project_id: str) -> bool:
+        async with self._projects_lock:
+            project = self.projects.pop(project_id, None)
+            if project is None:
+                return False
+            self._project_order.remove((project["updated_at"], project_id))
+        # 删除关联的chats（通过项目索引定位，不扫描全部对话）
+        async with self._chats_lock:
+            index = self._project_chats.get(project_id)
+            for chat_id in index.page() if index else []:
+                chat = self.chats.pop(chat_id)
+                self._unorder_chat(chat)
+                self._release(chat["messages"])
+                self.search_index.remove_chat(chat_id)
+        return True
+
+    async def list_chats(self, limit=None, after=None) -> List[dict]:
+        async with self._chats_lock:
+            return [chat_summary(self.chats[cid]) for cid in self._chat_order.page(limit, after)]
+
+    async def list_project_chats(self, project_id: str, limit=None, after=None) -> List[dict]:
+        async with self._chats_lock:
+            index = self._project_chats.get(project_id)
+            if index is None:
+                return []
+            return [chat_summary(self.chats[cid]) for cid in index.page(limit, after)]
+
+    async def search_chats(self, query: str, limit: int = 50, offset: int = 0) -> List[dict]:
+        async with self._chats_lock:
+            hits = [
+                (score, self.chats[chat_id])
+                for chat_id, score in self.search_index.search(query)
+                if chat_id in self.chats
+            ]
+            # 只取前 offset + limit 条，避免对全部命中排序
+            top = heapq.nlargest(offset + limit, hits, key=lambda h: (h[0], h[1]["updated_at"]))
+            return [chat_summary(chat) for _, chat in top[offset:]]
+
+    async def create_chat(self, chat: dict):
+        async with self._chats_lock:
+            messages = chat.get("messages") or []
+            chat = {**chat, "messages": [self._intern(msg) for msg in messages]}
+            old = self.chats.get(chat["id"])
+            if old:
+                self._unorder_chat(old)
+                self._release(old["messages"])
+            self.chats[chat["id"]] = chat
+            self._order_chat(chat)
+            self.search_index.remove_chat(chat["id"])
+            self.search_index.set_title(chat["id"], chat.get("title"))
+            for position, msg in enumerate(messages):
+                self.search_index.add_message(chat["id"], position, msg.get("content") or "")
+
+    async def get_chat(self, chat_id, offset=0, limit=None, max_content=None):
+        async with self._chats_lock:
+            chat = self.chats.get(chat_id)
+            if not chat:
+                return None
+            count = len(chat["messages"])
+            start, end = message_range(count, offset, limit)
+            return {
+                **chat,
+                "messages": [self._view(msg, max_content) for msg in chat["messages"][start:end]],
+                "message_count": count,
+                "message_offset": start,
+            }
+
+    async def get_message(self, chat_id: str, index: int) -> Optional[dict]:
+        async with self._chats_lock:
+            chat = self.chats.get(chat_id)
+            if not chat or not 0 <= index < len(chat["messages"]):
+                return None
+            return self._view(chat["messages"][index])
+
+    async def chat_exists(self, chat_id: str) -> bool:
+        async with self._chats_lock:
+            return chat_id in self.chats
+
+    async def append_message(self, chat_id, message, updated_at, default_title=None):
+        async with self._chats_lock:
+            chat = self.chats.get(chat_id)
+            if not chat:
+                return None
+            stored = self._intern(message)
+            chat["messages"].append(stored)
+            self.search_index.add_message(chat_id, len(chat["messages"]) - 1, message.get("content") or "")
+            if not chat["title"] and default_title:
+                chat["title"] = default_title
+                self.search_index.set_title(chat_id, default_title)
+            self._unorder_chat(chat)
+            chat["updated_at"] = updated_at
+            self._order_chat(chat)
+            return {
+                **chat_summary(chat),
+                "message_index": len(chat["messages"]) - 1,
+                "artifact": stored.get("artifact"),
+            }
+
+    async def get_artifact_data(self, artifact_id, original=False):
+        async with self._chats_lock:
+            entry = self.artifacts.get(artifact_id)
+            if entry is None:
+                return None
+            return (entry.original if original and entry.original is not None else entry.data), entry.encoding
+
+    async def artifact_stats(self):
+        async with self._chats_lock:
+            entries = list(self.artifacts.values())
+        return {
+            "count": len(entries),
+            "chars": sum(entry.size for entry in entries),
+            "stored_bytes": sum(len(entry.data) for entry in entries),
+            "original_bytes": sum(len(entry.original) for entry in entries if entry.original is not None),
+        }
+
+    async def create_job(self, job: dict):
+        async with self._chats_lock:
+            self.jobs[job["id"]] = {**job, "payload": dict(job.get("payload") or {})}
+
+    async def get_job(self, job_id: str) -> Optional[dict]:
+        async with self._chats_lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    async def claim_job(self, worker, now, stale_before):
+        async with self._chats_lock:
+            for job in self.jobs.values():
+                stale = job["status"] == "running" and self._job_heartbeats.get(job["id"], 0) < stale_before
+                if job["status"] == "queued" or stale:
+                    job["status"] = "running"
+                    job["worker"] = worker
+                    self._job_heartbeats[job["id"]] = now
+                    return dict(job)
+            return None
+
+    async def heartbeat_job(self, job_id, worker, progress, now):
+        async with self._chats_lock:
+            job = self.jobs.get(job_id)
+            if not job:
+                return None
+            if job["status"] == "running" and job["worker"] == worker:
+                job["progress"] = progress
+                self._job_heartbeats[job_id] = now
+                return job["status"]
+            return job["status"] if job["worker"] == worker else "lost"
+
+    async def finish_job(
+        self, job_id, worker, status, finished_at, content=None, error=None, message_index=None, original=None
+    ):
+        async with self._chats_lock:
+            job = self.jobs.get(job_id)
+            if not job or job["status"] != "running" or job["worker"] != worker:
+                return False
+            if content is not None:
+                job["artifact"] = self._retain(content, original)
+                job["progress"] = len(content)
+            job.update(status=status, error=error, message_index=message_index, finished_at=finished_at)
+            self._job_heartbeats.pop(job_id, None)
+            return True
+
+    async def cancel_job(self, job_id, finished_at):
+        async with self._chats_lock:
+            job = self.jobs.get(job_id)
+            if not job:
+                return None
+            if job["status"] not in JOB_FINISHED:
+                job.update(status="cancelled", finished_at=finished_at)
+                self._job_heartbeats.pop(job_id, None)
+            return dict(job)
+
+    async def purge_jobs(self, finished_before):
+        async with self._chats_lock:
+            expired = [
+                job for job in self.jobs.values()
+                if job["status"] in JOB_FINISHED and (job.get("finished_at") or "") < finished_before
+            ]
+            for job in expired:
+                del self.jobs[job["id"]]
+                self._release([job])
+            return len(expired)
+
+    async def rename_chat(self, chat_id, title, updated_at):
+        async with self._chats_lock:
+            chat = self.chats.get(chat_id)
+            if not chat:
+                return None
+            self._unorder_chat(chat)
+            chat["title"] = title
+            chat["updated_at"] = updated_at
+            self._order_chat(chat)
+            self.search_index.set_title(chat_id, title)
+            return chat_summary(chat)
+
+    async def delete_chat(self, chat_id: str) -> bool:
+        async with self._chats_lock:
+            chat = self.chats.pop(chat_id, None)
+            if chat is None:
+                return False
+            self._unorder_chat(chat)
+            self._release(chat["messages"])
+            self.search_index.remove_chat(chat_id)
+            return True
+
+    async def export_snapshot(self) -> dict:
+        async with self._projects_lock:
+            projects = {pid: dict(p) for pid, p in self.projects.items()}
+        async with self._chats_lock:
+            chats = {
+                cid: {**c, "messages": [plain_message(self._view(m)) for m in c["messages"]]}
+                for cid, c in self.chats.items()
+            }
+        return {"projects": projects, "chats": chats}
+
+    async def import_snapshot(self, snapshot: dict):
+        for project in _snapshot_records(snapshot, "projects"):
+            await self.create_project(project)
+        for chat in _snapshot_records(snapshot, "chats"):
+            await self.create_chat(chat)
+
+
+class SQLiteStore(ChatStore):
+    """
+    SQLite 存储（WAL 模式，aiosqlite 异步驱动）
+
+    - projects / chats 按 (updated_at, id)、(project_id, updated_at, id) 建索引，
+      列表分页为键集分页（WHERE (updated_at, id) < 游标），每页只读取 limit 行
+    - 消息单独成表，append_message 只插入一行，不重写整个对话
+    - 全文检索使用 FTS5：标题与每条消息各是一篇文档（search_docs 记录归属），
+      写入时在 Python 侧分词后存入 chat_fts，随写操作增量维护
+    - 大段消息正文存入 artifacts 表（主键为内容哈希），消息行只记录 artifact_id
+    - 后台任务存于 jobs 表，领取任务为单条 UPDATE ... RETURNING，多个 worker 进程不会重复领取
+    - WAL 模式下多个读者与一个写者可并发，多个 worker 进程可共享同一个数据库文件
+    """
+
+    SCHEMA_VERSION = 6
+
+    def __init__(self, path: str):
+        if aiosqlite is None:
+            raise RuntimeError("SQLite 存储需要 aiosqlite，请先执行 pip install aiosqlite")
+        self.path = path
+        self._db = None
+        # 写事务串行化（单连接内不能嵌套事务）
+        self._write_lock = asyncio.Lock()
+
+    async def init(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        self._db = await aiosqlite.connect(self.path)
+        self._db.row_factory = aiosqlite.Row
+        await self._db.execute("PRAGMA journal_mode=WAL")
+        await self._db.execute("PRAGMA synchronous=NORMAL")
+        await self._db.execute("PRAGMA foreign_keys=ON")
+        await self._db.execute("PRAGMA busy_timeout=5000")
+        await self._migrate()
+
+    async def close(self):
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    async def _migrate(self):
+        """
+        多个 worker 进程同时启动时迁移必须串行：BEGIN IMMEDIATE 取得写锁后再读取版本号，
+        后到的进程等待锁释放后看到已是最新版本，直接跳过。各步骤逐条 execute
+        （executescript 会先隐式提交，使后续语句脱离事务）
+        """
+        # 迁移大库可能耗时较长，等待写锁的时间放宽
+        await self._db.execute("PRAGMA busy_timeout=60000")
+        try:
+            await self._db.execute("BEGIN IMMEDIATE")
+            try:
+                async with self._db.execute("PRAGMA user_version") as cursor:
+                    version = (await cursor.fetchone())[0]
+                if version < self.SCHEMA_VERSION:
+                    await self._upgrade(version)
+                    await self._db.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+                await self._db.commit()
+            except BaseException:
+                await self._db.rollback()
+                raise
+        finally:
+            await self._db.execute("PRAGMA busy_timeout=5000")
+
+    async def _execute_all(self, statements: Iterable[str]):
+        for statement in statements:
+            await self._db.execute(statement)
+
+    async def _upgrade(self, version: int):
+        if version < 1:
+            await self._execute_all((
+                """
+                CREATE TABLE IF NOT EXISTS projects (
+                    id TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    updated_at TEXT NOT NULL
+                )
+                """,
+                "CREATE INDEX IF NOT EXISTS idx_projects_updated_at ON projects(updated_at)",
+                """
+                CREATE TABLE IF NOT EXISTS chats (
+                    id TEXT PRIMARY KEY,
+                    title TEXT,
+                    created_at TEXT NOT NULL,
+                    updated_at TEXT NOT NULL,
+                    project_id TEXT
+                )
+                """,
+                "CREATE INDEX IF NOT EXISTS idx_chats_updated_at ON chats(updated_at)",
+                "CREATE INDEX IF NOT EXISTS idx_chats_project_updated_at ON chats(project_id, updated_at)",
+                """
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id TEXT NOT NULL REFERENCES chats(id) ON DELETE CASCADE,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL
+                )
+                """,
+                "CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages(chat_id, id)",
+            ))
+        if version < 2:
+            await self._execute_all((
+                """
+                CREATE TABLE IF NOT EXISTS search_docs (
+                    doc_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id TEXT NOT NULL REFERENCES chats(id) ON DELETE CASCADE,
+                    is_title INTEGER NOT NULL DEFAULT 0
+                )
+                """,
+                "CREATE INDEX IF NOT EXISTS idx_search_docs_chat_id ON search_docs(chat_id, is_title)",
+                "CREATE VIRTUAL TABLE IF NOT EXISTS chat_fts USING fts5(tokens)",
+            ))
+            # 为已有数据建立索引
+            for chat in await self._fetchall("SELECT id, title FROM chats"):
+                await self._index_doc(chat["id"], chat["title"], is_title=True)
+            for msg in await self._fetchall("SELECT chat_id, content FROM messages ORDER BY id"):
+                await self._index_doc(msg["chat_id"], msg["content"])
+        if version < 3:
+            # 索引带上 id，保证 updated_at 相同时游标分页顺序稳定
+            await self._execute_all((
+                "DROP INDEX IF EXISTS idx_projects_updated_at",
+                "DROP INDEX IF EXISTS idx_chats_updated_at",
+                "DROP INDEX IF EXISTS idx_chats_project_updated_at",
+                "CREATE INDEX IF NOT EXISTS idx_projects_order ON projects(updated_at, id)",
+                "CREATE INDEX IF NOT EXISTS idx_chats_order ON chats(updated_at, id)",
+                "CREATE INDEX IF NOT EXISTS idx_chats_project_order ON chats(project_id, updated_at, id)",
+            ))
+        if version < 4:
+            await self._execute_all((
+                """
+                CREATE TABLE IF NOT EXISTS artifacts (
+                    id TEXT PRIMARY KEY,
+                    content TEXT NOT NULL,
+                    size INTEGER NOT NULL
+                )
+                """,
+                "ALTER TABLE messages ADD COLUMN artifact_id TEXT REFERENCES artifacts(id)",
+                "CREATE INDEX IF NOT EXISTS idx_messages_artifact_id ON messages(artifact_id)",
+            ))
+            # 已有的大段消息迁入产物表（此时仍为未压缩的 content 列，由版本 6 的迁移压缩）
+            rows = await self._fetchall(
+                "SELECT id, content FROM messages WHERE length(content) >= ?", (ARTIFACT_MIN_SIZE,)
+            )
+            for row in rows:
+                artifact_id = content_hash(row["content"])
+                await self._db.execute(
+                    "INSERT OR IGNORE INTO artifacts (id, content, size) VALUES (?, ?, ?)",
+                    (artifact_id, row["content"], len(row["content"])),
+                )
+                await self._db.execute(
+                    "UPDATE messages SET content = '', artifact_id = ? WHERE id = ?",
+                    (artifact_id, row["id"]),
+                )
+        if version < 5:
+            await self._execute_all((
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    chat_id TEXT,
+                    progress INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    artifact_id TEXT REFERENCES artifacts(id),
+                    message_index INTEGER,
+                    worker TEXT,
+                    heartbeat REAL,
+                    created_at TEXT NOT NULL,
+                    finished_at TEXT
+                )
+                """,
+                "CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, created_at)",
+                "CREATE INDEX IF NOT EXISTS idx_jobs_artifact_id ON jobs(artifact_id)",
+            ))
+        if version < 6:
+            # 产物改为压缩存储：data 为压缩后的正文，original 为压缩 HTML 之前的原文（相同时为空），content 列不再使用
+            await self._execute_all((
+                "ALTER TABLE artifacts ADD COLUMN data BLOB",
+                "ALTER TABLE artifacts ADD COLUMN encoding TEXT",
+                "ALTER TABLE artifacts ADD COLUMN original BLOB",
+            ))
+            for row in await self._fetchall("SELECT id, content FROM artifacts WHERE data IS NULL"):
+                data, encoding = pack(row["content"])
+                await self._db.execute(
+                    "UPDATE artifacts SET data = ?, encoding = ?, content = '' WHERE id = ?",
+                    (data, encoding, row["id"]),
+                )
+
+    async def _fetchall(self, sql: str, params=()) -> list:
+        async with self._db.execute(sql, params) as cursor:
+            return await cursor.fetchall()
+
+    async def _fetchone(self, sql: str, params=()):
+        async with self._db.execute(sql, params) as cursor:
+            return await cursor.fetchone()
+
+    async def _fetch_page(self, sql: str, params: tuple, limit, after, where: str = "") -> list:
+        """sql 为不含 WHERE/ORDER BY 的 SELECT，where 为额外过滤条件"""
+        conditions = [where] if where else []
+        if after:
+            conditions.append("(updated_at, id) < (?, ?)")
+            params = params + (after[0], after[1])
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY updated_at DESC, id DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params = params + (limit,)
+        return [dict(row) for row in await self._fetchall(sql, params)]
+
+    # ---------------- 产物 ----------------
+    async def _store_content(
+        self, content: str, force: bool = False, original: Optional[str] = None
+    ) -> Tuple[str, Optional[str]]:
+        """
+        返回消息行实际写入的 (content, artifact_id)：大段正文（force 时不论长短）压缩后写入产物表，
+        已存在则复用（不重复压缩）
+        """
+        if len(content) < ARTIFACT_MIN_SIZE and not force:
+            return content, None
+        artifact_id = content_hash(content)
+        if await self._fetchone("SELECT 1 FROM artifacts WHERE id = ?", (artifact_id,)) is None:
+            data, encoding = pack(content)
+            original_data = pack(original, encoding)[0] if original and original != content else None
+            await self._db.execute(
+                "INSERT OR IGNORE INTO artifacts (id, content, size, data, encoding, original) "
+                "VALUES (?, '', ?, ?, ?, ?)",
+                (artifact_id, len(content), data, encoding, original_data),
+            )
+        return "", artifact_id
+
+    async def _chat_artifacts(self, where: str, params: tuple) -> List[str]:
+        rows = await self._fetchall(
+            f"SELECT DISTINCT artifact_id FROM messages WHERE artifact_id IS NOT NULL AND chat_id IN ({where})",
+            params,
+        )
+        return [row["artifact_id"] for row in rows]
+
+    async def _release_artifacts(self, artifact_ids: List[str]):
+        """删除不再被任何消息或任务引用的产物"""
+        for artifact_id in artifact_ids:
+            await self._db.execute(
+                "DELETE FROM artifacts WHERE id = ? "
+                "AND NOT EXISTS (SELECT 1 FROM messages WHERE artifact_id = ?) "
+                "AND NOT EXISTS (SELECT 1 FROM jobs WHERE artifact_id = ?)",
+                (artifact_id, artifact_id, artifact_id),
+            )
+
+    async def get_artifact_data(self, artifact_id, original=False):
+        row = await self._fetchone("SELECT data, encoding, original FROM artifacts WHERE id = ?", (artifact_id,))
+        if row is None:
+            return None
+        return (row["original"] if original and row["original"] is not None else row["data"]), row["encoding"]
+
+    async def artifact_stats(self):
+        row = await self._fetchone(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(length(data)), 0), "
+            "COALESCE(SUM(length(original)), 0) FROM artifacts"
+        )
+        return {"count": row[0], "chars": row[1], "stored_bytes": row[2], "original_bytes": row[3]}
+
+    # ---------------- 后台任务 ----------------
+    async def create_job(self, job: dict):
+        async with self._write_lock:
+            await self._db.execute(
+                "INSERT INTO jobs (id, kind, status, payload, chat_id, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    job["id"],
+                    job["kind"],
+                    job["status"],
+                    json.dumps(job.get("payload") or {}, ensure_ascii=False),
+                    job.get("chat_id"),
+                    job["created_at"],
+                ),
+            )
+            await self._db.commit()
+
+    async def get_job(self, job_id: str) -> Optional[dict]:
+        row = await self._fetchone(f"SELECT {_JOB_COLUMNS} FROM jobs WHERE id = ?", (job_id,))
+        return _job_from_row(row) if row else None
+
+    async def claim_job(self, worker, now, stale_before):
+        async with self._write_lock:
+            row = await self._fetchone(
+                f"UPDATE jobs SET status = 'running', worker = ?, heartbeat = ? WHERE id = ("
+                "SELECT id FROM jobs WHERE status = 'queued' OR (status = 'running' AND heartbeat < ?) "
+                f"ORDER BY created_at LIMIT 1) RETURNING {_JOB_COLUMNS}",
+                (worker, now, stale_before),
+            )
+            await self._db.commit()
+        return _job_from_row(row) if row else None
+
+    async def heartbeat_job(self, job_id, worker, progress, now):
+        async with self._write_lock:
+            await self._db.execute(
+                "UPDATE jobs SET progress = ?, heartbeat = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                (progress, now, job_id, worker),
+            )
+            await self._db.commit()
+        row = await self._fetchone("SELECT status, worker FROM jobs WHERE id = ?", (job_id,))
+        if row is None:
+            return None
+        return row["status"] if row["worker"] == worker else "lost"
+
+    async def finish_job(
+        self, job_id, worker, status, finished_at, content=None, error=None, message_index=None, original=None
+    ):
+        async with self._write_lock:
+            row = await self._fetchone(
+                "SELECT 1 FROM jobs WHERE id = ? AND worker = ? AND status = 'running'", (job_id, worker)
+            )
+            if row is None:
+                return False
+            artifact_id = None
+            if content is not None:
+                _, artifact_id = await self._store_content(content, force=True, original=original)
+            await self._db.execute(
+                "UPDATE jobs SET status = ?, error = ?, artifact_id = ?, message_index = ?, finished_at = ?, "
+                "progress = CASE WHEN ? IS NULL THEN progress ELSE ? END WHERE id = ?",
+                (
+                    status, error, artifact_id, message_index, finished_at,
+                    content, len(content) if content is not None else None, job_id,
+                ),
+            )
+            await self._db.commit()
+        return True
+
+    async def cancel_job(self, job_id, finished_at):
+        async with self._write_lock:
+            await self._db.execute(
+                "UPDATE jobs SET status = 'cancelled', finished_at = ? "
+                "WHERE id = ? AND status IN ('queued', 'running')",
+                (finished_at, job_id),
+            )
+            await self._db.commit()
+        return await self.get_job(job_id)
+
+    async def purge_jobs(self, finished_before):
+        async with self._write_lock:
+            rows = await self._fetchall(
+                "DELETE FROM jobs WHERE status IN ('succeeded', 'failed', 'cancelled') AND finished_at < ? "
+                "RETURNING artifact_id",
+                (finished_before,),
+            )
+            await self._release_artifacts({row["artifact_id"] for row in rows if row["artifact_id"]})
+            await self._db.commit()
+        return len(rows)
+
+    # ---------------- 全文索引 ----------------
+    async def _index_doc(self, chat_id: str, text: Optional[str], is_title: bool = False):
+        terms = index_terms(text or "")
+        if not terms:
+            return
+        cursor = await self._db.execute(
+            "INSERT INTO search_docs (chat_id, is_title) VALUES (?, ?)", (chat_id, int(is_title))
+        )
+        await self._db.execute(
+            "INSERT INTO chat_fts (rowid, tokens) VALUES (?, ?)", (cursor.lastrowid, " ".join(terms))
+        )
+
+    async def _unindex_chat(self, chat_id: str, titles_only: bool = False):
+        condition = "chat_id = ? AND is_title = 1" if titles_only else "chat_id = ?"
+        await self._db.execute(
+            f"DELETE FROM chat_fts WHERE rowid IN (SELECT doc_id FROM search_docs WHERE {condition})",
+            (chat_id,),
+        )
+        await self._db.execute(f"DELETE FROM search_docs WHERE {condition}", (chat_id,))
+
+    # ---------------- 项目 ----------------
+    async def list_projects(self, limit=None, after=None) -> List[dict]:
+        return await self._fetch_page("SELECT id, name, updated_at FROM projects", (), limit, after)
+
+    async def get_project(self, project_id: str) -> Optional[dict]:
+        row = await self._fetchone(
+            "SELECT id, name, updated_at FROM projects WHERE id = ?", (project_id,)
+        )
+        return dict(row) if row else None
+
+    async def create_project(self, project: dict):
+        async with self._write_lock:
+            await self._db.execute(
+                "INSERT INTO projects (id, name, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET name = excluded.name, updated_at = excluded.updated_at",
+                (project["id"], project["name"], project["updated_at"]),
+            )
+            await self._db.commit()
+
+    async def rename_project(self, project_id: str, name: str, updated_at: str) -> Optional[dict]:
+        async with self._write_lock:
+            cursor = await self._db.execute(
+                "UPDATE projects SET name = ?, updated_at = ? WHERE id = ?",
+                (name, updated_at, project_id),
+            )
+            await self._db.commit()
+        if cursor.rowcount == 0:
+            return None
+        return {"id": project_id, "name": name, "updated_at": updated_at}
+
+    async def delete_project(self, project_id: str) -> bool:
+        async with self._write_lock:
+            cursor = await self._db.execute("DELETE FROM projects WHERE id = ?", (project_id,))
+            if cursor.rowcount == 0:
+                await self._db.rollback()
+                return False
+            # 删除关联的chats（消息通过外键级联删除）
+            for row in await self._fetchall("SELECT id FROM chats WHERE project_id = ?", (project_id,)):
+                await self._unindex_chat(row["id"])
+            artifact_ids = await self._chat_artifacts("SELECT id FROM chats WHERE project_id = ?", (project_id,))
+            await self._db.execute("DELETE FROM chats WHERE project_id = ?", (project_id,))
+            await self._release_artifacts(artifact_ids)
+            await self._db.commit()
+        return True
+
+    # ---------------- 对话 ----------------
+    async def list_chats(self, limit=None, after=None) -> List[dict]:
+        return await self._fetch_page(
+            "SELECT id, title, updated_at, project_id FROM chats", (), limit, after
+        )
+
+    async def list_project_chats(self, project_id: str, limit=None, after=None) -> List[dict]:
+        return await self._fetch_page(
+            "SELECT id, title, updated_at, project_id FROM chats", (project_id,), limit, after,
+            where="project_id = ?",
+        )
+
+    async def search_chats(self, query: str, limit: int = 50, offset: int = 0) -> List[dict]:
+        terms = query_terms(query)
+        if not terms:
+            return []
+        # 每个词项作为短语并列，FTS5 中即为 AND
+        match = " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+        # rank 即 bm25，越小越相关；标题命中按权重放大
+        rows = await self._fetchall(
+            "SELECT c.id, c.title, c.updated_at, c.project_id, "
+            "MIN(hits.rank * CASE WHEN d.is_title THEN ? ELSE 1.0 END) AS score "
+            "FROM (SELECT rowid, rank FROM chat_fts WHERE chat_fts MATCH ?) hits "
+            "JOIN search_docs d ON d.doc_id = hits.rowid "
+            "JOIN chats c ON c.id = d.chat_id "
+            "GROUP BY c.id "
+            "ORDER BY score, c.updated_at DESC LIMIT ? OFFSET ?",
+            (TITLE_WEIGHT, match, limit, offset),
+        )
+        return [
+            {"id": row["id"], "title": row["title"], "updated_at": row["updated_at"], "project_id": row["project_id"]}
+            for row in rows
+        ]
+
+    async def create_chat(self, chat: dict):
+        async with self._write_lock:
+            await self._insert_chat(chat)
+            await self._db.commit()
+
+    async def _insert_chat(self, chat: dict):
+        await self._db.execute(
+            "INSERT INTO chats (id, title, created_at, updated_at, project_id) "
+            "VALUES (?, ?, ?, ?, ?) ON CONFLICT(id) DO UPDATE SET "
+            "title = excluded.title, created_at = excluded.created_at, "
+            "updated_at = excluded.updated_at, project_id = excluded.project_id",
+            (
+                chat["id"],
+                chat.get("title"),
+                chat.get("created_at") or chat["updated_at"],
+                chat["updated_at"],
+                chat.get("project_id"),
+            ),
+        )
+        messages = chat.get("messages") or []
+        if messages:
+            artifact_ids = await self._chat_artifacts("?", (chat["id"],))
+            await self._db.execute("DELETE FROM messages WHERE chat_id = ?", (chat["id"],))
+            rows = []
+            for msg in messages:
+                content, artifact_id = await self._store_content(msg["content"], original=msg.get("original"))
+                rows.append((chat["id"], msg["role"], content, artifact_id))
+            await self._db.executemany(
+                "INSERT INTO messages (chat_id, role, content, artifact_id) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            await self._release_artifacts(artifact_ids)
+            await self._unindex_chat(chat["id"])
+            for msg in messages:
+                await self._index_doc(chat["id"], msg["content"])
+        else:
+            await self._unindex_chat(chat["id"], titles_only=True)
+        await self._index_doc(chat["id"], chat.get("title"), is_title=True)
+
+    async def get_chat(self, chat_id, offset=0, limit=None, max_content=None):
+        row = await self._fetchone(
+            "SELECT id, title, created_at, updated_at, project_id FROM chats WHERE id = ?",
+            (chat_id,),
+        )
+        if not row:
+            return None
+        count = (await self._fetchone(
+            "SELECT COUNT(*) FROM messages WHERE chat_id = ?", (chat_id,)
+        ))[0]
+        start, end = message_range(count, offset, limit)
+        if max_content is None:
+            columns = "m.role, m.content, NULL AS size, a.data"
+        else:
+            # 大段助手消息不读出正文（产物长度取自 size 列）
+            length = "COALESCE(a.size, length(m.content))"
+            omitted = f"m.role = 'assistant' AND {length} > :max"
+            columns = (
+                f"m.role, CASE WHEN {omitted} THEN NULL ELSE m.content END AS content, "
+                f"CASE WHEN {omitted} THEN {length} END AS size, "
+                f"CASE WHEN {omitted} THEN NULL ELSE a.data END AS data"
+            )
+        messages = await self._fetchall(
+            f"SELECT {columns}, a.encoding, m.artifact_id FROM messages m LEFT JOIN artifacts a ON a.id = m.artifact_id "
+            "WHERE m.chat_id = :chat_id ORDER BY m.id LIMIT :limit OFFSET :offset",
+            {"chat_id": chat_id, "limit": end - start, "offset": start, "max": max_content},
+        )
+        return {
+            **dict(row),
+            "messages": [_message_from_row(msg) for msg in messages],
+            "message_count": count,
+            "message_offset": start,
+        }
+
+    async def get_message(self, chat_id: str, index: int) -> Optional[dict]:
+        if index < 0:
+            return None
+        row = await self._fetchone(
+            "SELECT m.role, m.content, NULL AS size, a.data, a.encoding, m.artifact_id "
+            "FROM messages m LEFT JOIN artifacts a ON a.id = m.artifact_id "
+            "WHERE m.chat_id = ? ORDER BY m.id LIMIT 1 OFFSET ?",
+            (chat_id, index),
+        )
+        return _message_from_row(row) if row else None
+
+    async def chat_exists(self, chat_id: str) -> bool:
+        row = await self._fetchone("SELECT 1 FROM chats WHERE id = ?", (chat_id,))
+        return row is not None
+
+    async def append_message(self, chat_id, message, updated_at, default_title=None):
+        async with self._write_lock:
+            row = await self._fetchone("SELECT title, project_id FROM chats WHERE id = ?", (chat_id,))
+            if row is None:
+                return None
+            title = row["title"] or default_title
+            await self._db.execute(
+                "UPDATE chats SET updated_at = ?, title = ? WHERE id = ?",
+                (updated_at, title, chat_id),
+            )
+            content, artifact_id = await self._store_content(message["content"], original=message.get("original"))
+            await self._db.execute(
+                "INSERT INTO messages (chat_id, role, content, artifact_id) VALUES (?, ?, ?, ?)",
+                (chat_id, message["role"], content, artifact_id),
+            )
+            await self._index_doc(chat_id, message["content"])
+            if not row["title"] and title:
+                await self._index_doc(chat_id, title, is_title=True)
+            count = (await self._fetchone(
+                "SELECT COUNT(*) FROM messages WHERE chat_id = ?", (chat_id,)
+            ))[0]
+            await self._db.commit()
+        return {
+            "id": chat_id,
+            "title": title,
+            "updated_at": updated_at,
+            "project_id": row["project_id"],
+            "message_index": count - 1,
+            "artifact": artifact_id,
+        }
+
+    async def rename_chat(self, chat_id, title, updated_at):
+        async with self._write_lock:
+            cursor = await self._db.execute(
+                "UPDATE chats SET title = ?, updated_at = ? WHERE id = ?",
+                (title, updated_at, chat_id),
+            )
+            if cursor.rowcount:
+                await self._unindex_chat(chat_id, titles_only=True)
+                await self._index_doc(chat_id, title, is_title=True)
+            await self._db.commit()
+        if cursor.rowcount == 0:
+            return None
+        row = await self._fetchone(
+            "SELECT id, title, updated_at, project_id FROM chats WHERE id = ?", (chat_id,)
+        )
+        return dict(row) if row else None
+
+    async def delete_chat(self, chat_id: str) -> bool:
+        async with self._write_lock:
+            await self._unindex_chat(chat_id)
+            artifact_ids = await self._chat_artifacts("?", (chat_id,))
+            cursor = await self._db.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
+            await self._release_artifacts(artifact_ids)
+            await self._db.commit()
+        return cursor.rowcount > 0
+
+    # ---------------- 迁移 ----------------
+    async def export_snapshot(self) -> dict:
+        projects = {p["id"]: p for p in await self.list_projects()}
+        chats = {}
+        for row in await self._fetchall("SELECT id FROM chats"):
+            chat = await self.get_chat(row["id"])
+            chat.pop("message_count", None)
+            chat.pop("message_offset", None)
+            chat["messages"] = [plain_message(msg) for msg in chat["messages"]]
+            chats[row["id"]] = chat
+        return {"projects": projects, "chats": chats}
+
+    async def import_snapshot(self, snapshot: dict):
+        async with self._write_lock:
+            for project in _snapshot_records(snapshot, "projects"):
+                await self._db.execute(
+                    "INSERT INTO projects (id, name, updated_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(id) DO UPDATE SET name = excluded.name, updated_at = excluded.updated_at",
+                    (project["id"], project["name"], project["updated_at"]),
+                )
+            for chat in _snapshot_records(snapshot, "chats"):
+                await self._insert_chat(chat)
+            await self._db.commit()
+
+
+_JOB_COLUMNS = (
+    "id, kind, status, payload, chat_id, progress, error, artifact_id, message_index, worker, created_at, finished_at"
+)
+
+
+def _job_from_row(row) -> dict:
+    job = dict(row)
+    job["payload"] = json.loads(job["payload"])
+    job["artifact"] = job.pop("artifact_id")
+    return job
+
+
+def _message_from_row(row) -> dict:
+    content = unpack(row["data"], row["encoding"]) if row["data"] is not None else row["content"]
+    message = {"role": row["role"], "content": content}
+    if row["size"] is not None:
+        message["size"] = row["size"]
+    if row["artifact_id"]:
+        message["artifact"] = row["artifact_id"]
+    return message
+
+
+def _snapshot_records(snapshot: dict, name: str) -> List[dict]:
+    """快照中的集合既可以是 {id: record} 字典，也可以是 record 列表"""
+    records = snapshot.get(name) or {}
+    if isinstance(records, dict):
+        records = list(records.values())
+    return [r if isinstance(r, dict) else dict(r) for r in records]
+
+
+def create_store(backend: str, path: str = "") -> ChatStore:
+    backend = (backend or "sqlite").lower()
+    if backend == "memory":
+        return MemoryStore()
+    if backend == "sqlite":
+        return SQLiteStore(path or os.path.join("data", "chattutor.db"))
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+# -----------------------------------------------------------------------
+# 迁移命令：把原内存字典结构的 JSON 快照导入 / 导出 SQLite
+#   python storage.py import snapshot.json [data/chattutor.db]
+#   python storage.py export snapshot.json [data/chattutor.db]
+# -----------------------------------------------------------------------
+async def _main(argv: List[str]):
+    if len(argv) < 2 or argv[0] not in ("import", "export"):
+        print("用法: python storage.py import|export snapshot.json [数据库路径]")
+        return 1
+    command, snapshot_path = argv[0], argv[1]
+    store = create_store("sqlite", argv[2] if len(argv) > 2 else "")
+    await store.init()
+    try:
+        if command == "import":
+            with open(snapshot_path, "r", encoding="utf-8") as f:
+                await store.import_snapshot(json.load(f))
+            print(f"--- 已导入 {snapshot_path} ---")
+        else:
+            snapshot = await store.export_snapshot()
+            with open(snapshot_path, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f, ensure_ascii=False, indent=2)
+            print(f"--- 已导出到 {snapshot_path} ---")
+    finally:
+        await store.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_main(sys.argv[1:])))